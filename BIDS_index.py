@@ -0,0 +1,237 @@
+#Imports relevant modules.
+import os
+import sys
+import gzip
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+#A cached index of the files in a BIDS-style tree (e.g. a pipeline's fMRIPrep derivatives folder, or its FEAT folder),
+#shared by the scripts that look for a subject's files. The tree is walked once across a pool of threads, and each file
+#is stored with its size and modification time, and the BIDS entities in its name (e.g. 'sub', 'task', 'space',
+#'res' and 'desc', along with its 'suffix', 'extension' and 'datatype' folder). Files are then found by querying these
+#entities in memory, rather than listing folders and matching substrings of file names. The index is saved beside the
+#tree (so saving it doesn't change the tree's own modification times), and on the next run only the folders whose
+#modification time has changed (i.e. a file has been added, removed or renamed in them) are listed again. Files
+#rewritten in place don't change their folder's modification time, so their stored size and time may be out of date
+#until the index is rebuilt ('refresh(full=True)').
+#Running this module directly builds or refreshes the index for each folder given, e.g.
+#'python BIDS_index.py /<directory root>/fMRIPrep/Pipeline_0/derivatives'.
+
+#The name of the index file saved beside each tree (formatted with the tree's folder name), and the version of its format.
+index_name = '.{}_bids_index.json.gz'
+index_version = 1
+
+#Folders with these names aren't indexed, as they hold many files that aren't searched for (e.g. FreeSurfer output in
+#'sourcedata', and the report figures).
+default_skipped = {'sourcedata', 'figures', 'scratch'}
+
+#The number of threads used to list and check folders.
+n_threads = 16
+
+#A function to split a file name into its BIDS entities. Key-value pairs (e.g. 'res-2') are separated by underscores,
+#followed by the suffix (e.g. 'bold') and the extension, which starts at the first '.' (e.g. '.nii.gz'). Parts of the
+#name that are neither are ignored.
+def parse_entities(name):
+	first_decimal = name.find('.', 1)
+	stem, extension = (name, '') if first_decimal == -1 else (name[:first_decimal], name[first_decimal:])
+	parts = stem.split('_')
+	entities = {}
+	for part in parts:
+		key, separator, value = part.partition('-')
+		if separator and key and value:
+			entities[key] = value
+	if '-' not in parts[-1]:
+		entities['suffix'] = parts[-1]
+	entities['extension'] = extension
+	return entities
+
+#A function to list one folder. Returns its subfolders as (name, modification time) and its files as name: [size,
+#modification time]. Symbolic links are not followed.
+def scan_directory(path):
+	subdirectories, files = [], {}
+	try:
+		with os.scandir(path) as entries:
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					subdirectories.append((entry.name, entry.stat(follow_symlinks=False).st_mtime_ns))
+				elif entry.is_file(follow_symlinks=False):
+					stat = entry.stat(follow_symlinks=False)
+					files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+	except OSError as error:
+		print("Could not scan {}: {}".format(path, error))
+	return subdirectories, files
+
+#A function to find a folder's modification time, or None if it no longer exists.
+def directory_mtime(path):
+	try:
+		return os.stat(path).st_mtime_ns
+	except OSError:
+		return None
+
+#A class holding the index of one tree. Each folder is stored by its path relative to the top folder ('' for the top
+#folder itself), with its modification time and files.
+class BIDSIndex:
+
+	def __init__(self, root, index_file=None, skipped=default_skipped):
+		self.root = os.path.abspath(root)
+		self.index_file = index_file or os.path.join(os.path.dirname(self.root), index_name.format(os.path.basename(self.root)))
+		self.skipped = set(skipped)
+		self.directories = {}
+		self.changed = False
+		self.records = []
+		self.by_subject = defaultdict(list)
+
+		#Loads the saved index, if there is one for this tree in the current format.
+		if os.path.exists(self.index_file):
+			with gzip.open(self.index_file, 'rt') as f:
+				saved = json.load(f)
+			if saved.get('version') == index_version and saved.get('root') == self.root and sorted(saved.get('skipped', [])) == sorted(self.skipped):
+				self.directories = {relative: (mtime, files) for relative, (mtime, files) in saved['directories'].items()}
+		self.build_records()
+
+	#A function to list a folder and every folder below it across the pool, with each folder submitted as soon as its
+	#parent has been listed. The modification time of each subfolder is taken before it's listed, so any change made
+	#while it's being listed is picked up on the next refresh.
+	def walk(self, executor, relative, mtime):
+		pending = {executor.submit(scan_directory, os.path.join(self.root, relative)): (relative, mtime)}
+		while pending:
+			done, _ = wait(pending, return_when=FIRST_COMPLETED)
+			for future in done:
+				relative, mtime = pending.pop(future)
+				subdirectories, files = future.result()
+				self.directories[relative] = (mtime, files)
+				for name, sub_mtime in subdirectories:
+					if name not in self.skipped:
+						sub_relative = os.path.join(relative, name)
+						pending[executor.submit(scan_directory, os.path.join(self.root, sub_relative))] = (sub_relative, sub_mtime)
+
+	#A function to bring the index up to date. Every known folder is checked in parallel: folders that no longer exist
+	#are removed (along with everything below them), and folders whose modification time has changed are listed again,
+	#along with any new folders within them. If 'full' is True, or there's no saved index, the whole tree is walked.
+	#Returns the number of folders listed.
+	def refresh(self, full=False):
+		with ThreadPoolExecutor(max_workers=n_threads) as executor:
+			if full or '' not in self.directories:
+				self.directories = {}
+				self.walk(executor, '', directory_mtime(self.root))
+				self.changed = True
+				self.build_records()
+				return len(self.directories)
+
+			known = sorted(self.directories)
+			mtimes = dict(zip(known, executor.map(lambda relative: directory_mtime(os.path.join(self.root, relative)), known)))
+			changed = [relative for relative in known if mtimes[relative] is not None and mtimes[relative] != self.directories[relative][0]]
+			for relative in known:
+				if mtimes[relative] is None:
+					del self.directories[relative]
+
+			#Changed folders are listed again. Subfolders that are already known are kept (they're checked above), and
+			#new subfolders are walked.
+			listed = 0
+			for relative, (subdirectories, files) in zip(changed, executor.map(lambda relative: scan_directory(os.path.join(self.root, relative)), changed)):
+				self.directories[relative] = (mtimes[relative], files)
+				listed += 1
+				for name, sub_mtime in subdirectories:
+					sub_relative = os.path.join(relative, name)
+					if name not in self.skipped and sub_relative not in self.directories:
+						before = len(self.directories)
+						self.walk(executor, sub_relative, sub_mtime)
+						listed += len(self.directories) - before
+
+		if listed or len(known) != len(self.directories):
+			self.changed = True
+			self.build_records()
+		return listed
+
+	#A function to build the in-memory records queried below: one dictionary per file with its path, size, modification
+	#time and entities. Files are also grouped by subject, taken from the file name or, for files whose names don't
+	#include it (e.g. in the FEAT folders), the 'sub-' folder they're in. The datatype is the name of the file's folder
+	#(e.g. 'func', 'anat' or 'EVs').
+	def build_records(self):
+		self.records = []
+		self.by_subject = defaultdict(list)
+		for relative in sorted(self.directories):
+			folders = relative.split(os.sep) if relative else []
+			folder_subject = next((folder[4:] for folder in folders if folder.startswith('sub-')), None)
+			for name, (size, mtime) in sorted(self.directories[relative][1].items()):
+				record = parse_entities(name)
+				if 'sub' not in record and folder_subject is not None:
+					record['sub'] = folder_subject
+				if folders:
+					record['datatype'] = folders[-1]
+				record.update({'path': os.path.join(self.root, relative, name), 'name': name, 'size': size, 'mtime_ns': mtime})
+				self.records.append(record)
+				if 'sub' in record:
+					self.by_subject[record['sub']].append(record)
+
+	#A function to find the records of files matching the given entities, e.g. 'query(sub='10159', suffix='bold',
+	#res='2')'. Subjects can be given with or without the 'sub-' prefix. A list of values matches any of them, and None
+	#matches files without that entity.
+	def query(self, **entities):
+		if 'sub' in entities and isinstance(entities['sub'], str):
+			records = self.by_subject.get(entities['sub'][4:] if entities['sub'].startswith('sub-') else entities['sub'], [])
+			del entities['sub']
+		else:
+			records = self.records
+		matches = []
+		for record in records:
+			for key, value in entities.items():
+				if value is None:
+					if key in record:
+						break
+				elif isinstance(value, (list, tuple, set)):
+					if record.get(key) not in value:
+						break
+				elif record.get(key) != value:
+					break
+			else:
+				matches.append(record)
+		return matches
+
+	#A function to find the path of the one file matching the given entities. Returns None if there's no match, and
+	#raises an error if there's more than one.
+	def get(self, **entities):
+		matches = self.query(**entities)
+		if len(matches) > 1:
+			raise ValueError("{} files in {} match {}: {}".format(len(matches), self.root, entities, ', '.join(record['name'] for record in matches)))
+		return matches[0]['path'] if matches else None
+
+	#A function to find the values of an entity among the files matching the given entities (e.g. the resolutions
+	#available for a subject).
+	def values(self, entity, **entities):
+		return sorted({record[entity] for record in self.query(**entities) if entity in record})
+
+	#A function to find the subject folders (e.g. 'sub-10159') in the top folder of the tree.
+	def subjects(self):
+		return sorted(relative for relative in self.directories if os.sep not in relative and relative.startswith('sub-'))
+
+	#A function to save the index if it has changed. It's written to a temporary file which then replaces the old one,
+	#so a script stopped partway through (or another script reading the index) never sees a partial file.
+	def save(self):
+		if not self.changed:
+			return
+		temporary = '{}.{}.tmp'.format(self.index_file, os.getpid())
+		with gzip.open(temporary, 'wt') as f:
+			json.dump({'version': index_version, 'root': self.root, 'skipped': sorted(self.skipped), 'directories': self.directories}, f)
+		os.replace(temporary, self.index_file)
+		self.changed = False
+
+#A function to load the index for a tree, bring it up to date and save it. This is what the analysis scripts use.
+def load_index(root, **kwargs):
+	index = BIDSIndex(root, **kwargs)
+	index.refresh()
+	try:
+		index.save()
+	except OSError as error:
+		print("Could not save the index for {}: {}".format(root, error))
+	return index
+
+if __name__ == '__main__':
+
+	#Builds or refreshes the index for each folder given, reporting the number of folders listed.
+	for root in sys.argv[1:]:
+		index = BIDSIndex(root)
+		listed = index.refresh()
+		index.save()
+		print("{}: {} files in {} subjects, {} folders listed.".format(root, len(index.records), len(index.subjects()), listed))
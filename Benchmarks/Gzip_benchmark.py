@@ -0,0 +1,90 @@
+#Imports relevant modules.
+import os
+import sys
+import csv
+import time
+import zlib
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nb
+import Synthetic_data
+
+#The shared NIFTI writer is kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Nifti_writer
+
+#Measures the block-gzip NIFTI writer (see Nifti_writer.py) on a synthetic BOLD run: the throughput of compression for
+#each number of threads, and the size of the output file for each compression level. nibabel's own (single-threaded)
+#gzip writer is timed at its default level for comparison. Each file is checked to decompress to the same bytes.
+
+#The number of volumes in the synthetic run (184 in the real study), the numbers of threads and compression levels
+#tested, the number of times each is repeated (the fastest is kept), and a fixed seed for the synthetic data.
+n_vols = 184
+thread_counts = [1, 2, 4, 8, 16]
+levels = [1, 2, 3, 4, 5, 6, 7, 8, 9]
+repeats = 3
+seed = 1234
+
+#The file the results are written to.
+output_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gzip_benchmark.csv')
+
+#A function to time the fastest of several runs of a function.
+def fastest(function):
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+#A function to read back a compressed file as the uncompressed bytes, with zlib (which reads each gzip member in turn).
+def decompress(path):
+	with open(path, 'rb') as f:
+		data = f.read()
+	output = []
+	while data:
+		decompressor = zlib.decompressobj(wbits=31)
+		output.append(decompressor.decompress(data))
+		data = decompressor.unused_data
+	return b''.join(output)
+
+if __name__ == '__main__':
+
+	#Generates the synthetic run, and the uncompressed NIFTI file it's written as.
+	rng = np.random.default_rng(seed)
+	img = nb.Nifti1Image(Synthetic_data.bold_run(rng, Synthetic_data.brain_mask(), n_vols), Synthetic_data.mni_affine)
+	raw = img.to_bytes()
+	size_MB = len(raw) / 1e6
+	print("Synthetic run of {} volumes, {:.0f}MB uncompressed, {} cores available.".format(n_vols, size_MB, os.cpu_count()))
+
+	temp_dir = tempfile.mkdtemp(prefix='gzip_benchmark_')
+	rows = []
+	try:
+		path = os.path.join(temp_dir, 'bold.nii.gz')
+
+		#nibabel's writer, for comparison.
+		wall = fastest(lambda: nb.save(img, path))
+		rows.append({'Writer': 'nibabel', 'Threads': 1, 'Level': 1, 'Wall_s': wall, 'MB_per_s': size_MB / wall, 'Size_MB': os.path.getsize(path) / 1e6})
+
+		#The block writer with each number of threads, at the level used for timeseries, then at each level with every
+		#thread.
+		settings = [(threads, Nifti_writer.compression_levels['timeseries']) for threads in thread_counts]
+		settings += [(max(thread_counts), level) for level in levels if level != Nifti_writer.compression_levels['timeseries']]
+		for threads, level in settings:
+			wall = fastest(lambda: Nifti_writer.save(img, path, level, threads))
+			if decompress(path) != raw:
+				raise ValueError("Output with {} threads at level {} doesn't match the uncompressed file".format(threads, level))
+			rows.append({'Writer': 'block', 'Threads': threads, 'Level': level, 'Wall_s': wall, 'MB_per_s': size_MB / wall, 'Size_MB': os.path.getsize(path) / 1e6})
+	finally:
+		shutil.rmtree(temp_dir)
+
+	print("{:<10}{:>8}{:>7}{:>10}{:>10}{:>10}{:>8}".format('Writer', 'Threads', 'Level', 'Wall_s', 'MB/s', 'Size_MB', 'Ratio'))
+	for row in rows:
+		print("{:<10}{:>8}{:>7}{:>10.2f}{:>10.1f}{:>10.1f}{:>8.2f}".format(row['Writer'], row['Threads'], row['Level'], row['Wall_s'],
+			row['MB_per_s'], row['Size_MB'], size_MB / row['Size_MB']))
+
+	with open(output_file, 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+		writer.writeheader()
+		writer.writerows(rows)
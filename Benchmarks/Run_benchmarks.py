@@ -0,0 +1,239 @@
+#Imports relevant modules.
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+import numpy as np
+import nibabel as nb
+from concurrent.futures import ProcessPoolExecutor
+import Synthetic_data
+
+#Times each hot path in the repository on synthetic data (see Synthetic_data.py), recording wall time, CPU time and
+#peak memory, and appends the results to a JSON history so that changes in speed can be tracked across commits.
+
+#Defines the top of the repository, and the file the history of results is kept in.
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+history_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_history.json')
+
+#The size of the synthetic data for each scale. 'full' matches the real study (257 subjects, 184 volumes).
+scales = {'small': {'subjects': 8, 'vols': 40, 'jobs': 10, 'tasks': 257},
+	'medium': {'subjects': 32, 'vols': 100, 'jobs': 50, 'tasks': 257},
+	'full': {'subjects': 257, 'vols': 184, 'jobs': 200, 'tasks': 257}}
+scale = 'small'
+
+#The benchmarks to run (all if empty), the number of times each is repeated, a fixed seed for the synthetic data,
+#and whether a second run of each is made under tracemalloc to record peak Python/numpy allocations (this is slower).
+selected = []
+repeats = 3
+seed = 1234
+trace_memory = False
+
+#Benchmarks are flagged as regressions if their median wall time is this many times the best previous median, and
+#slower by at least this many seconds (so that timer noise in very short benchmarks isn't flagged).
+regression_ratio = 1.2
+regression_min_s = 0.05
+
+#A function to run one of the repository's scripts in this process, replacing the module-level assignments given in
+#'overrides' (e.g. input and output paths). Output printed by the script is discarded.
+def run_script(script, overrides):
+	path = os.path.join(repo_dir, script)
+	with open(path, 'r') as f:
+		source = f.read()
+	for name, value in overrides.items():
+		source, count = re.subn(r'^{} = .*$'.format(re.escape(name)), lambda match: '{} = {!r}'.format(name, value), source, flags=re.MULTILINE)
+		if count != 1:
+			raise ValueError("Could not find the assignment of '{}' in {}".format(name, script))
+
+	sys.path.insert(0, os.path.dirname(path))
+	try:
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			exec(compile(source, path, 'exec'), {'__name__': '__main__', '__file__': path})
+	finally:
+		sys.path.remove(os.path.dirname(path))
+
+#A function to import Calc_carbon.py as a module.
+def calc_carbon():
+	sys.path.insert(0, os.path.join(repo_dir, 'Carbon Tracking'))
+	import Calc_carbon
+	return Calc_carbon
+
+#Each benchmark is a function taking the data directory. Setup work that shouldn't be timed (e.g. loading the HPC
+#information files) is done by returning a function to be timed.
+def bench_parse_sge_qacct(data_dir):
+	module = calc_carbon()
+	with open(os.path.join(data_dir, 'qacct', 'qacct.txt')) as f:
+		lines = f.readlines()
+	return lambda: module.parse_sge_qacct(iter(lines))
+
+def bench_calulate_results(data_dir):
+	module = calc_carbon()
+	with open(os.path.join(data_dir, 'qacct', 'qacct.txt')) as f:
+		jobs = module.parse_sge_qacct(f)
+	with open(os.path.join(data_dir, 'qacct', 'cpu_info.json')) as f:
+		cpu_info = json.load(f)
+	with open(os.path.join(data_dir, 'qacct', 'node_info.json')) as f:
+		node_info = json.load(f)
+	return lambda: module.calulate_results(jobs, cpu_info, node_info)
+
+#The group maps keep accumulators between runs (see Group_accumulator.py), so these are removed before timing to measure
+#a full build. The '_incremental' benchmark instead times a rerun with nothing changed.
+def bench_activation_count(data_dir):
+	shutil.rmtree(os.path.join(data_dir, 'Output', 'Activation_Count', 'Accumulators'), ignore_errors=True)
+	return lambda: run_script(os.path.join('Figure Creation', 'Activation_count.py'),
+		{'pipeline_dir': os.path.join(data_dir, 'FEAT', 'Pipeline_0'), 'output_dir': os.path.join(data_dir, 'Output', 'Activation_Count')})
+
+def bench_activation_sd_map(data_dir):
+	shutil.rmtree(os.path.join(data_dir, 'Output', 'Accumulators', 'P0_Activation_SD'), ignore_errors=True)
+	return lambda: run_script(os.path.join('Figure Creation', 'Activation_SD_Map.py'),
+		{'pipeline_dir': os.path.join(data_dir, 'FEAT', 'Pipeline_0'), 'output_file': os.path.join(data_dir, 'Output', 'P0_Activation_SD_Map.nii.gz')})
+
+def bench_activation_sd_map_incremental(data_dir):
+	bench_activation_sd_map(data_dir)()
+	return lambda: run_script(os.path.join('Figure Creation', 'Activation_SD_Map.py'),
+		{'pipeline_dir': os.path.join(data_dir, 'FEAT', 'Pipeline_0'), 'output_file': os.path.join(data_dir, 'Output', 'P0_Activation_SD_Map.nii.gz')})
+
+def bench_timeseries_sd_map(data_dir):
+	shutil.rmtree(os.path.join(data_dir, 'Output', 'Accumulators', 'P0_Timeseries_SD'), ignore_errors=True)
+	return lambda: run_script(os.path.join('Figure Creation', 'Timeseries_SD_Map.py'),
+		{'pipeline_dir': os.path.join(data_dir, 'fMRIPrep', 'Pipeline_0', 'derivatives'), 'output_file': os.path.join(data_dir, 'Output', 'P0_SD_Map.nii.gz')})
+
+def bench_featquery_extract(data_dir):
+	return lambda: run_script(os.path.join('FEAT', 'Featquery_extract.py'),
+		{'pipeline_dir': os.path.join(data_dir, 'FEAT', 'Pipeline_0'), 'output_path': os.path.join(data_dir, 'Output', 'Pipeline_0_Featquery.csv')})
+
+def bench_smoothing_average(data_dir):
+	return lambda: run_script(os.path.join('Smoothing', 'Smoothing_average.py'),
+		{'feat_dir': os.path.join(data_dir, 'FEAT'), 'output_path': os.path.join(data_dir, 'Output', 'Pipeline_0_smoothness.csv')})
+
+def bench_pipeline_data_compile(data_dir):
+	return lambda: run_script('Pipeline_data_compile.py',
+		{'pipelines': ['0', '1'], 'data_folder': os.path.join(data_dir, 'Sustainability_Output')})
+
+#The block-gzip writer (see Nifti_writer.py) saving a synthetic BOLD run, loaded into memory before timing. The effect
+#of the number of threads and compression level is measured separately by Gzip_benchmark.py.
+def bench_nifti_writer(data_dir):
+	sys.path.insert(0, repo_dir)
+	import Nifti_writer
+	subject = Synthetic_data.subject_ids(1)[0]
+	bold_file = os.path.join(data_dir, 'fMRIPrep', 'Pipeline_0', 'derivatives', subject, 'func',
+		'{}_task-stopsignal_space-MNI152NLin6Asym_res-2_desc-preproc_bold.nii.gz'.format(subject))
+	bold_load = nb.load(bold_file)
+	img = nb.Nifti1Image(bold_load.get_fdata(dtype=np.float32), bold_load.affine, bold_load.header)
+	return lambda: Nifti_writer.save(img, os.path.join(data_dir, 'Output', 'stopsignal_brain.nii.gz'), 'timeseries')
+
+benchmarks = {'parse_sge_qacct': bench_parse_sge_qacct,
+	'calulate_results': bench_calulate_results,
+	'Activation_count': bench_activation_count,
+	'Activation_SD_Map': bench_activation_sd_map,
+	'Activation_SD_Map_incremental': bench_activation_sd_map_incremental,
+	'Timeseries_SD_Map': bench_timeseries_sd_map,
+	'Featquery_extract': bench_featquery_extract,
+	'Smoothing_average': bench_smoothing_average,
+	'Pipeline_data_compile': bench_pipeline_data_compile,
+	'Nifti_writer': bench_nifti_writer}
+
+#A function to generate all synthetic data for the given scale into a directory.
+def generate_data(data_dir, size):
+	rng = np.random.default_rng(seed)
+	mask = Synthetic_data.brain_mask()
+	subjects = Synthetic_data.subject_ids(size['subjects'])
+	Synthetic_data.write_qacct(rng, os.path.join(data_dir, 'qacct'), size['jobs'], size['tasks'])
+	Synthetic_data.write_feat_tree(rng, os.path.join(data_dir, 'FEAT'), '0', subjects, size['vols'], mask)
+	Synthetic_data.write_derivatives(rng, os.path.join(data_dir, 'fMRIPrep'), '0', subjects, size['vols'], mask)
+	for pipeline in ['0', '1']:
+		Synthetic_data.write_compile_inputs(rng, os.path.join(data_dir, 'Sustainability_Output'), pipeline, subjects)
+	os.makedirs(os.path.join(data_dir, 'Output', 'Activation_Count'), exist_ok=True)
+
+#A function to run one repeat of a benchmark. This is called in a fresh worker process, so that the peak resident
+#memory (which only ever increases within a process) belongs to this benchmark alone.
+def measure(name, data_dir, traced):
+	timed = benchmarks[name](data_dir)
+	rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	if traced:
+		tracemalloc.start()
+	wall_start, cpu_start = time.perf_counter(), time.process_time()
+	timed()
+	result = {'wall_s': time.perf_counter() - wall_start, 'cpu_s': time.process_time() - cpu_start}
+	if traced:
+		result['traced_peak_MB'] = tracemalloc.get_traced_memory()[1] / 1e6
+		tracemalloc.stop()
+
+	#ru_maxrss is given in kilobytes on Linux.
+	rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	result['peak_rss_MB'] = rss_after / 1e3
+	result['rss_increase_MB'] = (rss_after - rss_before) / 1e3
+	return result
+
+#A function to run a benchmark in a new worker process.
+def run_isolated(name, data_dir, traced=False):
+	with ProcessPoolExecutor(max_workers=1) as executor:
+		return executor.submit(measure, name, data_dir, traced).result()
+
+#A function to find the current commit, so that results can be matched to changes.
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True, text=True).stdout.strip()
+	except OSError:
+		return ''
+
+if __name__ == '__main__':
+
+	names = selected or list(benchmarks)
+	size = scales[scale]
+
+	#Generates the synthetic data once, in a temporary directory that is removed afterwards.
+	data_dir = tempfile.mkdtemp(prefix='benchmark_')
+	try:
+		start = time.perf_counter()
+		generate_data(data_dir, size)
+		print("Generated {} data in {:.1f}s.".format(scale, time.perf_counter() - start))
+
+		results = {}
+		for name in names:
+			runs = [run_isolated(name, data_dir) for _ in range(repeats)]
+			wall = [run['wall_s'] for run in runs]
+			results[name] = {'wall_s_median': float(np.median(wall)),
+				'wall_s_min': min(wall),
+				'cpu_s_median': float(np.median([run['cpu_s'] for run in runs])),
+				'peak_rss_MB': max(run['peak_rss_MB'] for run in runs),
+				'rss_increase_MB': max(run['rss_increase_MB'] for run in runs)}
+			if trace_memory:
+				results[name]['traced_peak_MB'] = run_isolated(name, data_dir, traced=True)['traced_peak_MB']
+	finally:
+		shutil.rmtree(data_dir)
+
+	#Loads the history, and compares each result with the best previous median at the same scale.
+	history = []
+	if os.path.exists(history_file):
+		with open(history_file, 'r') as f:
+			history = json.load(f)
+
+	for name, result in results.items():
+		previous = [entry['results'][name]['wall_s_median'] for entry in history if entry['scale'] == scale and name in entry['results']]
+		note = ''
+		if previous:
+			ratio = result['wall_s_median'] / min(previous)
+			regression = ratio > regression_ratio and result['wall_s_median'] - min(previous) > regression_min_s
+			note = '{:.2f}x best previous{}'.format(ratio, ', REGRESSION' if regression else '')
+		print("{:<24}{:>10.3f}s {:>10.1f}MB  {}".format(name, result['wall_s_median'], result['peak_rss_MB'], note))
+
+	#Appends this run to the history.
+	history.append({'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'commit': git_commit(),
+		'scale': scale,
+		'repeats': repeats,
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'machine': platform.node(),
+		'results': results})
+	with open(history_file, 'w') as f:
+		json.dump(history, f, indent=2)
@@ -0,0 +1,174 @@
+#Imports relevant modules.
+import os
+import csv
+import json
+import numpy as np
+import nibabel as nb
+
+#Generators for synthetic inputs with the same layout and format as the real data, so that scripts can be run and timed
+#without access to the cluster. Every generator takes a numpy random generator, so the same seed gives the same data.
+
+#The grid and affine of the MNI152 2mm template, used for all generated volumes.
+mni_shape = (91, 109, 91)
+mni_affine = np.array([[-2, 0, 0, 90], [0, 2, 0, -126], [0, 0, 2, -72], [0, 0, 0, 1]], dtype=float)
+
+#The ROIs used with FEATQUERY, and the hosts/CPU written into the HPC information files.
+regions = ['Motor', 'Pre-sma', 'Auditory', 'Insula']
+hosts = ['node{}'.format(n) for n in range(101, 111)]
+cpu_model = 'Xeon_Gold_6248R'
+
+#A function to list subject IDs in the same format as the CNP dataset.
+def subject_ids(n_subjects):
+	return ['sub-{}'.format(10159 + s) for s in range(n_subjects)]
+
+#A function to make a brain-shaped (ellipsoid) mask filling most of the grid.
+def brain_mask(shape=mni_shape):
+	grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+	return sum(((axis - (n - 1) / 2) / (0.42 * n)) ** 2 for axis, n in zip(grid, shape)) <= 1
+
+#A function to make a z-statistic volume: smooth noise within the brain plus a few blobs of activation, shared across
+#subjects (centres are fixed) so that activation overlaps as it would in real data.
+def zstat_volume(rng, mask, n_blobs=6):
+	shape = mask.shape
+	noise = rng.standard_normal([n // 4 + 1 for n in shape]).astype(np.float32)
+	volume = np.kron(noise, np.ones((4, 4, 4), dtype=np.float32))[:shape[0], :shape[1], :shape[2]]
+	grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+	centres = np.random.default_rng(0).uniform(0.3, 0.7, size=(n_blobs, 3)) * shape
+	for centre in centres:
+		distance = sum((axis - c) ** 2 for axis, c in zip(grid, centre))
+		volume += 5 * np.exp(-distance / 50).astype(np.float32) * rng.uniform(0.5, 1.5)
+	return volume * mask
+
+#A function to make a 4D BOLD run within the brain: a mean image plus slow drift and noise at every voxel.
+def bold_run(rng, mask, n_vols):
+	mean = 1000 * mask.astype(np.float32)
+	drift = np.linspace(0, 1, n_vols, dtype=np.float32)
+	noise = rng.standard_normal(mask.shape + (n_vols,), dtype=np.float32) * 10
+	return (mean[..., np.newaxis] * (1 + 0.01 * drift) + noise) * mask[..., np.newaxis]
+
+#A function to save an array as a compressed NIFTI file in MNI space.
+def save_nifti(data, path):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	nb.save(nb.Nifti1Image(data, mni_affine), path)
+
+#A function to write a qacct dump for a number of array jobs, each with a number of tasks, in the format read by
+#Calc_carbon.py. Also writes the node and CPU information files it needs. Returns the path of the dump.
+def write_qacct(rng, output_dir, n_jobs, n_tasks):
+	os.makedirs(output_dir, exist_ok=True)
+	qacct_file = os.path.join(output_dir, 'qacct.txt')
+	with open(qacct_file, 'w') as f:
+		for j in range(n_jobs):
+			for t in range(1, n_tasks + 1):
+				wallclock = rng.uniform(3, 12) * 3600
+				slots = [1, 5, 16][rng.integers(3)]
+				f.write('=' * 62 + '\n')
+				for key, value in [('qname', 'all.q'),
+						('hostname', hosts[rng.integers(len(hosts))]),
+						('group', 'psych'),
+						('owner', 'user'),
+						('jobname', 'P{}'.format(j % 10)),
+						('jobnumber', 3619260 + j),
+						('taskid', t),
+						('qsub_time', '01/11/2023 09:00:00.000'),
+						('start_time', '01/11/2023 09:00:10.000'),
+						('end_time', '01/11/2023 18:00:10.000'),
+						('granted_pe', 'openmp'),
+						('slots', slots),
+						('failed', 0),
+						('exit_status', 0),
+						('ru_wallclock', '{:.3f}s'.format(wallclock)),
+						('ru_utime', '{:.3f}s'.format(wallclock * slots * 0.6)),
+						('ru_stime', '{:.3f}s'.format(wallclock * 0.05)),
+						('wallclock', '{:.3f}'.format(wallclock)),
+						('cpu', '{:.3f}'.format(wallclock * slots * rng.uniform(0.4, 0.9))),
+						('mem', '{:.3f}'.format(wallclock * rng.uniform(2, 8))),
+						('io', '{:.3f}'.format(rng.uniform(1, 50))),
+						('iow', '0.000'),
+						('maxvmem', '{:.3f}G'.format(rng.uniform(2, 30))),
+						('arid', 'undefined'),
+						('hard_resources', 'h_vmem=8G,m_mem_free=8G')]:
+					f.write('{:<13} {}\n'.format(key, value))
+
+	with open(os.path.join(output_dir, 'node_info.json'), 'w') as f:
+		json.dump({host: cpu_model for host in hosts}, f)
+	with open(os.path.join(output_dir, 'cpu_info.json'), 'w') as f:
+		json.dump({cpu_model: {'TDP': 205, 'CPU': 24}}, f)
+	return qacct_file
+
+#A function to write a 3dFWHMx-style smoothness file, with one row of x, y and z estimates per volume.
+def write_smoothness(rng, path, n_vols, fwhm):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	np.savetxt(path, fwhm + rng.normal(0, 0.1, size=(n_vols, 3)), fmt='%.6f')
+
+#A function to write a FEATQUERY report, with the mean z-statistic in the sixth column of the first line.
+def write_featquery_report(rng, path):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	values = np.sort(rng.normal(1, 1, size=6))
+	with open(path, 'w') as f:
+		f.write('1 stats/zstat1 {} {:.4f} {:.4f} {:.4f} {:.4f} {:.4f} {:.4f} {:.4f}\n'.format(rng.integers(100, 2000), values[0], values[1], values.mean(), np.median(values), values[4], values[5], values.std()))
+
+#A function to write a full FEAT directory tree for one pipeline, with the files read by Activation_count.py,
+#Activation_SD_Map.py, Featquery_extract.py and Smoothing_average.py for each subject.
+def write_feat_tree(rng, feat_dir, pipeline, subjects, n_vols=184, mask=None):
+	mask = brain_mask() if mask is None else mask
+	pipeline_dir = os.path.join(feat_dir, 'Pipeline_{}'.format(pipeline))
+	for subject in subjects:
+		results_dir = os.path.join(pipeline_dir, subject, 'Results')
+		zstat = zstat_volume(rng, mask)
+		for number, volume in [('1', zstat), ('2', -zstat)]:
+			save_nifti(volume, os.path.join(results_dir, '.feat', 'stats', 'zstat{}.nii.gz'.format(number)))
+			save_nifti(np.where(volume > 3.1, volume, 0), os.path.join(results_dir, '.feat', 'thresh_zstat{}.nii.gz'.format(number)))
+		for region in regions:
+			write_featquery_report(rng, os.path.join(results_dir, '.feat', 'featquery_{}'.format(region), 'report.txt'))
+		write_smoothness(rng, os.path.join(results_dir, 'Smoothness', 'smoothness_pre'), n_vols, 2.5)
+		write_smoothness(rng, os.path.join(results_dir, 'Smoothness', 'smoothness_post'), n_vols, 6.0)
+	return pipeline_dir
+
+#A function to write an fMRIPrep confounds file, with the columns used from it (and n/a in the first row of the
+#derivative columns, as fMRIPrep writes them).
+def write_confounds(rng, path, n_vols):
+	motion = np.cumsum(rng.normal(0, 0.02, size=(n_vols, 6)), axis=0)
+	framewise = np.abs(np.diff(motion[:, :3], axis=0)).sum(axis=1) + 50 * np.abs(np.diff(motion[:, 3:], axis=0)).sum(axis=1)
+	dvars = rng.normal(20, 2, size=n_vols)
+	columns = {'global_signal': rng.normal(1000, 5, size=n_vols),
+		'csf': rng.normal(1200, 10, size=n_vols),
+		'white_matter': rng.normal(900, 5, size=n_vols),
+		'dvars': dvars,
+		'std_dvars': dvars / 20,
+		'framewise_displacement': np.concatenate([[np.nan], framewise])}
+	columns.update({name: motion[:, i] for i, name in enumerate(['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z'])})
+
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'w', newline='') as f:
+		writer = csv.writer(f, delimiter='\t')
+		writer.writerow(columns.keys())
+		for row in zip(*columns.values()):
+			writer.writerow(['n/a' if np.isnan(value) else '{:.6f}'.format(value) for value in row])
+
+#A function to write fMRIPrep derivatives for one pipeline, with the brain mask, preprocessed BOLD run and confounds
+#file for each subject (as read by Timeseries_SD_Map.py).
+def write_derivatives(rng, fmriprep_dir, pipeline, subjects, n_vols, mask=None):
+	mask = brain_mask() if mask is None else mask
+	derivatives_dir = os.path.join(fmriprep_dir, 'Pipeline_{}'.format(pipeline), 'derivatives')
+	for subject in subjects:
+		func_dir = os.path.join(derivatives_dir, subject, 'func')
+		prefix = os.path.join(func_dir, '{}_task-stopsignal_space-MNI152NLin6Asym_res-2_'.format(subject))
+		save_nifti(mask.astype(np.uint8), prefix + 'desc-brain_mask.nii.gz')
+		save_nifti(bold_run(rng, mask, n_vols), prefix + 'desc-preproc_bold.nii.gz')
+		write_confounds(rng, os.path.join(func_dir, '{}_task-stopsignal_desc-confounds_timeseries.tsv'.format(subject)), n_vols)
+	return derivatives_dir
+
+#A function to write the per-pipeline CSV files read by Pipeline_data_compile.py (carbon, smoothness and FEATQUERY
+#outputs), in the output folder structure it expects.
+def write_compile_inputs(rng, data_folder, pipeline, subjects):
+	outputs = {'Calc_Carbon': ('Pipeline_{}_carbon_HPC.csv', {'Wallclock': (30000, 5000), 'kgCO2': (0.5, 0.1), 'CPU_kWh': (2, 0.4), 'Memory_kWh': (0.1, 0.02)}),
+		'Smoothness': ('Pipeline_{}_smoothness.csv', {'Pre': (2.5, 0.1), 'Post': (6, 0.2)}),
+		'Featquery': ('Pipeline_{}_Featquery.csv', {region: (1, 1) for region in regions})}
+	for folder, (name, columns) in outputs.items():
+		os.makedirs(os.path.join(data_folder, folder), exist_ok=True)
+		with open(os.path.join(data_folder, folder, name.format(pipeline)), 'w', newline='') as f:
+			writer = csv.DictWriter(f, fieldnames=['Subject'] + list(columns))
+			writer.writeheader()
+			for subject in subjects:
+				writer.writerow(dict(Subject=subject, **{column: rng.normal(mean, sd) for column, (mean, sd) in columns.items()}))
+	os.makedirs(os.path.join(data_folder, 'Compiled'), exist_ok=True)
@@ -62,7 +62,7 @@ W_memory_per_GB = 0.3725
 g_per_kWh = 193.38
 
 
-#ARGPARSE GLOBALS/Defaults
+#ARGPARSE Defaults. These are only used as the defaults of CarbonConfig (below), and are never changed at runtime.
 SAVE_TO_JSON=True
 PRINT_RESULT=True
 MEM_CALC="ceiled"
@@ -73,6 +73,56 @@ CPU_FILE="cpu_info.json"
 CPU_CALC="cputime"
 
 
+#######################################################################
+##################### Config and Records ##############################
+#######################################################################
+
+#Settings for a run of the calculations. A config object is passed to the functions that need it, rather than setting
+#module globals, so that several configurations can be used in the same process.
+class CarbonConfig:
+    __slots__ = ("W_memory_per_GB", "g_per_kWh", "save_to_json", "print_result", "mem_calc", "cpu_calc",
+                 "json_dir", "node_file", "cpu_file")
+
+    def __init__(self, W_memory_per_GB=W_memory_per_GB, g_per_kWh=g_per_kWh, save_to_json=SAVE_TO_JSON,
+                 print_result=PRINT_RESULT, mem_calc=MEM_CALC, cpu_calc=CPU_CALC, json_dir=JSON_DIR,
+                 node_file=NODE_FILE, cpu_file=CPU_FILE):
+        self.W_memory_per_GB = W_memory_per_GB
+        self.g_per_kWh = g_per_kWh
+        self.save_to_json = save_to_json
+        self.print_result = print_result
+        self.mem_calc = mem_calc
+        self.cpu_calc = cpu_calc
+        self.json_dir = json_dir
+        self.node_file = node_file
+        self.cpu_file = cpu_file
+
+    #Builds a config from parsed command line arguments.
+    @classmethod
+    def from_args(cls, args):
+        return cls(W_memory_per_GB=args.w_mem_per_GB, g_per_kWh=args.CI, save_to_json=args.save_to_json,
+                   print_result=args.print_result, mem_calc=args.memory_calc, cpu_calc=args.cpu_calc,
+                   json_dir=args.json_dir, node_file=args.node_info, cpu_file=args.cpu_info)
+
+#The accounting information and results for one task of a job. Fields that haven't been found or calculated are None.
+#Using __slots__ keeps each record small, so thousands of jobs can be held and calculated in memory at once.
+class TaskRecord:
+    fields = ("host", "wallclock", "cpu", "mem", "max_vmem", "NUM_CPU", "RAM",
+              "mem_kWh", "mem_gCO2", "cpu_kWh", "cpu_gCO2", "kWh", "gCO2")
+    __slots__ = ("job_id", "task_id") + fields
+
+    def __init__(self, job_id, task_id, host=None):
+        self.job_id = job_id
+        self.task_id = task_id
+        for field in self.fields:
+            setattr(self, field, None)
+        self.host = host
+
+    #Returns the record as a dictionary, in the same form as the task entries of the output JSON files. As in earlier
+    #versions, fields that weren't found or calculated are left out rather than written as null.
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields if getattr(self, field) is not None}
+
+
 #######################################################################
 ##################### Function Declarations ###########################
 #######################################################################
@@ -85,11 +135,11 @@ def load_input_stream():
 
 #Opens and loads JSON files (specific to the University of Sussex HPC architecture)
 #that contain information about nodes and CPUs in use.
-def load_hpc_info():
-    with open(NODE_FILE, 'r') as fin:
+def load_hpc_info(config):
+    with open(config.node_file, 'r') as fin:
         node_info = json.load(fin)
         
-    with open(CPU_FILE, 'r') as fin:
+    with open(config.cpu_file, 'r') as fin:
         cpu_info = json.load(fin)
         
     return node_info,cpu_info
@@ -115,25 +165,50 @@ def calc_job_req_kWh(cpu,slots,wallclock,RAM,W_memory_per_GB=W_memory_per_GB):
     ram_kWh = RAM * W_memory_per_GB / 3600 / 1000
     return cpu_kWh + ram_kWh
 
-# Function to parse the input stream given it is the output from SGE/UGE qacct
-def parse_sge_qacct(input_stream):
-    #Creates an empty dictionary to store information about HPC jobs.
+#A function to convert a maxvmem value from qacct (e.g. '7.5G') to GBs.
+def parse_maxvmem(maxvmem):
+    if "T" in maxvmem:
+        return float(maxvmem[:-1])*1000
+    elif "G" in maxvmem:
+        return float(maxvmem[:-1])
+    elif "M" in maxvmem:
+        return float(maxvmem[:-1])/1000
+    elif "K" in maxvmem:
+        return float(maxvmem[:-1])/1e6
+    return float(maxvmem)/1e9
+
+#A function to find the requested (blocked) memory for a job in GBs from the hard_resources field, converting from MB if needed.
+def parse_requested_RAM(resources):
+    RAM=None
+    for res in resources.split(","):
+        if "h_vmem" in res:
+            request = res.split("=")[1]
+            if "G" in request:
+                RAM = float(request[:-1])
+            elif "M" in request:
+                RAM = float(request[:-1])/1000
+    return RAM
+
+# Function to parse SGE/UGE qacct output, given as any iterable of lines (e.g. stdin, an open file, or a list).
+# Returns a list of TaskRecords, in the order tasks were found. Nothing is read from or written to disk.
+def parse_sge_qacct(lines):
+    #Records are kept by job and task ID, so a task listed twice keeps its latest values.
     #At default, the task ID, job ID, and hostname (node) are effectively empty.
-    jobs = {}
+    records = {}
     task_id = "notset"
     job_id = 0
     hostname = None
+    record = None
 
     #Goes through the 'qacct' output line by line and grabs job
-    #information to store in dictionary for output and carbon calculations.
-    for line in input_stream:
+    #information to store in records for output and carbon calculations.
+    for line in lines:
 
         #Checks whether the current job number can be found.
         if "jobnumber" in line:
             tmp = line.split()[1]
             if tmp!=job_id:
                 job_id=tmp
-                jobs[job_id]={}
             else:
                 continue
 
@@ -148,167 +223,135 @@ def parse_sge_qacct(input_stream):
             except ValueError:
                 if line.split()[1].strip()=="undefined":
                     task_id=0
-            jobs[job_id][task_id]={"host":hostname}
+            record = records[(job_id, task_id)] = TaskRecord(job_id, task_id, hostname)
 
         #Finds the duration of the task.
         elif "wallclock" in line and "ru_" not in line:
             if task_id=="notset":
-                jobs[job_id][task_id]={"host":hostname}
-            jobs[job_id][task_id]["wallclock"] = float(line.split()[1])
+                record = records[(job_id, task_id)] = TaskRecord(job_id, task_id, hostname)
+            record.wallclock = float(line.split()[1])
 
         # Finds the cputime of the jobs (ignores idl thread time)
         elif "cpu" in line:
-            cpu_time = float(line.split()[1])
-            jobs[job_id][task_id]["cpu"] = cpu_time
+            record.cpu = float(line.split()[1])
 
         #The same steps as above are repeated for RAM. We look for the consumed GBs of RAM for the job and
         #not the max memory consumed. Mem is the sum of ram_in_use*time_interval for the runtime of the jop.
         elif "mem " in line and "max" not in line:
-            jobs[job_id][task_id]["mem"] = float(line.split()[1])            
+            record.mem = float(line.split()[1])
 
         #The same steps as above are repeated for RAM. We look for peak memory consumed.
         elif "maxvmem" in line:
-            maxvmem = line.split()[1]
-            if "T" in maxvmem:
-                maxvmem = float(maxvmem[:-1])*1000
-            elif "G" in maxvmem:
-                maxvmem = float(maxvmem[:-1])
-            elif "M" in maxvmem:
-                maxvmem = float(maxvmem[:-1])/1000
-            elif "K" in maxvmem:
-                maxvmem = float(maxvmem[:-1])/1e6
-            else:
-                maxvmem = float(maxvmem)/1e9
-            jobs[job_id][task_id]["max_vmem"] = maxvmem
+            record.max_vmem = parse_maxvmem(line.split()[1])
 
         #Finds the number of slots (cpu cores) used for a given task.
         elif "slots" in line:
-            jobs[job_id][task_id]["NUM_CPU"] = int(line.split()[1])
+            record.NUM_CPU = int(line.split()[1])
 
-        #Find and store the requested (blocked) memory for the job. Convert to GB if in MB.
+        #Find and store the requested (blocked) memory for the job.
         elif "hard_resources" in line:
-            reqs = line.split()[1].split(",")
-            RAM=None
-            for res in reqs:
-                if "h_vmem" in res:
-                    request = res.split("=")[1]
-                    if "G" in request:
-                        RAM = float(request[:-1])
-                    elif "M" in request:
-                        RAM = float(request[:-1])/1000
-            jobs[job_id][task_id]["RAM"] = RAM 
-    return jobs
+            record.RAM = parse_requested_RAM(line.split()[1])
+    return list(records.values())
 
 
-# Function to
-def calulate_results(jobs, cpu_info, node_info):
-    for job_id in jobs.keys():
-        for task_id in jobs[job_id].keys():
-            
-            #Finds the memory used and how long for depending on switch case..
-            #Calculates the energy use and estimated carbon footprint of the RAM time using the above functions.
-            match MEM_CALC:
-                case "integrated":
-                    GB_mem_time = jobs[job_id][task_id]["mem"]
-                case "ceiled":
-                    GB_mem_time = math.ceil(jobs[job_id][task_id]["max_vmem"]) * jobs[job_id][task_id]["wallclock"]
-                case "requested":
-                    GB_mem_time = jobs[job_id][task_id]["RAM"] * jobs[job_id][task_id]["wallclock"]
-            
-            jobs[job_id][task_id]["mem_kWh"] = calc_mem_kWh(GB_mem_time)
-            jobs[job_id][task_id]["mem_gCO2"] = calc_carbon_in_g(jobs[job_id][task_id]["mem_kWh"])
-            
-            #Finds the time a given CPU was in use depending on switch case, and extracts information from the CPU JSON file.
-            #Calculates the energy use and estimated carbon footprint of the CPU using the above functions.        
-            match CPU_CALC:
-                case "cputime":
-                    cpu_time = jobs[job_id][task_id]["cpu"]
-                case "requested":
-                    cpu_time = jobs[job_id][task_id]["NUM_CPU"] * jobs[job_id][task_id]["wallclock"]
-
-            cpu = cpu_info[node_info[jobs[job_id][task_id]["host"]]]
-            jobs[job_id][task_id]["cpu_kWh"] = calc_cpu_kWh(cpu, cpu_time)
-            jobs[job_id][task_id]["cpu_gCO2"] = calc_carbon_in_g(jobs[job_id][task_id]["cpu_kWh"])
+# Function to calculate energy use and estimated emissions for each record, in place. Returns the records.
+def calulate_results(records, cpu_info, node_info, config=None):
+    config = config or CarbonConfig()
+    for record in records:
             
-            #Calculates the total energy use and estimated emissions using values calculated above. Prints these values.
-            jobs[job_id][task_id]["kWh"] = jobs[job_id][task_id]["cpu_kWh"]+jobs[job_id][task_id]["mem_kWh"]
-            jobs[job_id][task_id]["gCO2"] = jobs[job_id][task_id]["cpu_gCO2"]+jobs[job_id][task_id]["mem_gCO2"]
-    return jobs    
+        #Finds the memory used and how long for depending on switch case..
+        #Calculates the energy use and estimated carbon footprint of the RAM time using the above functions.
+        match config.mem_calc:
+            case "integrated":
+                GB_mem_time = record.mem
+            case "ceiled":
+                GB_mem_time = math.ceil(record.max_vmem) * record.wallclock
+            case "requested":
+                GB_mem_time = record.RAM * record.wallclock
+        
+        record.mem_kWh = calc_mem_kWh(GB_mem_time, config.W_memory_per_GB)
+        record.mem_gCO2 = calc_carbon_in_g(record.mem_kWh, config.g_per_kWh)
+        
+        #Finds the time a given CPU was in use depending on switch case, and extracts information from the CPU JSON file.
+        #Calculates the energy use and estimated carbon footprint of the CPU using the above functions.        
+        match config.cpu_calc:
+            case "cputime":
+                cpu_time = record.cpu
+            case "requested":
+                cpu_time = record.NUM_CPU * record.wallclock
+
+        cpu = cpu_info[node_info[record.host]]
+        record.cpu_kWh = calc_cpu_kWh(cpu, cpu_time)
+        record.cpu_gCO2 = calc_carbon_in_g(record.cpu_kWh, config.g_per_kWh)
+        
+        #Calculates the total energy use and estimated emissions using values calculated above.
+        record.kWh = record.cpu_kWh+record.mem_kWh
+        record.gCO2 = record.cpu_gCO2+record.mem_gCO2
 
-            
+    return records
+
+#A function to group records by job and task ID, in the same form as the output JSON files: {job: {task: {...}}}.
+def records_to_jobs(records):
+    jobs = {}
+    for record in records:
+        jobs.setdefault(record.job_id, {})[record.task_id] = record.to_dict()
+    return jobs
+
+#A function to parse qacct output and calculate results in one call, without touching the filesystem.
+#Returns results in the same form as the output JSON files.
+def calc_carbon(lines, cpu_info, node_info, config=None):
+    return records_to_jobs(calulate_results(parse_sge_qacct(lines), cpu_info, node_info, config))
 
 #Iterate through the calculated results and print to std.out the results. We iterate over jobs and task IDs.
-def export_results(jobs):
+def export_results(jobs, config):
     for job_id in jobs.keys():
         
-        if PRINT_RESULT:
+        if config.print_result:
             print("\n\nJob ID: "+ job_id)
 
         #Iterates over each task that corresponds to a given job, prints the task RESULTS.
         for taskid in jobs[job_id].keys():
-            if PRINT_RESULT:
+            if config.print_result:
                 print("\t"+str(taskid)+": ")
                 print("\t\t kWh: {:4f}".format(jobs[job_id][taskid]["kWh"]))
                 print("\t\t gCO2: {:4f}".format(jobs[job_id][taskid]["gCO2"]))
             
         
         #Creates an output JSON file for this jobid and writes the calculated information into it.
-        if SAVE_TO_JSON:
-            with open( "{outdir}/calc_carbon_{job_id}.json".format(outdir=JSON_DIR,job_id=job_id),"w" ) as fout:
+        if config.save_to_json:
+            with open( "{outdir}/calc_carbon_{job_id}.json".format(outdir=config.json_dir,job_id=job_id),"w" ) as fout:
                 json.dump({job_id: jobs[job_id]},fout,indent=2)
 
-# Function to set global variables from command line arguments
-def set_args(args):
-    global W_memory_per_GB
-    global g_per_kWh
-    global SAVE_TO_JSON
-    global PRINT_RESULT
-    global MEM_CALC
-    global JSON_DIR
-    global NODE_FILE
-    global CPU_FILE
-    global CPU_CALC
-    
-    W_memory_per_GB=args.w_mem_per_GB
-    g_per_kWh=args.CI
-    SAVE_TO_JSON=args.save_to_json
-    PRINT_RESULT=args.print_result
-    MEM_CALC=args.memory_calc
-    JSON_DIR=args.json_dir
-    NODE_FILE=args.node_info
-    CPU_FILE=args.cpu_info
-    CPU_CALC=args.cpu_calc
-
 #verify if the various paths/directories exist, and if not raise exception
-def check_paths():
-    if not os.path.exists(JSON_DIR):
+def check_paths(config):
+    if not os.path.exists(config.json_dir):
         raise IOError("JSON Dir does not exist")
-    elif not os.path.exists(CPU_FILE):
-        raise IOError("CPU Info Json file does not exist",filename=CPU_FILE)
-    elif not os.path.exists(NODE_FILE):
-        raise IOError("Node Info Json file does not exist",filename=NODE_FILE)
+    elif not os.path.exists(config.cpu_file):
+        raise IOError("CPU Info Json file does not exist",filename=config.cpu_file)
+    elif not os.path.exists(config.node_file):
+        raise IOError("Node Info Json file does not exist",filename=config.node_file)
 
 #####################################################################################
 ####################### Main ########################################################
 #####################################################################################
 
+#The command line tool is a thin wrapper around the functions above: stdin is parsed and calculated in one call,
+#and the results are printed and written to JSON files.
 def main(args):
     
-    # First we set globals from cmdline arguments
-    set_args(args)
+    # First we build the config from cmdline arguments
+    config = CarbonConfig.from_args(args)
     
     # Check paths are correct
-    check_paths()
+    check_paths(config)
     
     #Load inputs
-    node_info,cpu_info = load_hpc_info()
+    node_info,cpu_info = load_hpc_info(config)
     input_stream = load_input_stream()
     
-    jobs = parse_sge_qacct(input_stream)
-    
-    jobs = calulate_results(jobs, cpu_info, node_info)
+    jobs = calc_carbon(input_stream, cpu_info, node_info, config)
     
-    export_results(jobs)
+    export_results(jobs, config)
     
     
     
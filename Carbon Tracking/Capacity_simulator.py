@@ -0,0 +1,198 @@
+#Imports relevant modules.
+import os
+import sys
+import csv
+import json
+import math
+import heapq
+import itertools
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from Calc_carbon import calc_cpu_kWh, calc_mem_kWh, calc_carbon_in_g
+
+#The shared container reader (see File_pack.py) is kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from File_pack import Pack
+
+#A what-if tool for choosing the concurrency cap ('-tc'), slots/threads ('-pe openmp' and '--nthreads') and nodes used
+#for a campaign. Scaling curves are fitted to the accounting records parsed by Calc_carbon.py, then the campaign (every
+#subject for every pipeline, submitted together) is simulated on the cluster for every combination of settings. The
+#settings on the Pareto front of makespan and energy are reported.
+
+#Defines the location of the directory containing JSON files for each HPC job, and the node and CPU information files.
+job_json_dir = '/<directory root>/Calc_Carbon/Job_JSONs' #Full path removed for purpose of public sharing.
+node_file = '/<directory root>/Calc_Carbon/node_info.json' #Full path removed for purpose of public sharing.
+cpu_file = '/<directory root>/Calc_Carbon/cpu_info.json' #Full path removed for purpose of public sharing.
+
+#The jobs run for each pipeline. Pipelines that only change the number of threads (P8 and P9) are pooled with the
+#pipeline they're based on when fitting, as they show how that pipeline scales with slots.
+pipeline_jobs = {'0': [], '1': [], '2': [], '3': [], '4': [], '5': [], '6': [], '7': [], '8': [], '9': []}
+pooled_with = {'8': '0', '9': '0'}
+
+#Defines the output directory for the fitted curves and the simulated settings.
+output_dir = '/<directory root>/Sustainability_Output/Capacity' #Full path removed for purpose of public sharing.
+
+#The campaign simulated: the number of subjects, and the pipelines run for each (pooled pipelines are left out, as
+#they're covered by the thread settings below).
+n_subjects = 257
+campaign_pipelines = ['0', '1', '2', '3', '4', '5', '6', '7']
+
+#The settings compared. Node mixes are lists of CPU models from cpu_info.json (an empty list uses every node), and
+#'available' is the share of each node's cores we can expect to get on a shared cluster.
+concurrencies = [10, 25, 50, 100, 257]
+slot_options = [1, 2, 4, 5, 8, 16]
+node_mixes = {'all': []}
+available = 0.5
+
+#The number of worker processes used to simulate settings.
+n_workers = 8
+
+#A function to load the accounting records for every pipeline: slots, wallclock (s), CPU time (s) and peak memory (GB).
+#Records for pooled pipelines are added to the pipeline they're pooled with.
+def load_records():
+	records = {}
+	with Pack(job_json_dir) as pack:
+		for pipeline, jobs in pipeline_jobs.items():
+			target = records.setdefault(pooled_with.get(pipeline, pipeline), [])
+			for job in jobs:
+				for task in json.load(pack.open('calc_carbon_{}.json'.format(job)))[job].values():
+					if task.get('wallclock') and task.get('NUM_CPU'):
+						target.append((task['NUM_CPU'], task['wallclock'], task['cpu'], task['max_vmem']))
+	return {pipeline: np.array(rows, dtype=float) for pipeline, rows in records.items() if rows}
+
+#A function to fit wallclock against slots with Amdahl's law, wallclock = a_p * (f + (1 - f) / slots). The serial
+#fraction f is shared by every pipeline (it can only be estimated from pipelines run with several slot counts), while
+#a_p is fitted for each pipeline. The fit is made on the log scale, by searching over f (a_p then has a closed form).
+#Returns f, a dictionary of a_p, and each record's residual (observed / fitted) for each pipeline.
+def fit_wallclock(records):
+	f = np.linspace(0, 1, 1001)[:, np.newaxis]
+	error = np.zeros(len(f))
+	for data in records.values():
+		residual = np.log(data[:, 1]) - np.log(f + (1 - f) / data[:, 0])
+		error += ((residual - residual.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+	best = f[np.argmin(error), 0]
+
+	scale, residuals = {}, {}
+	for pipeline, data in records.items():
+		log_residual = np.log(data[:, 1]) - np.log(best + (1 - best) / data[:, 0])
+		scale[pipeline] = math.exp(log_residual.mean())
+		residuals[pipeline] = np.exp(log_residual - log_residual.mean())
+	return best, scale, residuals
+
+#A function to fit a measure (CPU time or peak memory) linearly against slots, with a slope shared by every pipeline
+#and an intercept for each. Returns the slope and a dictionary of intercepts.
+def fit_linear(records, column):
+	centred_slots = np.concatenate([data[:, 0] - data[:, 0].mean() for data in records.values()])
+	centred_values = np.concatenate([data[:, column] - data[:, column].mean() for data in records.values()])
+	slope = (centred_slots * centred_values).sum() / (centred_slots ** 2).sum() if (centred_slots ** 2).sum() else 0
+	return slope, {pipeline: data[:, column].mean() - slope * data[:, 0].mean() for pipeline, data in records.items()}
+
+#A function to build the list of nodes for a mix, as (number of usable cores, CPU information) for each node.
+def build_nodes(node_info, cpu_info, models):
+	nodes = []
+	for host, model in sorted(node_info.items()):
+		if not models or model in models:
+			nodes.append((max(1, int(cpu_info[model]['CPU'] * available)), cpu_info[model]))
+	return nodes
+
+#A function to simulate the campaign for one combination of settings. Each pipeline is its own array job, capped at
+#'concurrency' running tasks. Whenever a task finishes (taken from a heap of finish events), each pipeline's queue
+#starts as many tasks as its cap and the free cores allow, placing each on the first node with enough free cores.
+#Returns the makespan (hours) and total energy (kWh) of the campaign.
+def simulate(model, nodes, concurrency, slots):
+	f, scale, residuals, cpu_slope, cpu_intercepts, mem_slope, mem_intercepts = model
+	free = np.array([cores for cores, _ in nodes])
+	if slots > free.max():
+		return None
+
+	#Each pipeline's tasks take the fitted wallclock and CPU time for this number of slots, multiplied by the residuals
+	#observed for that pipeline (repeated as needed), so that the spread of subjects' run times is kept.
+	queues = {pipeline: deque(np.resize(residuals[pipeline], n_subjects)) for pipeline in campaign_pipelines}
+	running = {pipeline: 0 for pipeline in campaign_pipelines}
+
+	events = []
+	now = 0.0
+	energy = 0.0
+	while True:
+		for pipeline, queue in queues.items():
+			while queue and running[pipeline] < concurrency:
+				node = int(np.argmax(free >= slots))
+				if free[node] < slots:
+					break
+				residual = queue.popleft()
+				wallclock = scale[pipeline] * (f + (1 - f) / slots) * residual
+				free[node] -= slots
+				running[pipeline] += 1
+				heapq.heappush(events, (now + wallclock, node, pipeline))
+
+				#Energy follows Calc_carbon.py: CPU time, and peak memory rounded up to the nearest GB over the run.
+				cpu_time = max(cpu_intercepts[pipeline] + cpu_slope * slots, 0) * residual
+				memory = max(mem_intercepts[pipeline] + mem_slope * slots, 0.1)
+				energy += calc_cpu_kWh(nodes[node][1], cpu_time) + calc_mem_kWh(math.ceil(memory) * wallclock)
+
+		if not events:
+			break
+		now, node, pipeline = heapq.heappop(events)
+		free[node] += slots
+		running[pipeline] -= 1
+	return now / 3600, energy
+
+#A function to simulate one setting, and return it as a row of the output.
+def run_setting(model, nodes, mix, concurrency, slots):
+	result = simulate(model, nodes, concurrency, slots)
+	if result is None:
+		return None
+	makespan, energy = result
+	return {'Node_mix': mix, 'Concurrency': concurrency, 'Slots': slots, 'Makespan_h': makespan, 'kWh': energy, 'gCO2': calc_carbon_in_g(energy)}
+
+#A function to flag the settings on the Pareto front: those for which no other setting is both faster and uses less
+#energy. Rows are sorted by makespan, and a row is on the front if it uses less energy than every faster row.
+def pareto_front(rows):
+	rows.sort(key=lambda row: (row['Makespan_h'], row['kWh']))
+	lowest = math.inf
+	for row in rows:
+		row['Pareto'] = row['kWh'] < lowest
+		lowest = min(lowest, row['kWh'])
+	return rows
+
+if __name__ == '__main__':
+
+	if not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+
+	with open(node_file, 'r') as f:
+		node_info = json.load(f)
+	with open(cpu_file, 'r') as f:
+		cpu_info = json.load(f)
+
+	#Fits the scaling curves, and writes the fitted values for each pipeline.
+	records = load_records()
+	f, scale, residuals = fit_wallclock(records)
+	cpu_slope, cpu_intercepts = fit_linear(records, 2)
+	mem_slope, mem_intercepts = fit_linear(records, 3)
+	model = (f, scale, residuals, cpu_slope, cpu_intercepts, mem_slope, mem_intercepts)
+
+	with open(os.path.join(output_dir, 'Scaling_fit.csv'), 'w', newline = '') as output:
+		writer = csv.writer(output)
+		writer.writerow(['Pipeline', 'Records', 'Serial_fraction', 'Wallclock_1_slot_h', 'CPU_s_intercept', 'CPU_s_per_slot', 'Memory_GB_intercept', 'Memory_GB_per_slot'])
+		for pipeline in records:
+			writer.writerow([pipeline, len(records[pipeline]), f, scale[pipeline] / 3600, cpu_intercepts[pipeline], cpu_slope, mem_intercepts[pipeline], mem_slope])
+	print("Fitted serial fraction of {:.3f} across {} pipeline(s).".format(f, len(records)))
+
+	#Simulates every setting across a pool of worker processes.
+	settings = [(model, build_nodes(node_info, cpu_info, models), mix, concurrency, slots)
+		for (mix, models), concurrency, slots in itertools.product(node_mixes.items(), concurrencies, slot_options)]
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		rows = [row for row in executor.map(run_setting, *zip(*settings)) if row is not None]
+
+	#Writes every setting with its Pareto flag, and prints the front.
+	rows = pareto_front(rows)
+	with open(os.path.join(output_dir, 'Capacity_settings.csv'), 'w', newline = '') as output:
+		writer = csv.DictWriter(output, fieldnames = list(rows[0].keys()))
+		writer.writeheader()
+		writer.writerows(rows)
+
+	for row in rows:
+		if row['Pareto']:
+			print("{} nodes, -tc {}, {} slot(s): {:.1f}h, {:.1f} kWh.".format(row['Node_mix'], row['Concurrency'], row['Slots'], row['Makespan_h'], row['kWh']))
@@ -1,7 +1,14 @@
 #Imports relevant modules.
 import os
 import csv
+import sys
 import json
+from Calc_carbon import calc_carbon
+
+#The shared tracing functions and container reader (see File_pack.py) are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tracing import span
+from File_pack import Pack
 
 #Defines the pipeline of interest.
 pipeline = '0'
@@ -12,6 +19,13 @@ pipeline_dir = '/<directory root>/fMRIPrep/Pipeline_{}'.format(pipeline) #Full p
 #Defines the location of the directory containing JSON files for each HPC job.
 job_json_dir = '/<directory root>/Calc_Carbon/Job_JSONs' #Full path removed for purpose of public sharing.
 
+#Alternatively, a saved qacct output file for this pipeline's jobs (e.g. from 'qacct -j <job> > file'). If given, results
+#are calculated in this script using the Calc_carbon functions, rather than read from JSON files, along with the node and
+#CPU information files they need.
+qacct_file = None
+node_file = '/<directory root>/Calc_Carbon/node_info.json' #Full path removed for purpose of public sharing.
+cpu_file = '/<directory root>/Calc_Carbon/cpu_info.json' #Full path removed for purpose of public sharing.
+
 #Defines the fieldnames to be used in the output file.
 fieldnames = ['Subject', 'Log', 'Node', 'Num_CPU', 'RAM', 'Wallclock', 'CPU', 'CPU_kWh', 'CPU_gCO2', 'Memory', 'Memory_kWh', 'Memory_gCO2', 'kWh', 'gCO2', 'kWh_req', 'gCO2_req', 'kgCO2']
 
@@ -21,85 +35,110 @@ log_dir = os.path.join(pipeline_dir, 'logs')
 #Defines the name of the output file to be created.
 output_file = '/<directory root>/Sustainability_Output/Calc_Carbon/Pipeline_{}_carbon_HPC.csv'.format(pipeline) #Full path removed for purpose of public sharing.
 
+#If a qacct output file is given, results for every job in it are calculated once, in this process. Task IDs are
+#converted to strings, to match those in the JSON files.
+calculated = {}
+if qacct_file is not None:
+	with open(node_file, 'r') as f:
+		node_info = json.load(f)
+	with open(cpu_file, 'r') as f:
+		cpu_info = json.load(f)
+	with span('calc_carbon', pipeline=pipeline), open(qacct_file, 'r') as f:
+		calculated = {job: {str(task): task_dict for task, task_dict in tasks.items()} for job, tasks in calc_carbon(f, cpu_info, node_info).items()}
+
+#The job JSON files and this pipeline's logs are read from the containers of small files in their folders, if they've
+#been packed (see File_pack.py), or from the original files if not.
+json_pack = Pack(job_json_dir)
+log_pack = Pack(pipeline_dir)
+
+#A function to find the results for a given job, from the calculated results or the job's JSON file. Each JSON file is
+#only loaded once. Returns None if there are no results for this job.
+json_results = {}
+def load_job(job):
+	if qacct_file is not None:
+		return calculated.get(job)
+	if job not in json_results:
+		job_json = 'calc_carbon_{}.json'.format(job)
+		json_results[job] = None
+		if job_json in json_pack or os.path.exists(os.path.join(job_json_dir, job_json)):
+			with span('read_job_json'):
+				json_results[job] = json.load(json_pack.open(job_json))[job]
+	return json_results[job]
+
 #This output file is opened to be written into, and headers are written.
 with open(output_file, 'w', newline = '') as csv_file:
 	writer = csv.DictWriter(csv_file, fieldnames = fieldnames)
 	writer.writeheader()
 
-	#Iterates over each log in the log directory.
-	for log in os.listdir(log_dir):
-
-		#Defines a job and task IDs by splitting the log file name and pulling out relevant aspects.
-		job = str(log.split('.')[-2][1:])
-		task = str(log.split('.')[-1])
+	#Iterates over each log in the log directory, along with any that have been packed and removed.
+	logs = set(os.listdir(log_dir)) | {os.path.basename(name) for name in log_pack.names(os.path.join('logs', '*'))}
+	for log in sorted(logs):
+		with span('log', pipeline=pipeline, log=log):
 
-		#Opens the fMRIPrep log file, and pulls out the subject ID as a variable.
-		with open(os.path.join(log_dir, log), 'r') as log_file:
-			for line in log_file:
-				if 'sub-' in line:
-					subject = line.strip()
-					break
+			#Defines a job and task IDs by splitting the log file name and pulling out relevant aspects.
+			job = str(log.split('.')[-2][1:])
+			task = str(log.split('.')[-1])
 
-		#Points to the specific json for the job relating to this log file. Skips if this file doesn't exist.
-		job_json = os.path.join(job_json_dir, 'calc_carbon_{}.json'.format(job))
+			#Opens the fMRIPrep log file, and pulls out the subject ID as a variable.
+			with log_pack.open(os.path.join('logs', log)) as log_file:
+				for line in log_file:
+					if 'sub-' in line:
+						subject = line.strip()
+						break
 
-		if not os.path.exists(job_json):
-			continue
+			#Finds the results for the job relating to this log file. Skips if there are no results for this job.
+			job_results = load_job(job)
 
-		#At default, logs that a dictionary has not been found for this specific task.
-		dict_found = False
+			if job_results is None:
+				continue
 
-		#Opens the job-specific JSON file and loads the data.
-		with open(job_json) as json_file:
-			data = json.load(json_file)
-
-			#Checks whether the task ID for this log file can be found in the relevant job file. If so, the dictionary for
-			#this task is pulled out and the above variable is updated to 'True'. If not, a warning is printed.
-			if task not in data[job].keys():
+			#Checks whether the task ID for this log file can be found in the results for this job. If so, the dictionary for
+			#this task is pulled out and dict_found is set to 'True'. If not, a warning is printed.
+			dict_found = task in job_results
+			if not dict_found:
 				print("Not found for {}.{}, {}".format(job, task, pipeline))
 			else:
-				task_dict = data[job][task]
-				dict_found = True
+				task_dict = job_results[task]
 
-		#If a dictionary was found for this log file, relevant data is written into the output file. If not, N/A values are written in.
-		if dict_found == True:
+			#If a dictionary was found for this log file, relevant data is written into the output file. If not, N/A values are written in.
+			if dict_found == True:
 					
-			subject_row = {'Subject': subject,
-			'Log': log,
-			'Node': task_dict['host'],
-			'Num_CPU': task_dict['NUM_CPU'],
-			'RAM': task_dict['RAM'],
-			'Wallclock': task_dict['wallclock'],
-			'CPU': task_dict['cpu'],
-			'CPU_kWh': task_dict['cpu_kWh'],
-			'CPU_gCO2': task_dict['cpu_gCO2'],
-			'Memory': task_dict['mem'],
-			'Memory_kWh': task_dict['mem_kWh'],
-			'Memory_gCO2': task_dict['mem_gCO2'],
-			'kWh': task_dict['kWh'],
-			'gCO2': task_dict['gCO2'],
-			'kWh_req': task_dict['kWh_req'],
-			'gCO2_req': task_dict['gCO2_req'],
-			'kgCO2': float(task_dict['gCO2'])*0.001}
-			writer.writerow(subject_row)
-
-		else:
-
-			subject_row = {'Subject': subject,
-			'Log': log,
-			'Node': 'N/A',
-			'Num_CPU': 'N/A',
-			'RAM': 'N/A',
-			'Wallclock': 'N/A',
-			'CPU': 'N/A',
-			'CPU_kWh': 'N/A',
-			'CPU_gCO2': 'N/A',
-			'Memory': 'N/A',
-			'Memory_kWh': 'N/A',
-			'Memory_gCO2': 'N/A',
-			'kWh': 'N/A',
-			'gCO2': 'N/A',
-			'kWh_req': 'N/A',
-			'gCO2_req': 'N/A',
-			'kgCO2': 'N/A'}
-			writer.writerow(subject_row)
+				subject_row = {'Subject': subject,
+				'Log': log,
+				'Node': task_dict['host'],
+				'Num_CPU': task_dict['NUM_CPU'],
+				'RAM': task_dict['RAM'],
+				'Wallclock': task_dict['wallclock'],
+				'CPU': task_dict['cpu'],
+				'CPU_kWh': task_dict['cpu_kWh'],
+				'CPU_gCO2': task_dict['cpu_gCO2'],
+				'Memory': task_dict['mem'],
+				'Memory_kWh': task_dict['mem_kWh'],
+				'Memory_gCO2': task_dict['mem_gCO2'],
+				'kWh': task_dict['kWh'],
+				'gCO2': task_dict['gCO2'],
+				'kWh_req': task_dict.get('kWh_req', 'N/A'),
+				'gCO2_req': task_dict.get('gCO2_req', 'N/A'),
+				'kgCO2': float(task_dict['gCO2'])*0.001}
+				writer.writerow(subject_row)
+
+			else:
+
+				subject_row = {'Subject': subject,
+				'Log': log,
+				'Node': 'N/A',
+				'Num_CPU': 'N/A',
+				'RAM': 'N/A',
+				'Wallclock': 'N/A',
+				'CPU': 'N/A',
+				'CPU_kWh': 'N/A',
+				'CPU_gCO2': 'N/A',
+				'Memory': 'N/A',
+				'Memory_kWh': 'N/A',
+				'Memory_gCO2': 'N/A',
+				'kWh': 'N/A',
+				'gCO2': 'N/A',
+				'kWh_req': 'N/A',
+				'gCO2_req': 'N/A',
+				'kgCO2': 'N/A'}
+				writer.writerow(subject_row)
@@ -0,0 +1,152 @@
+#Imports relevant modules.
+import os
+import sys
+import csv
+import json
+
+#The shared container reader (see File_pack.py) is kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from File_pack import Pack
+
+#Defines the pipelines of interest.
+pipelines = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+
+#Defines the directory containing each pipeline's folder (logs, derivatives, etc.).
+fmriprep_dir = '/<directory root>/fMRIPrep' #Full path removed for purpose of public sharing.
+
+#Defines the location of the directory containing JSON files for each HPC job.
+job_json_dir = '/<directory root>/Calc_Carbon/Job_JSONs' #Full path removed for purpose of public sharing.
+
+#Defines the output directory for the per-subject and per-pipeline comparisons.
+output_dir = '/<directory root>/Sustainability_Output/CodeCarbon' #Full path removed for purpose of public sharing.
+
+#Subjects are flagged where energy or duration from the two sources differ by more than this proportion.
+tolerance = 0.25
+
+#Folders that are never searched, as they hold a very large number of files that aren't needed here.
+skipped_dirs = {'scratch', 'sourcedata', 'figures', 'anat', 'func', 'fmap'}
+
+#A function to walk a pipeline's folder once, collecting both its fMRIPrep log files (from the 'logs' folder, along with
+#any that have been packed and removed, see File_pack.py) and the emissions files written by CodeCarbon for each subject
+#(derivatives/sub-*/log/<run>/emissions.csv). Log files are given as paths relative to the pipeline's folder.
+def scan_pipeline(pipeline_dir, log_pack):
+	logs = set(log_pack.names(os.path.join('logs', '*')))
+	emissions = []
+	for directory, dirnames, filenames in os.walk(pipeline_dir):
+		dirnames[:] = [name for name in dirnames if name not in skipped_dirs]
+		if os.path.basename(directory) == 'logs':
+			logs.update(os.path.relpath(os.path.join(directory, filename), pipeline_dir) for filename in filenames)
+		elif 'emissions.csv' in filenames:
+			subject = next((part for part in directory.split(os.sep) if part.startswith('sub-')), None)
+			if subject is not None:
+				emissions.append((subject, os.path.join(directory, 'emissions.csv')))
+	return sorted(logs), emissions
+
+#A function to read the CodeCarbon record for each subject. If a subject was run more than once, the latest run is used.
+#Returns a dictionary of subject IDs to records with duration (seconds), energy (kWh), and emissions (g).
+def read_codecarbon(emissions):
+	records = {}
+	for subject, path in emissions:
+		with open(path, newline = '') as f:
+			for row in csv.DictReader(f):
+				if subject in records and records[subject]['timestamp'] > row['timestamp']:
+					continue
+				records[subject] = {'timestamp': row['timestamp'],
+					'duration': float(row['duration']),
+					'kWh': float(row['energy_consumed']),
+					'gCO2': float(row['emissions']) * 1000}
+	return records
+
+#A function to read the accounting-based estimate (from Calc_carbon.py) for each subject, using the same link between
+#log files and job/task IDs as Carbon_extract.py. Log files and job JSON files are read from their containers if
+#they've been packed, or from the original files if not. Each job's JSON file is only loaded once.
+def read_accounting(logs, log_pack, json_pack):
+	jobs = {}
+	records = {}
+	for log in logs:
+
+		#Defines a job and task IDs by splitting the log file name and pulling out relevant aspects.
+		name = os.path.basename(log)
+		job = name.split('.')[-2][1:]
+		task = name.split('.')[-1]
+
+		#Opens the fMRIPrep log file, and pulls out the subject ID.
+		with log_pack.open(log) as log_file:
+			subject = next((line.strip() for line in log_file if 'sub-' in line), None)
+
+		#Loads the JSON file for this job, if it exists and hasn't been loaded yet.
+		if job not in jobs:
+			job_json = 'calc_carbon_{}.json'.format(job)
+			jobs[job] = {}
+			if job_json in json_pack or os.path.exists(os.path.join(job_json_dir, job_json)):
+				jobs[job] = json.load(json_pack.open(job_json))[job]
+
+		if subject is None or task not in jobs[job]:
+			continue
+		task_dict = jobs[job][task]
+		records[subject] = {'duration': float(task_dict['wallclock']), 'kWh': float(task_dict['kWh']), 'gCO2': float(task_dict['gCO2'])}
+	return records
+
+#A function to calculate the relative difference of CodeCarbon from the accounting estimate.
+def relative_difference(codecarbon, accounting):
+	return (codecarbon - accounting) / accounting if accounting else float('nan')
+
+#A function to join both sources for one pipeline by subject, returning a row for each subject found in either.
+def reconcile(pipeline, json_pack):
+	pipeline_dir = os.path.join(fmriprep_dir, 'Pipeline_{}'.format(pipeline))
+	with Pack(pipeline_dir) as log_pack:
+		logs, emissions = scan_pipeline(pipeline_dir, log_pack)
+		accounting = read_accounting(logs, log_pack, json_pack)
+	codecarbon = read_codecarbon(emissions)
+
+	rows = []
+	for subject in sorted(set(codecarbon) | set(accounting)):
+		row = {'Pipeline': pipeline, 'Subject': subject}
+		for source, records in [('CodeCarbon', codecarbon), ('Accounting', accounting)]:
+			for measure in ['duration', 'kWh', 'gCO2']:
+				row['{}_{}'.format(source, measure)] = records[subject][measure] if subject in records else ''
+
+		if subject in codecarbon and subject in accounting:
+			row['kWh_rel_diff'] = relative_difference(codecarbon[subject]['kWh'], accounting[subject]['kWh'])
+			row['duration_rel_diff'] = relative_difference(codecarbon[subject]['duration'], accounting[subject]['duration'])
+			row['Flagged'] = not (abs(row['kWh_rel_diff']) <= tolerance and abs(row['duration_rel_diff']) <= tolerance)
+		else:
+			row.update({'kWh_rel_diff': '', 'duration_rel_diff': '', 'Flagged': True})
+		rows.append(row)
+	return rows
+
+#A function to summarise the comparison for one pipeline, using subjects found in both sources.
+def summarise_pipeline(pipeline, rows):
+	matched = [row for row in rows if row['kWh_rel_diff'] != '']
+	summary = {'Pipeline': pipeline, 'Subjects': len(rows), 'Matched': len(matched), 'Flagged': sum(row['Flagged'] for row in rows)}
+	for source in ['CodeCarbon', 'Accounting']:
+		for measure in ['duration', 'kWh', 'gCO2']:
+			summary['{}_{}_total'.format(source, measure)] = sum(row['{}_{}'.format(source, measure)] for row in matched)
+	for measure in ['kWh', 'duration']:
+		summary['{}_rel_diff'.format(measure)] = relative_difference(summary['CodeCarbon_{}_total'.format(measure)], summary['Accounting_{}_total'.format(measure)])
+	return summary
+
+if __name__ == '__main__':
+
+	if not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+
+	#Reconciles every pipeline, and writes one file with a row per subject and one with a row per pipeline.
+	subject_rows = []
+	pipeline_rows = []
+	json_pack = Pack(job_json_dir)
+	for pipeline in pipelines:
+		rows = reconcile(pipeline, json_pack)
+		subject_rows.extend(rows)
+		pipeline_rows.append(summarise_pipeline(pipeline, rows))
+		print("Finished pipeline {}, {} subject(s) flagged.".format(pipeline, pipeline_rows[-1]['Flagged']))
+
+	with open(os.path.join(output_dir, 'CodeCarbon_vs_accounting_subjects.csv'), 'w', newline = '') as output:
+		writer = csv.DictWriter(output, fieldnames = list(subject_rows[0].keys()))
+		writer.writeheader()
+		writer.writerows(subject_rows)
+
+	with open(os.path.join(output_dir, 'CodeCarbon_vs_accounting_pipelines.csv'), 'w', newline = '') as output:
+		writer = csv.DictWriter(output, fieldnames = list(pipeline_rows[0].keys()))
+		writer.writeheader()
+		writer.writerows(pipeline_rows)
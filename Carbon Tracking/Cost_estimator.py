@@ -0,0 +1,359 @@
+#Imports relevant modules.
+import os
+import re
+import csv
+import sys
+import json
+import math
+import itertools
+import numpy as np
+import nibabel as nb
+from statistics import NormalDist
+from concurrent.futures import ThreadPoolExecutor
+
+#The shared BIDS index is kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from BIDS_index import load_index
+
+#Estimates the runtime, energy and emissions of a planned fMRIPrep campaign before it's submitted. A linear model is
+#fitted to the per-task records written by Carbon_extract.py for every pipeline run so far, predicting the log of each
+#task's wallclock time, energy (kWh) and emissions (gCO2) from the flags in its pipeline script, the size of the
+#subject's scans (read from the NIFTI headers in the BIDS folder) and the CPU model of the node it ran on. Candidate
+#configurations (a pipeline's flags with any combination of optional flags and thread counts, and any planned scripts)
+#are then scored for every subject, with prediction intervals for each subject and for the campaign's totals. All
+#candidates are scored at once with array operations, so hundreds of them take well under a second.
+
+#Defines the pipelines whose records are used for fitting, the CSV files written for them by Carbon_extract.py, and
+#the scripts their flags are read from.
+pipelines = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+carbon_file = '/<directory root>/Sustainability_Output/Calc_Carbon/Pipeline_{}_carbon_HPC.csv' #Full path removed for purpose of public sharing.
+script_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fMRIPrep_scripts', 'Pipeline_{}.sh')
+
+#Defines the BIDS input folder (scan sizes are read from every subject in it), the task of the functional run, and the
+#node information file giving the CPU model of each node.
+bids_dir = '/<directory root>/CNP_BIDS' #Full path removed for purpose of public sharing.
+task = 'stopsignal'
+node_file = '/<directory root>/Calc_Carbon/node_info.json' #Full path removed for purpose of public sharing.
+
+#Defines the output directory for the fitted model and the scored candidates.
+output_dir = '/<directory root>/Sustainability_Output/Cost_Estimator' #Full path removed for purpose of public sharing.
+
+#The candidates scored. Every pipeline script is scored as it is, along with any planned scripts given as name: path.
+#The pipeline given as 'candidate_base' is then scored with every combination of the optional flags and thread counts
+#(each option replaces the base's value for that flag). 'node_mix' lists the CPU models candidates run on (an empty
+#list assumes the same mix of nodes as the records).
+candidate_scripts = {}
+candidate_base = '0'
+optional_flags = ['--fs-no-reconall', '--sloppy', '--low-mem', '--use-aroma', '--use-syn-sdc error', '--output-spaces MNI152NLin6Asym:res-2 fsaverage']
+thread_options = [1, 2, 4, 5, 8, 16]
+node_mix = []
+
+#Combinations that fMRIPrep won't run, each given as a flag or a flag and value (without any ':' modifiers) that can't
+#be used together. Surface output spaces and CIFTI output need FreeSurfer's surface reconstruction. Optional flag
+#combinations including any of these are left out of the candidates.
+invalid_combinations = [('--fs-no-reconall', '--output-spaces fsaverage'), ('--fs-no-reconall', '--output-spaces fsnative'),
+	('--fs-no-reconall', '--cifti-output')]
+
+#Flags that don't describe the configuration (they differ by subject or by folder) are ignored. Flags with a number
+#are used as the log (base 2) of that number, so that doubling the threads has the same effect at any count.
+ignored_flags = {'--participant-label', '--fs-license-file', '--work-dir'}
+numeric_flags = {'--nthreads', '--omp-nthreads', '--mem_mb'}
+
+#The size of the ridge penalty (relative to the number of records), the coverage of the prediction intervals, and the
+#number of folds used to check the intervals (subjects are split into folds at random, with a fixed seed).
+ridge = 1e-3
+coverage = 0.95
+n_folds = 5
+seed = 1234
+
+#The number of threads used to read NIFTI headers.
+n_threads = 16
+
+#The measures predicted, as (output name, column in the Carbon_extract.py files, scale applied to the column).
+targets = [('Wallclock_h', 'Wallclock', 1 / 3600), ('kWh', 'kWh', 1), ('gCO2', 'gCO2', 1)]
+
+#A function to split a command line into its flags, as a dictionary of flag: tuple of values. A flag is followed by
+#any values up to the next flag.
+def parse_flags(tokens):
+	flags = {}
+	flag = None
+	for token in tokens:
+		if token.startswith('-'):
+			flag = token
+			flags[flag] = ()
+		elif flag is not None:
+			flags[flag] += (token,)
+	return flags
+
+#A function to read the fMRIPrep flags from a pipeline script. The 'singularity run' command is joined across its
+#continuation lines (with the comments after each '\' removed), and the flags between the container image and the
+#positional arguments at the end ('/data /out/ participant') are kept.
+def script_flags(path):
+	with open(path) as f:
+		lines = f.read().splitlines()
+	start = next(number for number, line in enumerate(lines) if line.strip().startswith('singularity run'))
+	tokens = []
+	for line in lines[start:]:
+		line = line.split('#')[0].rstrip()
+		tokens += line.rstrip('\\').split()
+		if not line.endswith('\\'):
+			break
+	image = next(number for number, token in enumerate(tokens) if token.endswith(('.simg', '.sif')))
+	tokens = tokens[image + 1:]
+	if tokens and tokens[-1] == 'participant':
+		tokens = tokens[:-3]
+	return parse_flags(tokens)
+
+#A function to check whether a set of flags can be run, i.e. doesn't include any of the invalid combinations.
+def valid_flags(flags):
+	given = set(flags) | {'{} {}'.format(flag, value.split(':')[0]) for flag, values in flags.items() for value in values}
+	return not any(set(combination) <= given for combination in invalid_combinations)
+
+#A function to turn a set of flags into features: each numeric flag as the log of its value, each flag without a value
+#as 1, and each value of a flag with values (e.g. '--output-spaces fsaverage') as 1.
+def flag_features(flags):
+	features = {}
+	for flag, values in flags.items():
+		if flag in ignored_flags:
+			continue
+		if flag in numeric_flags:
+			features[flag] = math.log2(float(values[0]))
+		elif not values:
+			features[flag] = 1.0
+		else:
+			for value in values:
+				features['{} {}'.format(flag, value)] = 1.0
+	return features
+
+#A function to read the size of one subject's scans from the NIFTI headers (the images themselves aren't read): the
+#number of volumes and voxels per volume in the functional run, and the number of voxels in the T1w image, each as a
+#log. Values for scans that can't be found are NaN.
+def subject_features(index, subject):
+	bold = index.query(sub=subject, datatype='func', task=task, suffix='bold', extension=['.nii', '.nii.gz'])
+	t1w = index.query(sub=subject, datatype='anat', suffix='T1w', extension=['.nii', '.nii.gz'])
+	features = [math.nan] * 3
+	if bold:
+		shape = nb.load(bold[0]['path']).header.get_data_shape()
+		features[0] = math.log(shape[3] if len(shape) > 3 else 1)
+		features[1] = math.log(np.prod(shape[:3]))
+	if t1w:
+		features[2] = math.log(np.prod(nb.load(t1w[0]['path']).header.get_data_shape()[:3]))
+	return features
+subject_feature_names = ['log(volumes)', 'log(BOLD voxels)', 'log(T1w voxels)']
+
+#A function to load the records for every pipeline, skipping tasks without results. Returns the pipeline, subject,
+#CPU model and measures of each record, with the measures as an array (records x targets).
+def load_records(node_info):
+	record_pipelines, subjects, models, values = [], [], [], []
+	for pipeline in pipelines:
+		path = carbon_file.format(pipeline)
+		if not os.path.exists(path):
+			print("No records found for pipeline {}, at {}.".format(pipeline, path))
+			continue
+		with open(path, newline='') as f:
+			for row in csv.DictReader(f):
+				if 'N/A' in [row[column] for _, column, _ in targets] or min(float(row[column]) for _, column, _ in targets) <= 0:
+					continue
+				subject = re.search(r'sub-[A-Za-z0-9]+', row['Subject'])
+				record_pipelines.append(pipeline)
+				subjects.append(subject.group(0) if subject else row['Subject'].strip())
+				models.append(node_info.get(row['Node'], node_info.get(row['Node'].split('.')[0], 'unknown')))
+				values.append([float(row[column]) * scale for _, column, scale in targets])
+	return record_pipelines, subjects, models, np.array(values)
+
+#A class holding the fitted model. Features are standardised with the mean and SD of the records, and the logs of
+#every measure are fitted together with one ridge regression (the intercept isn't penalised).
+class CostModel:
+
+	def __init__(self, X, Y):
+		self.mean = X.mean(axis=0)
+		self.sd = X.std(axis=0)
+		Z = self.design(X)
+		penalty = ridge * len(Z) * np.eye(Z.shape[1])
+		penalty[0, 0] = 0
+		self.inverse = np.linalg.inv(Z.T @ Z + penalty)
+		self.coefficients = self.inverse @ Z.T @ np.log(Y)
+
+		#The SD of the residuals of each measure, with the degrees of freedom taken by the coefficients.
+		residuals = np.log(Y) - Z @ self.coefficients
+		self.residual_sd = np.sqrt((residuals ** 2).sum(axis=0) / max(len(Z) - Z.shape[1], 1))
+
+	#A function to standardise features and add the intercept, for any number of leading dimensions.
+	def design(self, X):
+		Z = (X - self.mean) / np.where(self.sd > 0, self.sd, 1)
+		return np.concatenate([np.ones(Z.shape[:-1] + (1,)), Z], axis=-1)
+
+	#A function to predict the log of every measure for each row of features (any number of leading dimensions), with
+	#the SD of a new observation: the residual SD, widened by the uncertainty in the coefficients at those features.
+	#Returns the predictions and SDs, each with a last dimension of measures, and the leverage of each row.
+	def predict(self, X):
+		Z = self.design(X)
+		leverage = np.einsum('...i,ij,...j->...', Z, self.inverse, Z)
+		return Z @ self.coefficients, self.residual_sd * np.sqrt(1 + leverage)[..., np.newaxis], leverage
+
+	#A function to predict the total of each measure over subjects for each candidate. X has dimensions (candidates x
+	#subjects x features). The expected total is the sum of each subject's expected (log-normal) value, and the total is
+	#treated as log-normal, with a variance on the log scale from two sources: the subjects' residuals (which mostly
+	#cancel out over many subjects), and the uncertainty in the coefficients (which doesn't, as it's shared by every
+	#subject). The second is found from the gradient of the log of the total with respect to the coefficients, which is
+	#the mean of the subjects' features weighted by their expected values. Returns the expected totals and their variance
+	#on the log scale (each candidates x measures).
+	def predict_totals(self, X):
+		Z = self.design(X)
+		variance = self.residual_sd ** 2
+		expected = np.exp(Z @ self.coefficients + variance / 2)
+		total = expected.sum(axis=1)
+		residual_variance = (expected ** 2 * (np.exp(variance) - 1)).sum(axis=1)
+		gradient = np.einsum('cst,csf->ctf', expected, Z) / total[..., np.newaxis]
+		coefficient_variance = np.einsum('ctf,fg,ctg->ct', gradient, self.inverse, gradient) * variance
+		return total, np.log1p(residual_variance / total ** 2) + coefficient_variance
+
+#A function to check the prediction intervals by cross-validation: the model is fitted without each fold of subjects,
+#and used to predict that fold's records. Returns the share of held-out records inside their interval, and the median
+#ratio between predicted (median) and observed values, for each measure.
+def cross_validate(X, Y, subjects, z):
+	unique = sorted(set(subjects))
+	fold_of = dict(zip(unique, np.random.default_rng(seed).permutation(len(unique)) % n_folds))
+	folds = np.array([fold_of[subject] for subject in subjects])
+	inside = np.zeros(Y.shape, dtype=bool)
+	ratio = np.zeros(Y.shape)
+	for fold in range(n_folds):
+		test = folds == fold
+		if not test.any() or test.all():
+			continue
+		predicted, sd, _ = CostModel(X[~test], Y[~test]).predict(X[test])
+		error = np.log(Y[test]) - predicted
+		inside[test] = np.abs(error) <= z * sd
+		ratio[test] = np.exp(np.abs(error))
+	return inside.mean(axis=0), np.median(ratio, axis=0)
+
+if __name__ == '__main__':
+
+	if not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+
+	with open(node_file, 'r') as f:
+		node_info = json.load(f)
+	z = NormalDist().inv_cdf((1 + coverage) / 2)
+
+	#Reads the flags of each pipeline, and the scan sizes of every subject in the BIDS folder.
+	pipeline_flags = {pipeline: script_flags(script_file.format(pipeline)) for pipeline in pipelines}
+	index = load_index(bids_dir)
+	all_subjects = index.subjects()
+	with ThreadPoolExecutor(max_workers=n_threads) as executor:
+		scans = dict(zip(all_subjects, executor.map(lambda subject: subject_features(index, subject), all_subjects)))
+
+	#Builds the features of each record, from its pipeline's flags, its subject's scans and its node's CPU model.
+	#Features that don't vary across the records can't be fitted, so are left out. Scans that couldn't be read are
+	#given the mean of the other records.
+	record_pipelines, subjects, models, Y = load_records(node_info)
+	if not len(Y):
+		raise ValueError("No records with results were found in {}".format(carbon_file))
+	flag_names = sorted({name for pipeline in set(record_pipelines) for name in flag_features(pipeline_flags[pipeline])})
+	model_names = sorted(set(models))
+	def flag_matrix(flags):
+		features = flag_features(flags)
+		return [features.get(name, 0.0) for name in flag_names]
+	record_scans = np.array([scans.get(subject, [math.nan] * 3) for subject in subjects])
+	scan_means = np.nanmean(np.where(np.isnan(record_scans).all(axis=0), 0, record_scans), axis=0)
+	record_scans = np.where(np.isnan(record_scans), scan_means, record_scans)
+	X = np.concatenate([np.array([flag_matrix(pipeline_flags[pipeline]) for pipeline in record_pipelines]).reshape(len(Y), -1), record_scans,
+		np.array([[float(model == name) for name in model_names] for model in models]).reshape(len(Y), -1)], axis=1)
+	names = flag_names + subject_feature_names + ['node {}'.format(name) for name in model_names]
+	varying = np.ptp(X, axis=0) > 0
+	X, names = X[:, varying], [name for name, keep in zip(names, varying) if keep]
+
+	#Fits the model, and writes its coefficients (on the standardised scale), residual SDs and cross-validated checks.
+	model = CostModel(X, Y)
+	inside, ratio = cross_validate(X, Y, subjects, z)
+	with open(os.path.join(output_dir, 'Estimator_fit.csv'), 'w', newline = '') as output:
+		writer = csv.writer(output)
+		writer.writerow(['Feature', 'Mean', 'SD'] + ['{}_log_coefficient'.format(name) for name, _, _ in targets])
+		writer.writerow(['Intercept', '', ''] + list(model.coefficients[0]))
+		for number, name in enumerate(names):
+			writer.writerow([name, model.mean[number], model.sd[number]] + list(model.coefficients[number + 1]))
+		writer.writerow(['Residual_SD', '', ''] + list(model.residual_sd))
+		writer.writerow(['CV_interval_coverage', '', ''] + list(inside))
+		writer.writerow(['CV_median_error_ratio', '', ''] + list(ratio))
+	print("Fitted {} records from {} pipeline(s) with {} features.".format(len(Y), len(set(record_pipelines)), len(names)))
+	for (name, _, _), share, error in zip(targets, inside, ratio):
+		print("{}: {:.0%} of held-out records inside their {:.0%} interval, median error x{:.2f}.".format(name, share, coverage, error))
+
+	#Builds the candidates: every pipeline script, the planned scripts, and every combination of the optional flags and
+	#thread counts on the base pipeline that fMRIPrep can run.
+	candidates = {'Pipeline_{}'.format(pipeline): flags for pipeline, flags in pipeline_flags.items()}
+	candidates.update({name: script_flags(path) for name, path in candidate_scripts.items()})
+	detailed = list(candidates)
+	skipped = 0
+	for threads in thread_options:
+		for count in range(len(optional_flags) + 1):
+			for options in itertools.combinations(optional_flags, count):
+				flags = dict(pipeline_flags[candidate_base])
+				for option in options:
+					flags.update(parse_flags(option.split()))
+				flags['--nthreads'] = (str(threads),)
+				if not valid_flags(flags):
+					skipped += 1
+					continue
+				candidates['P{}_{}threads{}'.format(candidate_base, threads, ''.join('_' + option.split()[0].strip('-') for option in options))] = flags
+
+	if skipped:
+		print("Left out {} combination(s) of optional flags that fMRIPrep can't run (see 'invalid_combinations').".format(skipped))
+
+	#Features of the candidates that weren't seen in the records can't be predicted, so are reported and ignored.
+	unseen = sorted({name for flags in candidates.values() for name in flag_features(flags) if name not in flag_names})
+	if unseen:
+		print("Ignoring features not seen in the records: {}".format(', '.join(unseen)))
+
+	#Builds the features of every candidate for every subject in the BIDS folder (candidates x subjects x features),
+	#with the node features set to the share of each CPU model in the chosen mix.
+	mix = node_mix or models
+	node_shares = [mix.count(name) / len(mix) for name in model_names]
+	subject_scans = np.array([scans[subject] for subject in all_subjects]).reshape(len(all_subjects), 3)
+	subject_scans = np.where(np.isnan(subject_scans), scan_means, subject_scans)
+	flag_rows = np.array([flag_matrix(flags) for flags in candidates.values()]).reshape(len(candidates), -1)
+	shape = (len(candidates), len(all_subjects))
+	candidate_X = np.concatenate([np.broadcast_to(flag_rows[:, np.newaxis], shape + flag_rows.shape[1:]),
+		np.broadcast_to(subject_scans, shape + (3,)), np.broadcast_to(np.array(node_shares), shape + (len(model_names),))], axis=2)[..., varying]
+
+	#Predicts every subject and the totals for every candidate.
+	predicted, sd, leverage = model.predict(candidate_X)
+	totals, log_variance = model.predict_totals(candidate_X)
+	centre = np.log(totals) - log_variance / 2
+	low, high = np.exp(centre - z * np.sqrt(log_variance)), np.exp(centre + z * np.sqrt(log_variance))
+
+	#Writes the totals for every candidate, from the lowest expected emissions, along with the largest leverage of any
+	#subject (values well above those of the records mean the candidate is far from anything that's been run).
+	rows = []
+	for number, (name, flags) in enumerate(candidates.items()):
+		row = {'Candidate': name, 'Flags': ' '.join(' '.join((flag,) + values) for flag, values in flags.items() if flag not in ignored_flags), 'Subjects': len(all_subjects)}
+		for measure, (target, _, _) in enumerate(targets):
+			row[target] = totals[number, measure]
+			row['{}_lower'.format(target)] = low[number, measure]
+			row['{}_upper'.format(target)] = high[number, measure]
+		row['Max_leverage'] = leverage[number].max()
+		rows.append(row)
+	rows.sort(key=lambda row: row['gCO2'])
+	with open(os.path.join(output_dir, 'Estimator_candidates.csv'), 'w', newline = '') as output:
+		writer = csv.DictWriter(output, fieldnames = list(rows[0].keys()))
+		writer.writeheader()
+		writer.writerows(rows)
+
+	#Writes each subject's predictions for the pipeline scripts and planned scripts, with the mean of the log-normal
+	#prediction and its interval.
+	with open(os.path.join(output_dir, 'Estimator_subjects.csv'), 'w', newline = '') as output:
+		writer = csv.writer(output)
+		writer.writerow(['Candidate', 'Subject'] + [column.format(target) for target, _, _ in targets for column in ['{}', '{}_lower', '{}_upper']])
+		for number, name in enumerate(candidates):
+			if name not in detailed:
+				continue
+			for subject_number, subject in enumerate(all_subjects):
+				mean, spread = predicted[number, subject_number], sd[number, subject_number]
+				values = np.stack([np.exp(mean + spread ** 2 / 2), np.exp(mean - z * spread), np.exp(mean + z * spread)], axis=1)
+				writer.writerow([name, subject] + list(values.ravel()))
+
+	print("Scored {} candidates for {} subjects. Lowest expected emissions:".format(len(candidates), len(all_subjects)))
+	for row in rows[:5]:
+		print("{}: {:.0f}h ({:.0f}-{:.0f}), {:.1f} kWh ({:.1f}-{:.1f}), {:.0f} gCO2 ({:.0f}-{:.0f}).".format(row['Candidate'],
+			row['Wallclock_h'], row['Wallclock_h_lower'], row['Wallclock_h_upper'], row['kWh'], row['kWh_lower'], row['kWh_upper'],
+			row['gCO2'], row['gCO2_lower'], row['gCO2_upper']))
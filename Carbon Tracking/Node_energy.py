@@ -0,0 +1,186 @@
+#Imports relevant modules.
+import os
+import re
+import csv
+import glob
+import json
+from concurrent.futures import ProcessPoolExecutor
+from Calc_carbon import calc_cpu_kWh, calc_mem_kWh, calc_carbon_in_g
+
+#Attributes CPU time, memory and energy to individual nipype nodes, using the callback logs written by fMRIPrep when run
+#with '--resource-monitor'. Each line of these logs is a JSON record (written by nipype's log_nodes_cb) for a node that
+#has finished, including its duration, its peak CPU use (runtime_threads, which nipype fills in from the resource
+#monitor's peak CPU percentage, i.e. about 100 per busy core), and its peak memory (runtime_memory_gb). As both are
+#peaks rather than means, the CPU time and memory use calculated below are upper bounds for each node.
+
+#Defines the pipelines of interest, and the pipeline that every other pipeline is compared against.
+pipelines = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+baseline = '0'
+
+#Defines the directory containing each pipeline's folder (logs, derivatives, scratch, etc.).
+fmriprep_dir = '/<directory root>/fMRIPrep' #Full path removed for purpose of public sharing.
+
+#Patterns (relative to each pipeline's folder) used to find callback logs, in the fMRIPrep log folder of each subject
+#and at the top of the working directory.
+log_patterns = [os.path.join('derivatives', 'sub-*', 'log', '*', 'callback.log*'),
+	os.path.join('scratch', '*', 'callback.log*'),
+	os.path.join('scratch', 'callback.log*')]
+
+#The JSON file with information about the CPU used by the HPC nodes, and the CPU model to take from it.
+cpu_file = '/<directory root>/Calc_Carbon/cpu_info.json' #Full path removed for purpose of public sharing.
+cpu_model = '<cpu model>'
+
+#Defines the output directory for the per-pipeline breakdowns and the comparison across pipelines.
+output_dir = '/<directory root>/Sustainability_Output/Node_Energy' #Full path removed for purpose of public sharing.
+
+#The number of worker processes used to read log files.
+n_workers = 8
+
+#Patterns used to give the same node the same name in every subject: the subject's workflow name, and the index added
+#to each iteration of a MapNode (e.g. '_bold_transform3'). The subject of a log is taken from its path (the fMRIPrep
+#log folder of each subject), as the node IDs written by nipype don't include the workflow they belong to.
+subject_pattern = re.compile(r'single_subject_[^.]+_wf')
+iteration_pattern = re.compile(r'(\._[^.]*?)\d+$')
+log_subject_pattern = re.compile(r'derivatives[\\/](sub-[^\\/]+)[\\/]log[\\/]')
+
+#A function to give the name of a node shared across subjects, from the hierarchical ID in the callback log.
+def node_key(node_id):
+	return iteration_pattern.sub(r'\1', subject_pattern.sub('single_subject_wf', node_id))
+
+#A function to convert a value from the callback log to a float, returning None for missing or 'N/A' values.
+def to_float(value):
+	try:
+		return float(value)
+	except (TypeError, ValueError):
+		return None
+
+#A function to read one callback log, line by line, and total each node's runtime, CPU time (seconds of thread use, at
+#its peak CPU use), and memory use (GB x seconds, using its peak memory), along with its peak memory across runs. Only
+#records for finished nodes are parsed. Memory use stays bounded by the number of distinct nodes, however long the log
+#is. Returns the totals for each node and the subject of the log (if it's in a subject's log folder).
+def read_log(log_file):
+	totals = {}
+	subjects = set()
+	log_subject = log_subject_pattern.search(log_file)
+	if log_subject:
+		subjects.add(log_subject.group(1))
+	with open(log_file, 'r') as f:
+		for line in f:
+			if '"finish"' not in line:
+				continue
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue
+
+			duration = to_float(record.get('duration'))
+			if duration is None:
+				continue
+
+			#The peak CPU percentage is converted to a number of threads. If the resource monitor didn't record it, the
+			#number of threads the node was given is used instead, as with the 'requested' CPU calculation in
+			#Calc_carbon.py.
+			threads = to_float(record.get('runtime_threads'))
+			if threads is None:
+				threads = to_float(record.get('num_threads')) or 1
+			else:
+				threads /= 100
+			memory = to_float(record.get('runtime_memory_gb')) or 0
+
+			node = totals.setdefault(node_key(record.get('id', record.get('name', ''))), [0, 0, 0, 0, 0])
+			node[0] += 1
+			node[1] += duration
+			node[2] += duration * threads
+			node[3] += duration * memory
+			node[4] = max(node[4], memory)
+	return totals, subjects
+
+#A function to read every callback log for a pipeline across a pool of worker processes, and merge their totals. If no
+#log was found in a subject's log folder (e.g. only the working directory's logs remain), the subjects are counted from
+#the fMRIPrep reports in the pipeline's derivatives instead.
+def read_pipeline(pipeline):
+	pipeline_dir = os.path.join(fmriprep_dir, 'Pipeline_{}'.format(pipeline))
+	log_files = sorted(set(path for pattern in log_patterns for path in glob.glob(os.path.join(pipeline_dir, pattern))))
+
+	totals = {}
+	subjects = set()
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		for log_totals, log_subjects in executor.map(read_log, log_files, chunksize=4):
+			subjects |= log_subjects
+			for key, values in log_totals.items():
+				node = totals.setdefault(key, [0, 0, 0, 0, 0])
+				for i in range(4):
+					node[i] += values[i]
+				node[4] = max(node[4], values[4])
+	if not subjects:
+		subjects = set(os.path.basename(path)[:-len('.html')] for path in glob.glob(os.path.join(pipeline_dir, 'derivatives', 'sub-*.html')))
+	return totals, subjects
+
+#A function to convert each node's totals into rows of energy use and estimated emissions, using the same coefficients
+#as Calc_carbon.py. Rows are sorted by energy use, and each is given its share of the pipeline's total.
+def energy_rows(pipeline, totals, n_subjects, cpu):
+	rows = []
+	for key, (runs, runtime, cpu_time, memory_time, peak_memory) in totals.items():
+		cpu_kWh = calc_cpu_kWh(cpu, cpu_time)
+		mem_kWh = calc_mem_kWh(memory_time)
+		rows.append({'Pipeline': pipeline,
+			'Node': key,
+			'Runs': runs,
+			'Runtime_s': runtime,
+			'CPU_s': cpu_time,
+			'Peak_threads': cpu_time / runtime if runtime else 0,
+			'Peak_memory_GB': peak_memory,
+			'CPU_kWh': cpu_kWh,
+			'Memory_kWh': mem_kWh,
+			'kWh': cpu_kWh + mem_kWh,
+			'gCO2': calc_carbon_in_g(cpu_kWh + mem_kWh),
+			'kWh_per_subject': (cpu_kWh + mem_kWh) / n_subjects if n_subjects else 0})
+
+	total_kWh = sum(row['kWh'] for row in rows)
+	for row in rows:
+		row['Share'] = row['kWh'] / total_kWh if total_kWh else 0
+	return sorted(rows, key=lambda row: row['kWh'], reverse=True)
+
+#A function to write a list of rows to a CSV file.
+def write_rows(output_file, rows, fieldnames):
+	with open(output_file, 'w', newline = '') as output:
+		writer = csv.DictWriter(output, fieldnames = fieldnames)
+		writer.writeheader()
+		writer.writerows(rows)
+
+if __name__ == '__main__':
+
+	if not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+
+	with open(cpu_file, 'r') as f:
+		cpu = json.load(f)[cpu_model]
+
+	#Writes the breakdown of energy use by node for each pipeline, keeping the energy per subject for comparison.
+	per_subject = {}
+	for pipeline in pipelines:
+		totals, subjects = read_pipeline(pipeline)
+		rows = energy_rows(pipeline, totals, len(subjects), cpu)
+		per_subject[pipeline] = {row['Node']: row['kWh_per_subject'] for row in rows}
+		if rows:
+			write_rows(os.path.join(output_dir, 'Pipeline_{}_node_energy.csv'.format(pipeline)), rows, list(rows[0].keys()))
+		print("Finished Pipeline {}: {} node(s) across {} subject(s).".format(pipeline, len(rows), len(subjects)))
+
+	#Compares the energy used per subject by each node across pipelines. Nodes missing from a pipeline are given zero,
+	#so a node added by a pipeline (e.g. ICA-AROMA) appears as a positive difference from the baseline.
+	others = [pipeline for pipeline in pipelines if pipeline != baseline]
+	nodes = sorted(set(node for pipeline_nodes in per_subject.values() for node in pipeline_nodes))
+	diff_rows = []
+	for node in nodes:
+		row = {'Node': node}
+		for pipeline in pipelines:
+			row['P{}_kWh'.format(pipeline)] = per_subject[pipeline].get(node, 0)
+		for pipeline in others:
+			row['P{}_minus_P{}'.format(pipeline, baseline)] = row['P{}_kWh'.format(pipeline)] - row['P{}_kWh'.format(baseline)]
+		diff_rows.append(row)
+
+	#Nodes are sorted by the largest difference from the baseline in any pipeline.
+	diff_rows.sort(key=lambda row: max([abs(row['P{}_minus_P{}'.format(pipeline, baseline)]) for pipeline in others] or [0]), reverse=True)
+
+	if diff_rows:
+		write_rows(os.path.join(output_dir, 'Node_energy_comparison.csv'), diff_rows, list(diff_rows[0].keys()))
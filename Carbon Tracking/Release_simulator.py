@@ -0,0 +1,191 @@
+#Imports relevant modules.
+import os
+import sys
+import csv
+import json
+import heapq
+import itertools
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+#The shared container reader (see File_pack.py) is kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from File_pack import Pack
+
+#Replays the tasks of our array jobs, using the durations and energy use recorded in the Calc_carbon.py JSON files,
+#under different rules for when tasks are released to the cluster. Each task is assumed to draw constant power over
+#its run, so its emissions depend on the grid carbon intensity while it runs. Policies are:
+#  'fixed': tasks start as soon as one of 'concurrency' slots is free (as with '-tc' on the cluster).
+#  'deferral': as 'fixed', but tasks only start while intensity is at or below a percentile of the intensity series.
+#  'deadline': as 'deferral', but tasks start regardless of intensity once waiting longer would miss the deadline.
+
+#Defines the location of the directory containing JSON files for each HPC job, and the jobs to replay (all if empty).
+job_json_dir = '/<directory root>/Calc_Carbon/Job_JSONs' #Full path removed for purpose of public sharing.
+job_ids = []
+
+#A CSV file of grid carbon intensity (gCO2/kWh) over time, e.g. half-hourly values for our region from the National
+#Grid carbon intensity API, along with the names of its time and intensity columns. Tasks are submitted at the first
+#time in the file, and the series is repeated if the simulation runs past its end.
+intensity_file = '/<directory root>/Calc_Carbon/carbon_intensity.csv' #Full path removed for purpose of public sharing.
+time_column = 'from'
+intensity_column = 'actual'
+
+#Defines the output file for the results of every policy.
+output_file = '/<directory root>/Sustainability_Output/Calc_Carbon/Release_policies.csv' #Full path removed for purpose of public sharing.
+
+#The policy variants simulated: every combination of the values below is run for the relevant policies.
+concurrencies = [10, 25, 50, 100, 150, 257]
+percentiles = [10, 25, 50, 75]
+deadlines_h = [24, 48, 72, 168]
+
+#The number of worker processes used to simulate policies.
+n_workers = 8
+
+#A function to load the duration (s) and energy use (kWh) of every task in the given jobs, in job and task order. Job
+#JSON files are read from the folder's container if they've been packed (see File_pack.py), or from the originals if not.
+def load_tasks(job_json_dir, job_ids):
+	durations, energy = [], []
+	with Pack(job_json_dir) as pack:
+		if not job_ids:
+			names = set(name for name in os.listdir(job_json_dir) if name.startswith('calc_carbon_')) | set(pack.names('calc_carbon_*.json'))
+			job_ids = sorted(name[len('calc_carbon_'):-len('.json')] for name in names)
+		for job in job_ids:
+			tasks = json.load(pack.open('calc_carbon_{}.json'.format(job)))[job]
+			for task in sorted(tasks, key=lambda task: int(task) if task.isdigit() else 0):
+				durations.append(float(tasks[task]['wallclock']))
+				energy.append(float(tasks[task]['kWh']))
+	return np.array(durations), np.array(energy)
+
+#A function to load the intensity series. Values are placed on a regular time grid by their timestamps, with the step
+#taken as the most common gap between timestamps, so that missing values and missing rows don't shift the rest of the
+#series. Gaps are filled with the last value before them (or the first value, for a gap at the start). Returns the step
+#between values (s) and the values (gCO2/kWh).
+def load_intensity(intensity_file):
+	times, values = [], []
+	with open(intensity_file, newline='') as f:
+		for row in csv.DictReader(f):
+			times.append(datetime.fromisoformat(row[time_column].replace('Z', '+00:00')).timestamp())
+			values.append(float(row[intensity_column]) if row[intensity_column] not in ('', 'N/A', 'null') else np.nan)
+	times, values = np.array(times), np.array(values)
+	gaps, counts = np.unique(np.diff(np.unique(times)), return_counts=True)
+	step = gaps[np.argmax(counts)]
+
+	grid = np.full(int(round((times.max() - times.min()) / step)) + 1, np.nan)
+	grid[np.round((times - times.min()) / step).astype(int)] = values
+	known = np.flatnonzero(~np.isnan(grid))
+	grid = grid[known[np.maximum(np.searchsorted(known, np.arange(len(grid)), side='right') - 1, 0)]]
+	return step, grid
+
+#A class holding the intensity series in the forms needed to simulate quickly: the integral of intensity over time, so
+#a task's emissions come from two lookups, and for a given threshold, the time until the next period at or below it.
+class Intensity:
+
+	def __init__(self, step, values):
+		self.step = step
+		self.values = values
+		self.period = step * len(values)
+		self.cumulative = np.concatenate([[0], np.cumsum(values) * step])
+
+	#The integral of intensity from time zero to each time in 't' (g/kWh x s), repeating the series past its end.
+	def integral(self, t):
+		cycles, remainder = np.divmod(t, self.period)
+		return cycles * self.cumulative[-1] + np.interp(remainder, np.arange(len(self.cumulative)) * self.step, self.cumulative)
+
+	#The number of steps from each step of the series until the next step at or below the threshold (zero if the step
+	#itself is), searching over two repeats of the series so that the search wraps around. Thresholds are percentiles of
+	#the series, so there is always at least one such step.
+	def steps_to_low(self, threshold):
+		low = np.flatnonzero(np.tile(self.values <= threshold, 2))
+		steps = np.arange(len(self.values))
+		return low[np.searchsorted(low, steps)] - steps
+
+#A function to simulate releasing the tasks under one policy. Free slots are kept in a heap of the times they become
+#free. Each task (in array order) takes the earliest free slot, and starts then unless the policy holds it back.
+#Returns the start time of every task (s after submission).
+def simulate(durations, intensity, policy, concurrency, threshold=None, deadline=None):
+	if policy != 'fixed':
+		wait = intensity.steps_to_low(threshold)
+
+	slots = [0.0] * min(concurrency, len(durations))
+	remaining = durations.sum()
+	longest_remaining = np.maximum.accumulate(durations[::-1])[::-1]
+	starts = np.empty(len(durations))
+	for i, duration in enumerate(durations):
+		start = heapq.heappop(slots)
+
+		#Tasks are held until the start of the next low-intensity step, unless (for 'deadline') the remaining work
+		#spread over all slots would then no longer finish before the deadline.
+		if policy != 'fixed':
+			step = int(start // intensity.step) % len(wait)
+			if wait[step]:
+				deferred = (start // intensity.step + wait[step]) * intensity.step
+				if policy == 'deferral' or deferred + remaining / len(slots) + longest_remaining[i] <= deadline:
+					start = deferred
+
+		starts[i] = start
+		remaining -= duration
+		heapq.heappush(slots, start + duration)
+	return starts
+
+#The task durations, energy use and intensity series, as used by each worker process. These are the same for every
+#policy, so they're sent to each worker once, when the pool starts, rather than with every variant.
+shared = None
+
+#A function to set the task durations, energy use and intensity series in a worker process.
+def set_shared(worker_shared):
+	global shared
+	shared = worker_shared
+
+#A function to run one policy variant and summarise it: makespan (hours), total energy (kWh) and emissions (g), the
+#mean intensity of the energy used, and whether the deadline (if any) was met.
+def run_policy(policy, concurrency, percentile=None, deadline_h=None):
+	durations, energy, intensity = shared
+	threshold = np.percentile(intensity.values, percentile) if percentile is not None else None
+	deadline = deadline_h * 3600 if deadline_h is not None else None
+	starts = simulate(durations, intensity, policy, concurrency, threshold, deadline)
+	finishes = starts + durations
+
+	#Each task's emissions are its mean power multiplied by the integral of intensity over the time it runs.
+	gCO2 = (energy / durations * (intensity.integral(finishes) - intensity.integral(starts))).sum()
+	return {'Policy': policy,
+		'Concurrency': concurrency,
+		'Percentile': '' if percentile is None else percentile,
+		'Deadline_h': '' if deadline_h is None else deadline_h,
+		'Makespan_h': finishes.max() / 3600,
+		'kWh': energy.sum(),
+		'gCO2': gCO2,
+		'Mean_intensity': gCO2 / energy.sum(),
+		'Met_deadline': '' if deadline is None else bool(finishes.max() <= deadline)}
+
+#A function to list every policy variant to be simulated.
+def policy_variants():
+	variants = [('fixed', c, None, None) for c in concurrencies]
+	variants += [('deferral', c, q, None) for c, q in itertools.product(concurrencies, percentiles)]
+	variants += [('deadline', c, q, d) for c, q, d in itertools.product(concurrencies, percentiles, deadlines_h)]
+	return variants
+
+if __name__ == '__main__':
+
+	durations, energy = load_tasks(job_json_dir, job_ids)
+	durations = np.maximum(durations, 1)
+	intensity = Intensity(*load_intensity(intensity_file))
+	variants = policy_variants()
+	print("Simulating {} policies for {} tasks.".format(len(variants), len(durations)))
+
+	#Variants are spread across a pool of worker processes, each given the tasks and intensity series once.
+	with ProcessPoolExecutor(max_workers=n_workers, initializer=set_shared, initargs=((durations, energy, intensity),)) as executor:
+		rows = list(executor.map(run_policy, *zip(*variants), chunksize=8))
+
+	#Writes the results of every policy, and prints the policy with the lowest emissions for each concurrency.
+	with open(output_file, 'w', newline = '') as output:
+		writer = csv.DictWriter(output, fieldnames = list(rows[0].keys()))
+		writer.writeheader()
+		writer.writerows(rows)
+
+	baseline = {row['Concurrency']: row for row in rows if row['Policy'] == 'fixed'}
+	for concurrency in concurrencies:
+		best = min((row for row in rows if row['Concurrency'] == concurrency and row['Met_deadline'] is not False), key=lambda row: row['gCO2'])
+		print("Concurrency {}: fixed {:.0f}g over {:.1f}h, lowest is {} {:.0f}g over {:.1f}h.".format(concurrency, baseline[concurrency]['gCO2'],
+			baseline[concurrency]['Makespan_h'], ', '.join('{}={}'.format(key, best[key]) for key in ['Policy', 'Percentile', 'Deadline_h'] if best[key] != ''),
+			best['gCO2'], best['Makespan_h']))
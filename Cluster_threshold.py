@@ -0,0 +1,125 @@
+#Imports relevant modules.
+import sys
+import math
+import numpy as np
+import nibabel as nb
+from statistics import NormalDist
+from scipy import ndimage
+from Nifti_writer import save
+
+#Cluster-based thresholding of z-statistic maps, as carried out by FSL's 'cluster' for the thresholded maps written by
+#FEAT ('thresh_zstat'). Voxels above a cluster-forming threshold are grouped into clusters (neighbours sharing a face,
+#edge or corner), and each cluster is given a p-value for its size from Gaussian random field theory, using the
+#smoothness of the model's residuals. Voxels in clusters whose p-value is below the threshold keep their z-statistic,
+#and every other voxel is set to zero. Shared by the native first- and group-level models. Running this module
+#directly thresholds an existing map, given a FEAT 'smoothness' file, e.g.
+#'python Cluster_threshold.py zstat1.nii.gz mask.nii.gz stats/smoothness thresh_zstat1.nii.gz'.
+
+#The cluster-forming z threshold and cluster p threshold (FEAT's defaults), and the neighbours a voxel is connected to.
+z_threshold = 3.1
+p_threshold = 0.05
+connectivity = np.ones((3, 3, 3), dtype=bool)
+
+#The number of volumes standardised at once when estimating smoothness.
+smoothness_chunk = 16
+
+#A function to estimate the smoothness of a model's residuals, as FSL's 'smoothest' does. Residuals are given as a
+#(voxels x volumes) array of the voxels in the mask. Each voxel's residuals are scaled to unit variance, and the
+#correlation between neighbouring voxels along each axis is found from the variance of their differences. The residuals
+#are read a few volumes at a time, first for each voxel's mean and SD and then for the differences, so only a chunk of
+#volumes is ever copied. Returns the FWHM (in voxels) along each axis, 'DLH' (the square root of the determinant of the
+#roughness matrix, used below) and the number of voxels in one resel.
+def estimate_smoothness(residuals, mask):
+	index = np.full(mask.shape, -1, dtype=np.int64)
+	index[mask] = np.arange(np.count_nonzero(mask))
+	neighbours = []
+	for axis in range(3):
+		first = np.moveaxis(index, axis, 0)[:-1]
+		second = np.moveaxis(index, axis, 0)[1:]
+		valid = (first >= 0) & (second >= 0)
+		neighbours.append((first[valid], second[valid]))
+
+	n_volumes = residuals.shape[1]
+	chunks = [slice(start, start + smoothness_chunk) for start in range(0, n_volumes, smoothness_chunk)]
+	total = np.zeros(residuals.shape[0])
+	total_squares = np.zeros(residuals.shape[0])
+	for chunk in chunks:
+		block = residuals[:, chunk].astype(np.float64)
+		total += block.sum(axis=1)
+		total_squares += (block ** 2).sum(axis=1)
+	mean = total / n_volumes
+	scale = np.sqrt(np.maximum(total_squares / n_volumes - mean ** 2, 0))
+	scale = np.where(scale > 0, scale, 1)
+
+	difference_squares = np.zeros(3)
+	for chunk in chunks:
+		standardised = (residuals[:, chunk] - mean[:, np.newaxis]) / scale[:, np.newaxis]
+		for axis, (first, second) in enumerate(neighbours):
+			difference_squares[axis] += ((standardised[first] - standardised[second]) ** 2).sum()
+
+	fwhm = np.ones(3)
+	for axis, (first, second) in enumerate(neighbours):
+		difference_variance = difference_squares[axis] / (len(first) * n_volumes) if len(first) else np.nan
+		correlation = 1 - difference_variance / 2
+		if 0 < correlation < 1:
+			fwhm[axis] = math.sqrt(-2 * math.log(2) / math.log(correlation))
+	return fwhm, (4 * math.log(2)) ** 1.5 / fwhm.prod(), fwhm.prod()
+
+#A function to find the p-value of a cluster of each size, from Gaussian random field theory (as in FSL's 'cluster'):
+#the expected number of clusters above the threshold (from the Euler characteristic density in 3D), the expected
+#number of voxels in each, and the probability that at least one cluster is as large as the one found.
+def cluster_p_values(sizes, n_voxels, dlh, threshold=z_threshold):
+	expected_clusters = n_voxels * dlh * (threshold ** 2 - 1) * math.exp(-threshold ** 2 / 2) / (2 * math.pi) ** 2
+	if expected_clusters <= 0:
+		return np.zeros(len(sizes))
+	expected_size = n_voxels * NormalDist().cdf(-threshold) / expected_clusters
+	beta = (math.gamma(2.5) / expected_size) ** (2 / 3)
+	return 1 - np.exp(-expected_clusters * np.exp(-beta * np.asarray(sizes, dtype=float) ** (2 / 3)))
+
+#A function to threshold a z-statistic map by cluster. Returns the thresholded map, and a table of the clusters found
+#(in order of size, as in FSL's cluster tables), each with its size, p-value, and the value and position of its peak.
+def cluster_threshold(zstat, mask, dlh, threshold=z_threshold, p=p_threshold):
+	labels, n_clusters = ndimage.label((zstat > threshold) & mask, structure=connectivity)
+	if not n_clusters:
+		return np.zeros(zstat.shape, dtype=np.float32), []
+	sizes = np.bincount(labels.ravel())[1:]
+	p_values = cluster_p_values(sizes, np.count_nonzero(mask), dlh, threshold)
+	peaks = ndimage.maximum_position(zstat, labels, range(1, n_clusters + 1))
+	kept = np.concatenate([[False], p_values < p])
+	thresholded = np.where(kept[labels], zstat, 0).astype(np.float32)
+
+	table = []
+	for number in np.argsort(sizes, kind='stable'):
+		if kept[number + 1]:
+			table.append({'Voxels': int(sizes[number]), 'P': float(p_values[number]), 'Z_max': float(zstat[peaks[number]]),
+				'X': peaks[number][0], 'Y': peaks[number][1], 'Z': peaks[number][2]})
+	return thresholded, table
+
+#A function to write a cluster table in the layout of FSL's cluster tables (tab-separated, with the largest cluster
+#given the highest index and listed first).
+def write_cluster_table(path, table):
+	with open(path, 'w') as f:
+		f.write('Cluster Index\tVoxels\tP\t-log10(P)\tZ-MAX\tZ-MAX X (vox)\tZ-MAX Y (vox)\tZ-MAX Z (vox)\n')
+		for number, cluster in reversed(list(enumerate(table, 1))):
+			f.write('{}\t{}\t{:.3g}\t{:.2f}\t{:.2f}\t{}\t{}\t{}\n'.format(number, cluster['Voxels'], cluster['P'], -math.log10(max(cluster['P'], 1e-300)),
+				cluster['Z_max'], cluster['X'], cluster['Y'], cluster['Z']))
+
+#A function to write a 'smoothness' file in the layout of FEAT's (stats/smoothness), and to read one back. Returns DLH.
+def write_smoothness(path, dlh, n_voxels, resel_size):
+	with open(path, 'w') as f:
+		f.write('DLH {:.6f}\nVOLUME {}\nRESELS {:.6f}\n'.format(dlh, n_voxels, resel_size))
+
+def read_smoothness(path):
+	with open(path) as f:
+		values = dict(line.split()[:2] for line in f if line.strip())
+	return float(values['DLH'])
+
+if __name__ == '__main__':
+
+	#Thresholds the map given as the first argument within the mask given as the second, with the smoothness in the
+	#third, and saves it as the fourth.
+	zstat_load = nb.load(sys.argv[1])
+	mask = np.asanyarray(nb.load(sys.argv[2]).dataobj) > 0
+	thresholded, table = cluster_threshold(zstat_load.get_fdata(dtype=np.float32), mask, read_smoothness(sys.argv[3]))
+	save(nb.Nifti1Image(thresholded, zstat_load.affine, zstat_load.header), sys.argv[4], 'map')
+	print("{} cluster(s) kept, {} voxels.".format(len(table), sum(cluster['Voxels'] for cluster in table)))
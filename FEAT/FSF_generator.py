@@ -2,9 +2,14 @@
 import glob
 import os
 import configparser
+import sys
 import shutil
 import math
 
+#The shared index functions are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from BIDS_index import load_index
+
 #Defines the pipeline that we're geneting FSF files for.
 pipeline = '0'
 
@@ -14,6 +19,10 @@ studydir = '/<directory root>/FEAT/Pipeline_{}/'.format(pipeline) #Full path rem
 fsfdir = '/<directory root>/FEAT/Pipeline_{}/fsf_files/'.format(pipeline) #Full path removed for purpose of public sharing.
 templates = '/<directory root>/FEAT/fsf_templates/' #Full path removed for purpose of public sharing.
 
+#Whether to write this pipeline's group-level fsf file. Set to False if the group level is fitted with
+#Group_level_native.py, which reads every pipeline's first-level output directly.
+group_fsf = True
+
 #Checks whether the FSF directory exists. It's created if not.
 if not os.path.exists(fsfdir):
 	os.makedirs(fsfdir)
@@ -26,8 +35,11 @@ for item in os.listdir(fsfdir):
 #per batch and the number of subjects in the input directory. Number is defined as the latter divided by
 #the former, rounded up to the nearest whole number. We need these batches as we won't want to run
 #FEAT for all subjects simultaneously.
+#Subjects are found from the index of the input directory (see BIDS_index.py), which only counts subject folders (and
+#not the FSF folder or any other files). FEAT output and the FSF files aren't indexed, as they aren't needed here.
 batch_size = 13
-num_subjects = len(os.listdir(studydir)) - 1
+index = load_index(studydir, skipped={'fsf_files', 'Results'})
+num_subjects = len(index.subjects())
 num_batches = math.ceil(num_subjects/batch_size)
 
 #Defines the number of batches as an inclusive list with values between 1 and and the number of batches to be used.
@@ -48,33 +60,33 @@ for batch in batches:
 	if not os.path.exists(batch_dir):
 		os.makedirs(batch_dir)
 
+#A counter for the number of FSF files in the current batch.
+batch_count = 0
+
 #Iterates over subjects in the input directory.
-for subject in sorted(os.listdir(studydir)):
+for subject in index.subjects():
 
 	#Checks if there are already the max number of subjects in the current batch. If so, the first index of the batch list is removed.
-	if len(os.listdir(os.path.join(fsfdir, 'Batch_{}'.format(batches[0])))) == batch_size:
+	if batch_count == batch_size:
 		batches.pop(0)
+		batch_count = 0
 
 	#Defines the batch directory as the first index of the list, which will change as a folder hits the max number of files (as above).
 	batch_dir = os.path.join(fsfdir, 'Batch_{}'.format(batches[0]))
 
-	#If a subfolder doesn't correspond to a specific subject, it's skipped.
-	if 'sub' not in subject:
-		continue
-
 	#This dictionary contains template placeholders as keys, and replacement variables as values.
 	replacements = {'SUBNUM': subject, 'PIPELINEID': 'Pipeline_{}'.format(pipeline)}
 
-	#A subject-specific directory containing EV files.
-	EV_dir = os.path.join(studydir, subject, 'EVs')
+	#The names of this subject's EV files.
+	EV_files = [record['name'] for record in index.query(sub=subject, datatype='EVs')]
 
 	#If this participant has an 'erroneous' EV, we'll use the 6 EV template and tell the user. If not,
 	#we'll use the 5 ev template instead. Note that each EV subfolder will include X exprimental EVs plus
 	#the confounds file. Finally, if the number of files in this folder is not 6 or 7, the user is told that
 	#something weird is happening and the rest of the loop is skipped.
-	if 'erroneous_trials.txt' in os.listdir(EV_dir) and len(os.listdir(EV_dir)) == 7:
+	if 'erroneous_trials.txt' in EV_files and len(EV_files) == 7:
 		template = os.path.join(templates, 'EV6_template.fsf')
-	elif 'erroneous_trials.txt' not in os.listdir(EV_dir) and len(os.listdir(EV_dir)) == 6:
+	elif 'erroneous_trials.txt' not in EV_files and len(EV_files) == 6:
 		template = os.path.join(templates, 'EV5_template.fsf')
 	else:
 		print('Unexpected number of EVs for {}, investigate.'.format(subject))
@@ -97,22 +109,28 @@ for subject in sorted(os.listdir(studydir)):
 					line = line.replace(placeholder, target)
 				outfile.write(line)
 
-#Defines the filepath that group fsf file will be saved to. This folder is created if it does not exist.
-group_folder = '/<directory root>/Group_Level/Pipeline_{}/'.format(pipeline) #Full path removed for purpose of public sharing.
-if not os.path.exists(group_folder):
-	os.makedirs(group_folder)
+	batch_count += 1
+
+#The group-level fsf file is only needed if the group level is run in FEAT. It's not written if the group level is
+#fitted with Group_level_native.py instead (see 'group_fsf' above).
+if group_fsf:
 
-#Defines the input and output group fsf files as variables.
-group_template = os.path.join(templates, 'Group_template.fsf')
-group_output = os.path.join(group_folder, 'Group_stopsignal_{}.fsf'.format(pipeline))
+	#Defines the filepath that group fsf file will be saved to. This folder is created if it does not exist.
+	group_folder = '/<directory root>/Group_Level/Pipeline_{}/'.format(pipeline) #Full path removed for purpose of public sharing.
+	if not os.path.exists(group_folder):
+		os.makedirs(group_folder)
 
-#Opens the input and output files.
-with open(group_template) as group_in:
-	with open(group_output, 'w') as group_out:
+	#Defines the input and output group fsf files as variables.
+	group_template = os.path.join(templates, 'Group_template.fsf')
+	group_output = os.path.join(group_folder, 'Group_stopsignal_{}.fsf'.format(pipeline))
+
+	#Opens the input and output files.
+	with open(group_template) as group_in:
+		with open(group_output, 'w') as group_out:
 		
-		#Iterates over each line in the template.
-		for line in group_in:
+			#Iterates over each line in the template.
+			for line in group_in:
 
-			#Finds any instance of the pipeline ID placeholder, and replaces.
-			line = line.replace('PIPELINEID', 'Pipeline_{}'.format(pipeline))
-			group_out.write(line)
+				#Finds any instance of the pipeline ID placeholder, and replaces.
+				line = line.replace('PIPELINEID', 'Pipeline_{}'.format(pipeline))
+				group_out.write(line)
@@ -1,7 +1,12 @@
 #Imports relevant modules
 import os
+import sys
 import csv
 
+#The shared packing functions are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from File_pack import Pack
+
 #Sets the pipeline. This will need to be updated manually.
 pipeline = '0'
 
@@ -12,8 +17,9 @@ pipeline_dir = '/<directory root>/FEAT/Pipeline_{}'.format(pipeline) #Full path
 output_path = '/<directory root>/Featquery/Pipeline_{}_Featquery.csv'.format(pipeline) #Full path removed for purpose of public sharing.
 headers = ['Subject', 'Motor', 'Pre-sma', 'Auditory', 'Insula']
 
-#The output file is opened and the header row is written.
-with open(output_path, mode = 'w', newline = '') as output_file:
+#The output file is opened and the header row is written. Reports are read from the container of small files for this
+#pipeline, if they've been packed (see File_pack.py), or from the report files if not.
+with open(output_path, mode = 'w', newline = '') as output_file, Pack(pipeline_dir) as pack:
 	writer = csv.DictWriter(output_file, fieldnames = headers)
 	writer.writeheader()
 
@@ -32,12 +38,11 @@ with open(output_path, mode = 'w', newline = '') as output_file:
 			if region == 'Subject':
 				continue
 			
-			#Defines a path to the relevant featquery report for this region.	
-			featquery_report = os.path.join(pipeline_dir, subject, 'Results', '.feat', 'featquery_{}'.format(region), 'report.txt')
+			#Defines a path to the relevant featquery report for this region, within the pipeline directory.
+			featquery_report = os.path.join(subject, 'Results', '.feat', 'featquery_{}'.format(region), 'report.txt')
 
-			#Opens the report, and pulls out the mean zstat value.
-			with open(featquery_report, 'r') as f:
-					mean_stat = f.readline().split()[5]
+			#Reads the report, and pulls out the mean zstat value.
+			mean_stat = pack.open(featquery_report).readline().split()[5]
 
 			#This value is added to the above dictionary with the region label as a key.
 			zstats[region] = mean_stat
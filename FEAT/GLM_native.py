@@ -0,0 +1,370 @@
+#Imports relevant modules.
+import os
+import re
+import sys
+import csv
+import glob
+import nibabel as nb
+import numpy as np
+from scipy import special, stats
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+#The shared NIFTI writer and cluster thresholding are kept at the top of the repository, and the masked smoother is
+#shared with Smoothing_native.py.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Smoothing'))
+from Nifti_writer import save
+from Cluster_threshold import estimate_smoothness, cluster_threshold, write_cluster_table, write_smoothness
+from Smoothing_native import MaskedSmoother
+
+#An in-process alternative to running first-level FEAT for each subject. The model is read from the subject's FSF file
+#(written by FSF_generator.py), so it matches what FEAT would fit: the EV files and confounds.txt staged by
+#FMRIPrep_to_FEAT.py, the convolution, temporal derivatives and high-pass filter set in the template, and the contrasts.
+#The data are scaled and filtered as in FEAT's pre-statistics, and every voxel in the brain mask is fitted with the
+#same design, with AR(1) prewhitening. The outputs are written into the same layout as FEAT's (Results/.feat/stats).
+
+#Defines the identity of the pipeline being run. Will need to be updated accordingly.
+pipeline = '0'
+
+#Defines the FEAT directory for this pipeline, and the folder holding the FSF files generated for it.
+studydir = '/<directory root>/FEAT/Pipeline_{}/'.format(pipeline) #Full path removed for purpose of public sharing.
+fsfdir = '/<directory root>/FEAT/Pipeline_{}/fsf_files/'.format(pipeline) #Full path removed for purpose of public sharing.
+
+#The brain mask used for each subject (relative to their folder), and the name of the output folder in their Results
+#folder.
+mask_name = os.path.join('Functional', 'stopsignal_mask.nii.gz')
+output_name = '.feat'
+
+#The time resolution (s) at which EVs are built and convolved, and the point within each volume at which they're
+#sampled (as a fraction of the TR). Slice timing correction isn't applied, so the middle of the volume is used.
+time_resolution = 0.05
+sample_offset = 0.5
+
+#The FWHM (mm) used to smooth the autocorrelation estimates within the mask before prewhitening (FILM also smooths
+#them, to reduce their noise), or 0 to use each voxel's own estimate.
+ar_fwhm = 5
+
+#The number of voxels fitted together in each chunk, the number of subjects fitted simultaneously (each in its own
+#process), and the number of threads each process uses to compress its output (see Nifti_writer.py).
+chunk_size = 10000
+n_workers = 8
+compression_threads = max(1, (os.cpu_count() or 1) // n_workers)
+
+#Subjects listed here are fitted into a separate folder ('Results/.feat_native') and compared against their existing
+#FEAT output, rather than replacing it. Leave empty to fit the whole pipeline.
+validation_subjects = []
+validation_name = '.feat_native'
+
+#Defines the output file that validation metrics are written into, if validation subjects are given.
+validation_file = '/<directory root>/FEAT/Pipeline_{}_GLM_validation.csv'.format(pipeline) #Full path removed for purpose of public sharing.
+
+#A function to read the settings in an FSF file, as a dictionary of name: value (e.g. 'fmri(tr)': '2.0' or
+#'feat_files(1)': '/path/to/data'), with quotes removed.
+def read_fsf(path):
+	settings = {}
+	with open(path) as f:
+		for line in f:
+			found = re.match(r'set\s+(\S+)\s+(.*)$', line.strip())
+			if found:
+				settings[found.group(1)] = found.group(2).strip().strip('"')
+	return settings
+
+#A function to find the FSF file generated for a subject, in any batch folder.
+def find_fsf(subject):
+	matches = sorted(glob.glob(os.path.join(fsfdir, '*', '{}_stopsignal_{}.fsf'.format(subject, pipeline))))
+	return matches[0] if matches else None
+
+#A function to find an image given with or without its extension, as in FSL.
+def find_image(path):
+	for candidate in [path, path + '.nii.gz', path + '.nii']:
+		if os.path.isfile(candidate):
+			return candidate
+	raise FileNotFoundError("Could not find the image {}".format(path))
+
+#A function to build the convolution kernel for an EV, at the time resolution above and normalised to sum to 1: FSL's
+#double-gamma HRF (a gamma function peaking at 6s minus one sixth of one peaking at 16s), or a single gamma function with
+#the FSF file's mean lag and SD. Returns None if the EV isn't convolved.
+def hrf_kernel(settings, ev):
+	convolve = int(settings.get('fmri(convolve{})'.format(ev), 0))
+	times = np.arange(0, 32, time_resolution)
+	if convolve == 0:
+		return None
+	elif convolve == 2:
+		delay = float(settings['fmri(gammadelay{})'.format(ev)])
+		sigma = float(settings['fmri(gammasigma{})'.format(ev)])
+		kernel = stats.gamma.pdf(times, (delay / sigma) ** 2, scale=sigma ** 2 / delay)
+	elif convolve == 3:
+		kernel = stats.gamma.pdf(times, 6) - stats.gamma.pdf(times, 16) / 6
+	else:
+		raise ValueError("Convolution {} for EV {} is not supported".format(convolve, ev))
+	return kernel / kernel.sum()
+
+#A function to build one original EV at the time resolution above, from a 3-column file (onset, duration and height of
+#each event) or a 1-column file (a value for each volume), convolve it, and sample it at each volume. Events with no
+#duration are given one time step.
+def build_ev(settings, ev, n_volumes, tr):
+	shape = int(settings['fmri(shape{})'.format(ev)])
+	n_steps = int(round(n_volumes * tr / time_resolution))
+	signal = np.zeros(n_steps)
+	if shape == 3:
+		path = settings['fmri(custom{})'.format(ev)]
+		events = np.loadtxt(path, ndmin=2) if os.path.getsize(path) else np.zeros((0, 3))
+		for onset, duration, height in events[:, :3]:
+			start = int(round(onset / time_resolution))
+			signal[start:start + max(1, int(round(duration / time_resolution)))] += height
+	elif shape == 2:
+		values = np.loadtxt(settings['fmri(custom{})'.format(ev)], ndmin=1)
+		signal = np.repeat(values[:n_volumes], int(round(tr / time_resolution)))[:n_steps]
+	elif shape != 10:
+		raise ValueError("EV shape {} for EV {} is not supported".format(shape, ev))
+
+	kernel = hrf_kernel(settings, ev)
+	if kernel is not None:
+		signal = np.convolve(signal, kernel)[:n_steps]
+	samples = np.minimum(((np.arange(n_volumes) + sample_offset) * tr / time_resolution).astype(int), n_steps - 1)
+	return signal[samples]
+
+#A function to build FEAT's high-pass filter as a matrix (volumes x volumes): each volume has a Gaussian-weighted
+#straight line fitted around it (with the same sigma as 'fslmaths -bptf', half the cutoff in volumes, over 3 sigma on
+#either side), and the filtered timeseries is the original minus the fitted line.
+def highpass_matrix(n_volumes, sigma):
+	fitted = np.zeros((n_volumes, n_volumes))
+	half_width = int(3 * sigma)
+	for t in range(n_volumes):
+		window = np.arange(max(0, t - half_width), min(n_volumes, t + half_width + 1))
+		weights = np.exp(-0.5 * ((window - t) / sigma) ** 2)
+		basis = np.stack([np.ones(len(window)), window - t], axis=1)
+		fitted[t, window] = np.linalg.solve(basis.T @ (basis * weights[:, np.newaxis]), (basis * weights[:, np.newaxis]).T)[0]
+	return np.eye(n_volumes) - fitted
+
+#A function to build the design for a subject from their FSF settings. Each original EV is followed by its temporal
+#derivative if requested (orthogonalised with respect to the EV, as in FEAT), then the confound EVs are added. Columns
+#are high-pass filtered as requested, and demeaned. Returns the design (volumes x columns), the contrasts (contrasts x
+#columns) and the contrast names.
+def build_design(settings, n_volumes, highpass):
+	tr = float(settings['fmri(tr)'])
+	columns = []
+	for ev in range(1, int(settings['fmri(evs_orig)']) + 1):
+		filtered = highpass is not None and int(settings.get('fmri(tempfilt_yn{})'.format(ev), 1))
+		timecourse = build_ev(settings, ev, n_volumes, tr)
+		added = [timecourse]
+		if int(settings.get('fmri(deriv_yn{})'.format(ev), 0)):
+			derivative = np.gradient(timecourse)
+			centred = timecourse - timecourse.mean()
+			if centred @ centred > 0:
+				derivative = derivative - (derivative @ centred) / (centred @ centred) * centred
+			added.append(derivative)
+		columns += [highpass @ column if filtered else column for column in added]
+	n_real = len(columns)
+
+	if int(settings.get('fmri(confoundevs)', 0)):
+		confounds = np.loadtxt(settings['confoundev_files(1)'], ndmin=2)[int(settings.get('fmri(ndelete)', 0)):]
+		columns += [highpass @ column if highpass is not None else column for column in confounds.T]
+
+	design = np.stack(columns, axis=1)
+	design -= design.mean(axis=0)
+	n_contrasts = int(settings.get('fmri(ncon_real)', 0))
+	contrasts = np.zeros((n_contrasts, design.shape[1]))
+	for contrast in range(n_contrasts):
+		for column in range(n_real):
+			contrasts[contrast, column] = float(settings.get('fmri(con_real{}.{})'.format(contrast + 1, column + 1), 0))
+	names = [settings.get('fmri(conname_real{})'.format(contrast + 1), str(contrast + 1)) for contrast in range(n_contrasts)]
+	return design, contrasts, names
+
+#A function to convert t-statistics to z-statistics with the same p-value. The upper tail is found on the log scale, so
+#that very large t-statistics don't become infinite.
+def t_to_z(t, dof):
+	return np.sign(t) * -special.ndtri_exp(stats.t.logsf(np.abs(t), dof))
+
+#A function to estimate the lag-1 autocorrelation of each voxel's residuals from an ordinary least squares fit, for a
+#chunk of data (volumes x voxels).
+def ols_autocorrelation(data, design, pseudoinverse):
+	residuals = data - design @ (pseudoinverse @ data)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return np.nan_to_num((residuals[1:] * residuals[:-1]).sum(axis=0) / (residuals ** 2).sum(axis=0))
+
+#A function to fit a chunk of voxels (volumes x voxels) by generalised least squares, given each voxel's AR(1)
+#coefficient. Prewhitening replaces each volume by itself minus rho times the one before (and scales the first volume by
+#sqrt(1 - rho^2)), so the whitened cross-products are quadratic in rho: X'X - rho * C + rho^2 * E, where C holds the
+#cross-products of each volume with the one before and E those of the volumes without the first and last. These are
+#found for the whole chunk with a few matrix products, and each voxel's system is then solved in one batched call, along
+#with the contrasts. Returns the parameter estimates (voxels x columns), the residual variance, the copes and varcopes
+#(voxels x contrasts), and the unwhitened residuals (volumes x voxels).
+def gls_chunk(data, design, rho, contrasts, dof):
+	first, middle = design[:-1], design[1:-1]
+	cross = design.T @ design, design[1:].T @ first + first.T @ design[1:], middle.T @ middle
+	projected = design.T @ data, design[1:].T @ data[:-1] + first.T @ data[1:], middle.T @ data[1:-1]
+	squares = (data ** 2).sum(axis=0), 2 * (data[1:] * data[:-1]).sum(axis=0), (data[1:-1] ** 2).sum(axis=0)
+
+	weights = rho[:, np.newaxis, np.newaxis]
+	systems = cross[0] - weights * cross[1] + weights ** 2 * cross[2]
+	right = (projected[0] - rho * projected[1] + rho ** 2 * projected[2]).T
+	solved = np.linalg.solve(systems, np.concatenate([right[..., np.newaxis], np.broadcast_to(contrasts.T, (len(rho),) + contrasts.T.shape)], axis=2))
+	estimates = solved[..., 0]
+
+	residual_squares = squares[0] - rho * squares[1] + rho ** 2 * squares[2] - (estimates * right).sum(axis=1)
+	variance = np.maximum(residual_squares, 0) / dof
+	copes = estimates @ contrasts.T
+	varcopes = variance[:, np.newaxis] * np.einsum('cp,vpc->vc', contrasts, solved[..., 1:])
+	return estimates, variance, copes, varcopes, data - design @ estimates.T
+
+#A function to fit one subject's model and write its outputs into the given folder (inside their Results folder), in
+#FEAT's layout: the parameter estimates, copes, varcopes, t- and z-statistics, residual variance, autocorrelation and
+#degrees of freedom in 'stats', and the mask, mean image, design, and cluster-thresholded z-statistics at the top.
+def fit_subject(subject_dir, settings, output_dir):
+	stats_dir = os.path.join(output_dir, 'stats')
+	if not os.path.isdir(stats_dir):
+		os.makedirs(stats_dir)
+
+	#Loads the data (without any deleted volumes) and the mask. The data are scaled so that the median of the voxels'
+	#means is 10000, as in FEAT's pre-statistics, and the mean of each voxel is kept for the mean image. The data are then
+	#high-pass filtered and demeaned, as the design is demeaned too (so no constant term is needed).
+	bold_load = nb.load(find_image(settings['feat_files(1)']))
+	mask_load = nb.load(os.path.join(subject_dir, mask_name))
+	mask = np.asanyarray(mask_load.dataobj) > 0
+	data = np.asanyarray(bold_load.dataobj, dtype=np.float32)[mask][:, int(settings.get('fmri(ndelete)', 0)):].T
+	n_volumes = data.shape[0]
+	data *= 10000 / np.median(data.mean(axis=0))
+	mean_func = data.mean(axis=0)
+	highpass = None
+	if int(settings.get('fmri(temphp_yn)', 1)):
+		highpass = highpass_matrix(n_volumes, float(settings['fmri(paradigm_hp)']) / (2 * float(settings['fmri(tr)'])))
+		data = (highpass @ data).astype(np.float32)
+	data -= data.mean(axis=0)
+
+	#Builds the design. Columns that are empty (e.g. an EV with no events) can't be estimated, so are left out of the
+	#fit, with their estimates set to zero.
+	design, contrasts, names = build_design(settings, n_volumes, highpass)
+	used = design.std(axis=0) > 1e-8 * np.abs(design).max()
+	if not used.all():
+		print("{}: leaving out empty design column(s) {}.".format(os.path.basename(subject_dir), ', '.join(str(column + 1) for column in np.flatnonzero(~used))))
+	fitted_design, fitted_contrasts = design[:, used], contrasts[:, used]
+	dof = n_volumes - fitted_design.shape[1]
+
+	#Estimates each voxel's autocorrelation from an OLS fit, and smooths the estimates within the mask.
+	n_voxels = data.shape[1]
+	pseudoinverse = np.linalg.pinv(fitted_design)
+	rho = np.concatenate([ols_autocorrelation(data[:, start:start + chunk_size].astype(np.float64), fitted_design, pseudoinverse) for start in range(0, n_voxels, chunk_size)])
+	if ar_fwhm:
+		rho_volume = np.zeros(mask.shape, dtype=np.float32)
+		rho_volume[mask] = rho
+		rho = MaskedSmoother(mask, mask_load.header.get_zooms(), ar_fwhm).smooth(rho_volume)[mask]
+	rho = np.clip(rho, -0.99, 0.99)
+
+	#Fits every voxel by GLS, chunk by chunk. The data aren't needed after a chunk is fitted, so each chunk's residuals are
+	#written over its data, rather than being kept in a second (voxels x volumes) array.
+	estimates = np.zeros((n_voxels, design.shape[1]), dtype=np.float32)
+	variance = np.zeros(n_voxels, dtype=np.float32)
+	copes = np.zeros((n_voxels, len(contrasts)), dtype=np.float32)
+	varcopes = np.zeros((n_voxels, len(contrasts)), dtype=np.float32)
+	for start in range(0, n_voxels, chunk_size):
+		chunk = slice(start, start + chunk_size)
+		chunk_estimates, variance[chunk], copes[chunk], varcopes[chunk], data[:, chunk] = gls_chunk(data[:, chunk].astype(np.float64), fitted_design, rho[chunk].astype(np.float64), fitted_contrasts, dof)
+		estimates[chunk][:, used] = chunk_estimates
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		tstats = np.where(varcopes > 0, copes / np.sqrt(varcopes), 0)
+	zstats = t_to_z(tstats, dof).astype(np.float32)
+
+	#Writes each map, with the header of the mask (as float32).
+	header = mask_load.header.copy()
+	header.set_data_dtype(np.float32)
+	def write_map(values, path):
+		volume = np.zeros(mask.shape, dtype=np.float32)
+		volume[mask] = values
+		save(nb.Nifti1Image(volume, mask_load.affine, header), path, 'map', compression_threads)
+		return volume
+	for column in range(design.shape[1]):
+		write_map(estimates[:, column], os.path.join(stats_dir, 'pe{}.nii.gz'.format(column + 1)))
+	write_map(variance, os.path.join(stats_dir, 'sigmasquareds.nii.gz'))
+	write_map(rho, os.path.join(stats_dir, 'threshac1.nii.gz'))
+	write_map(mean_func, os.path.join(output_dir, 'mean_func.nii.gz'))
+	save(nb.Nifti1Image(mask.astype(np.uint8), mask_load.affine), os.path.join(output_dir, 'mask.nii.gz'), 'mask', compression_threads)
+	with open(os.path.join(stats_dir, 'dof'), 'w') as f:
+		f.write('{}\n'.format(dof))
+	np.savetxt(os.path.join(output_dir, 'design.mat'), design, fmt='%.6e', delimiter='\t',
+		header='/NumWaves\t{}\n/NumPoints\t{}\n/Matrix'.format(design.shape[1], n_volumes), comments='')
+
+	#Cluster-thresholds each z-statistic map, using the smoothness of the residuals, with the thresholds set in the FSF
+	#file (as FEAT does when cluster thresholding is chosen). The residuals are passed as a transposed view of the data
+	#array, which estimate_smoothness reads a few volumes at a time.
+	fwhm, dlh, resel_size = estimate_smoothness(data.T, mask)
+	write_smoothness(os.path.join(stats_dir, 'smoothness'), dlh, n_voxels, resel_size)
+	for contrast in range(len(contrasts)):
+		number = contrast + 1
+		write_map(copes[:, contrast], os.path.join(stats_dir, 'cope{}.nii.gz'.format(number)))
+		write_map(varcopes[:, contrast], os.path.join(stats_dir, 'varcope{}.nii.gz'.format(number)))
+		write_map(tstats[:, contrast], os.path.join(stats_dir, 'tstat{}.nii.gz'.format(number)))
+		zstat = write_map(zstats[:, contrast], os.path.join(stats_dir, 'zstat{}.nii.gz'.format(number)))
+		if int(settings.get('fmri(thresh)', 3)) == 3:
+			thresholded, table = cluster_threshold(zstat, mask, dlh, float(settings.get('fmri(z_thresh)', 3.1)), float(settings.get('fmri(prob_thresh)', 0.05)))
+			save(nb.Nifti1Image(thresholded, mask_load.affine, header), os.path.join(output_dir, 'thresh_zstat{}.nii.gz'.format(number)), 'map', compression_threads)
+			write_cluster_table(os.path.join(output_dir, 'cluster_zstat{}.txt'.format(number)), table)
+	return names
+
+#A function to compare the native output for each contrast against FEAT's within the mask. Returns a row for each
+#contrast with the correlation between the two z-statistic maps, the RMS difference relative to the RMS of FEAT's map,
+#the largest difference, and the overlap (Dice coefficient) of the thresholded maps.
+def compare_to_feat(native_dir, feat_dir, names, mask):
+	rows = []
+	for number, name in enumerate(names, 1):
+		native = nb.load(os.path.join(native_dir, 'stats', 'zstat{}.nii.gz'.format(number))).get_fdata(dtype=np.float32)[mask]
+		feat = nb.load(os.path.join(feat_dir, 'stats', 'zstat{}.nii.gz'.format(number))).get_fdata(dtype=np.float32)[mask]
+		difference = native - feat
+		row = {'Contrast': name, 'Correlation': float(np.corrcoef(native, feat)[0, 1]),
+			'Relative_RMS': float(np.sqrt(np.mean(difference ** 2)) / np.sqrt(np.mean(feat ** 2))), 'Max_abs_diff': float(np.max(np.abs(difference))), 'Dice': ''}
+		thresholded = [os.path.join(folder, 'thresh_zstat{}.nii.gz'.format(number)) for folder in [native_dir, feat_dir]]
+		if all(os.path.exists(path) for path in thresholded):
+			native_active, feat_active = [np.asanyarray(nb.load(path).dataobj)[mask] > 0 for path in thresholded]
+			total = native_active.sum() + feat_active.sum()
+			row['Dice'] = float(2 * (native_active & feat_active).sum() / total) if total else 1.0
+		rows.append(row)
+	return rows
+
+#A function to run for each subject in the process pool. Validation subjects are written to a separate folder and
+#compared against FEAT's output, others are written into the folder FEAT would use.
+def process_subject(subject_dir):
+	subject = os.path.basename(subject_dir)
+	fsf_file = find_fsf(subject)
+	if fsf_file is None:
+		return None
+	settings = read_fsf(fsf_file)
+
+	if subject in validation_subjects:
+		native_dir = os.path.join(subject_dir, 'Results', validation_name)
+		names = fit_subject(subject_dir, settings, native_dir)
+		mask = np.asanyarray(nb.load(os.path.join(subject_dir, mask_name)).dataobj) > 0
+		return compare_to_feat(native_dir, os.path.join(subject_dir, 'Results', output_name), names, mask)
+
+	fit_subject(subject_dir, settings, os.path.join(subject_dir, 'Results', output_name))
+	return []
+
+if __name__ == '__main__':
+
+	#Finds each subject directory for this pipeline.
+	subjects = sorted(subject for subject in os.listdir(studydir) if 'sub' in subject)
+	if validation_subjects:
+		subjects = [subject for subject in subjects if subject in validation_subjects]
+
+	#Subjects are distributed across the process pool. A message is printed as each one finishes.
+	validation_rows = []
+	count = 0
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		futures = {executor.submit(process_subject, os.path.join(studydir, subject)): subject for subject in subjects}
+		for future in as_completed(futures):
+			subject = futures[future]
+			count += 1
+			result = future.result()
+			if result is None:
+				print("No FSF file found for {}, the model has not been fitted.".format(subject))
+				continue
+			validation_rows += [dict(Subject=subject, **row) for row in result]
+			print("Model fitted for {}, {}/{}".format(subject, count, len(subjects)))
+
+	#If any subjects were validated, the comparison metrics are written out.
+	if validation_rows:
+		with open(validation_file, 'w', newline='') as output_file:
+			writer = csv.DictWriter(output_file, fieldnames=['Subject', 'Contrast', 'Correlation', 'Relative_RMS', 'Max_abs_diff', 'Dice'])
+			writer.writeheader()
+			for row in sorted(validation_rows, key=lambda row: (row['Subject'], row['Contrast'])):
+				writer.writerow(row)
@@ -4,6 +4,8 @@ import shutil
 import csv
 import nibabel as nb
 import numpy as np
+from Tracing import span, traced, each
+from BIDS_index import load_index
 
 #Defines the version of the pipeline being run
 pipeline = '0'
@@ -12,6 +14,7 @@ pipeline = '0'
 derivatives = '/<directory root>/fMRIPrep/Pipeline_{}/derivatives/'.format(pipeline) #Full path removed for purpose of public sharing.
 
 #A function to copy relevant files.
+@traced('copy')
 def copy_file(input_folder, input_file, output_folder, copy_name):
 	
 	#Firt, identifies the suffix (filetype) of the input file by finding the first instance of '.'
@@ -35,12 +38,14 @@ def copy_file(input_folder, input_file, output_folder, copy_name):
 #A counter for the number of subjects processed.
 sub_count = 0
 
-#Iterates through each subject in the derivatives directory.
-for subject_ID in sorted(os.listdir(derivatives)):
+#Loads the index of the derivatives directory, bringing it up to date (see BIDS_index.py). Files are found by querying
+#their BIDS entities in this index, rather than listing each folder and matching parts of file names.
+with span('index', pipeline=pipeline):
+	index = load_index(derivatives)
 
-	#Checks whether the given element within this directory actually corresponds to a subject. If not, it's skipped.
-	if 'sub' not in subject_ID or 'html' in subject_ID:
-		continue
+#Iterates through each subject folder in the derivatives directory.
+subjects = index.subjects()
+for subject_ID in each(subjects, 'subject', pipeline=pipeline):
 
 	#Prints out the subject ID and number of subjects who have been processed.
 	sub_count += 1
@@ -60,37 +65,26 @@ for subject_ID in sorted(os.listdir(derivatives)):
 		if not os.path.exists(subdirectories[sub]):
 			os.makedirs(subdirectories[sub])
 
-	#Defines the 'func' and 'anat' input directories as variables.
-	func_folder = os.path.join(derivatives, subject_ID, 'func')
-	anat_folder = os.path.join(derivatives, subject_ID, 'anat')
-
 	#A dictionary that will be used to store our motion nuisance regressor values. Each variable of
 	#interest includes an empty list as a value. Numbers will be appended below.
 	confound_dict = {'trans_x': [], 'trans_y': [], 'trans_z': [], 'rot_x': [], 'rot_y': [], 'rot_z': []}
 
-	#Iterates through each file in the functional directory.
-	for func_file in os.listdir(func_folder):						
-				
-		#Checks for the files that were interested in, including (a) the preprocessed bold file, 
-		#(b) a brain mask for this run, and (c) confounds relating to movement etc. Each file we're interested in will have
-		#a corresponding JSON file. Both will be identified with this loop/function and copied to the appropriate folder.
-		if 'preproc_bold' in func_file and 'res-2' in func_file:
-			copy_file(func_folder, func_file, 'functional', 'stopsignal_bold')
-
-		if 'brain_mask' in func_file and 'res-2' in func_file:
-			copy_file(func_folder, func_file, 'functional', 'stopsignal_mask')
-
-		if 'confounds' in func_file:
-			copy_file(func_folder, func_file, 'confounds', 'stopsignal_confounds')
+	#Finds the functional files that were interested in, including (a) the preprocessed bold file, (b) a brain mask for
+	#this run, and (c) confounds relating to movement etc. Each file we're interested in will have a corresponding JSON
+	#file. Both will be identified with this query and copied to the appropriate folder.
+	func_files = [({'desc': 'preproc', 'suffix': 'bold', 'res': '2'}, 'functional', 'stopsignal_bold'),
+		({'desc': 'brain', 'suffix': 'mask', 'res': '2'}, 'functional', 'stopsignal_mask'),
+		({'desc': 'confounds', 'suffix': 'timeseries'}, 'confounds', 'stopsignal_confounds')]
+	for entities, output_folder, copy_name in func_files:
+		for func_file in index.query(sub=subject_ID, datatype='func', **entities):
+			copy_file(os.path.dirname(func_file['path']), func_file['name'], output_folder, copy_name)
 
 			#This extra step for the confound TSV opens the file and pulls out the information that we're
 			#interested in, which is then added to the confounds ditctionary created above. Any 'n/a' values
 			#are entered as 0, others are kept in their original form.
-			if 'tsv' in func_file:
-			
-				confounds_file = os.path.join(func_folder, func_file)
-	
-				with open(confounds_file, 'r') as open_confounds:
+			if output_folder == 'confounds' and func_file['extension'] == '.tsv':
+
+				with span('read_confounds'), open(func_file['path'], 'r') as open_confounds:
 
 					confounds_reader = csv.DictReader(open_confounds, delimiter = '\t')
 
@@ -104,7 +98,7 @@ for subject_ID in sorted(os.listdir(derivatives)):
 
 	#Creates a text file that will be used to store motion confounds for input to FEAT. This file is opened to be written into.
 	confounds_file = os.path.join(subdirectories['EVs'], 'confounds.txt')
-	with open(confounds_file, 'w') as f:
+	with span('write_confounds'), open(confounds_file, 'w') as f:
 
 		#Iterates through the number of rows in the first confound (number of volumes)
 		for i in range(len(confound_dict['trans_x'])):
@@ -118,13 +112,10 @@ for subject_ID in sorted(os.listdir(derivatives)):
 			f.write(volume_string + '\n')
 		
 	#The same process as above is used to copy structural files.
-	for anat_file in os.listdir(anat_folder):
-
-		if 'preproc_T1w' in anat_file and 'res-2' in anat_file:
-			copy_file(anat_folder, anat_file, 'structural', 'T1w')
-
-		if 'brain_mask' in anat_file and 'res-2' in anat_file:
-			copy_file(anat_folder, anat_file, 'structural', 'T1w_brain')
+	anat_files = [({'desc': 'preproc', 'suffix': 'T1w'}, 'T1w'), ({'desc': 'brain', 'suffix': 'mask'}, 'T1w_brain')]
+	for entities, copy_name in anat_files:
+		for anat_file in index.query(sub=subject_ID, datatype='anat', res='2', **entities):
+			copy_file(os.path.dirname(anat_file['path']), anat_file['name'], 'structural', copy_name)
 
 	#A variable is created to correspond to the location of this participant's EV files.
 	EV_data = '/<directory root>/EVs/{}'.format(subject_ID) #Full path removed for purpose of public sharing.
@@ -1,7 +1,14 @@
 #Imports relevant modules
 import os
+import sys
 import nibabel as nb
 import numpy as np
+from Group_accumulator import Accumulator
+
+#The shared tracing functions and NIFTI writer are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tracing import span, traced, each
+from Nifti_writer import save
 
 #Defines the pipeline ID.
 pipeline = '0'
@@ -9,45 +16,60 @@ pipeline = '0'
 #Defines the path in which FEAT output is stored for this pipeline.
 pipeline_dir = '/<directory root>/FEAT/Pipeline_{}'.format(pipeline) #Full path removed for purpose of public sharing.
 
-#Creates an empty list to store subjects' data.
-stats_list = []
+#Defines the name of the output file to be created.
+output_file = '/<directory root>//Sustainability_Output/Activation_SD_Map/P{}_Activation_SD_Map.nii.gz'.format(pipeline)
+
+#Defines the directory holding the accumulator for this pipeline (see Group_accumulator.py), which keeps the sum and
+#sum of squares of z-stats at each voxel. On each run, only subjects that are new or whose zstat file has changed are
+#read, and subjects without a folder are removed.
+accumulator_dir = os.path.join(os.path.dirname(output_file), 'Accumulators', 'P{}_Activation_SD'.format(pipeline))
+
+#The subjects to include (all if empty), e.g. to build a partial accumulator on one node to be merged later.
+only_subjects = []
+
+#A function to find a subject's contribution: their z-stats and squared z-stats. Returns this along with the loaded
+#file, which provides the affine and header for the output.
+@traced('read_zstat')
+def stats_contribution(files):
+	stats_load = nb.load(files[0])
+	stats_matrix = stats_load.get_fdata()
+	return {'sum': stats_matrix, 'sum_squares': stats_matrix ** 2}, stats_load
 
-#Iterates over each subject, skipping any folders that don't correspond to a subject.
-for subject in sorted(os.listdir(pipeline_dir)):
+#Loads the accumulator, and removes any subjects that are no longer present.
+subjects = [subject for subject in sorted(os.listdir(pipeline_dir)) if 'sub' in subject and (not only_subjects or subject in only_subjects)]
+accumulator = Accumulator(accumulator_dir)
+for subject in accumulator.prune(subjects):
+	print("Removed {}".format(subject))
 
-	if 'sub' not in subject:
-		continue
+#Iterates over each subject.
+for subject in each(subjects, 'subject', pipeline=pipeline):
 
 	#Defines the path in which statistical results can be found for this subject.
-	stats_path = os.path.join(pipeline_dir, subject, 'Results', '.feat', 'stats')	
-		
-	#Finds one of the stats file, and opens it (we only use zstat1 as zstat 2 is a perfect inverse).
+	stats_path = os.path.join(pipeline_dir, subject, 'Results', '.feat', 'stats')
+
+	#Finds one of the stats file, and brings the subject up to date in the accumulator (we only use zstat1 as zstat 2 is a perfect inverse).
 	stats_file = os.path.join(stats_path, 'zstat1.nii.gz')
-	stats_load = nb.load(stats_file)
-	stats_matrix = stats_load.get_fdata()
+	status = accumulator.update(subject, [stats_file], stats_contribution)
 
-	#Adds a matrix containing all z-stats for this subject to the above list.
-	stats_list.append(stats_matrix)
-	
 	#Prints that processing is finished for this subject.
-	print("Finished {}".format(subject))
+	print("Finished {} ({})".format(subject, status))
+
+with span('save_accumulator'):
+	accumulator.save()
 
 #Prints that group level map is now generating.
 print("Generating group map...")
 
-#Stacks the subjects' matrices, providing a 4D matrix.
-stacked_stats = np.stack(stats_list, axis = -1)
-
-#Caclulates the standard deviation of z-stats at each voxel across this 4th dimension (subject)
-stats_sd = np.std(stacked_stats, axis = -1)
-
-#Defines the name of the output file to be created.
-output_file = '/<directory root>//Sustainability_Output/Activation_SD_Map/P{}_Activation_SD_Map.nii.gz'.format(pipeline)
+#Caclulates the standard deviation of z-stats at each voxel across subjects from the mean and mean of squares (with n as
+#the denominator, as with np.std).
+mean = accumulator.mean('sum')
+stats_sd = np.sqrt(np.maximum(accumulator.mean('sum_squares') - mean ** 2, 0))
 
 #Updates header information for this file.
-header = stats_load.header.copy()
+header = accumulator.header.copy()
 header.set_data_shape(stats_sd.shape)
 
 #Names the resulting file, and saves it out.
-SD_file = nb.Nifti1Image(stats_sd, stats_load.affine, header)
-nb.save(SD_file, output_file)
+SD_file = nb.Nifti1Image(stats_sd, accumulator.affine, header)
+with span('write_map'):
+	save(SD_file, output_file, 'map')
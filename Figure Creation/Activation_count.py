@@ -1,7 +1,14 @@
 #Imports relevant modules.
 import os
+import sys
 import nibabel as nb
 import numpy as np
+from Group_accumulator import Accumulator
+
+#The shared tracing functions and NIFTI writer are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tracing import span, traced, each
+from Nifti_writer import save
 
 #Defines the pipeline that we want to generate the activation count map for. This will need to be updated each time.
 pipeline = '0'
@@ -14,45 +21,44 @@ output_dir = '/<directory root>/Activation_Count/Pipeline_{}/'.format(pipeline)
 if not os.path.isdir(output_dir):
 	os.makedirs(output_dir)
 
+#Defines the directory holding an accumulator for each contrast (see Group_accumulator.py). On each run, only subjects
+#that are new or whose thresholded zstat file has changed are read, and subjects without a folder are removed.
+accumulator_dir = os.path.join(output_dir, 'Accumulators')
+
+#The subjects to include (all if empty), e.g. to build a partial accumulator on one node to be merged later.
+only_subjects = []
+
 #Creates a dictionary with contrasts of interest as keys and the corresponding zstat number as values.
 contrasts = {'go': '1', 'stop': '2'}
 
-#Iterates over each of our contrast.
-for contrast in contrasts:
+#A function to find a subject's contribution to the activation count: '1' in each voxel above 0 in the thresholded
+#zstat file. Returns this along with the loaded file, which provides the affine and header for the output.
+@traced('read_zstat')
+def count_contribution(files):
+	contrast_load = nb.load(files[0])
+	return {'count': np.asanyarray(contrast_load.dataobj) > 0}, contrast_load
 
-	#Creates a 'None' item that will soon be populated with an output array.
-	count = None
-	
-	#Creates a variable to keep track of the number of subjects for this pipeline.
-	subject_num = 0
+#Finds the subjects for this pipeline, ignoring any folders that don't correspond to a specific subject.
+subjects = [subject for subject in sorted(os.listdir(pipeline_dir)) if 'sub' in subject and (not only_subjects or subject in only_subjects)]
 
-	#Iterates over each subject for this pipeline.
-	for subject in sorted(os.listdir(pipeline_dir)):
+#Iterates over each of our contrast.
+for contrast in contrasts:
 
-		#Ignores a given folder if it doesn't correspond to a specific subject. If it does, logs an additional subject in the total number.
-		if 'sub' not in subject:
-			continue
-		else:
-			subject_num += 1
+	#Loads the accumulator for this contrast, and removes any subjects that are no longer present.
+	accumulator = Accumulator(os.path.join(accumulator_dir, contrast))
+	for subject in accumulator.prune(subjects):
+		print("Removed {} for {}.".format(subject, contrast))
 
-		#The relevant thresholded zstat file for this contrast is located, loaded, and opened.
+	#Brings each subject up to date, using their thresholded zstat file for this contrast.
+	for subject_num, subject in enumerate(each(subjects, 'subject', pipeline=pipeline, contrast=contrast), 1):
 		contrast_file = os.path.join(pipeline_dir, subject, 'Results', '.feat', 'thresh_zstat{}.nii.gz'.format(contrasts[contrast]))
-		contrast_load = nb.load(contrast_file)
-		contrast_thr = contrast_load.get_fdata()
-	
-		#For the first subject being iterated over, the None type is replaced with an array with the shape of the input zstat file encountered here.
-		if subject_num == 1:
-			count = np.zeros(contrast_thr.shape)
-
-		#Iterates through each voxel in our output array. If the respective voxel of the input file is above 0, '1' is added to this voxel location.
-		for idx in np.ndindex(contrast_thr.shape):
-			if contrast_thr[idx] > 0:
-				count[idx] += 1
-
-		print("Finished {} for {}, {} subjects processed.".format(subject, contrast, subject_num))
+		status = accumulator.update(subject, [contrast_file], count_contribution)
+		print("{} {} for {}, {} subjects processed.".format(status, subject, contrast, subject_num))
+	with span('save_accumulator', contrast=contrast):
+		accumulator.save()
 
 	#After the activation count array is complete, we generate a version that reflects the percent of the sample showing activation in each voxel.
-	percent = count / subject_num * 100
+	percent = accumulator.mean('count') * 100
 
 	#A version of this array is created which is thresholded at voxels active in 5%+ of participants.
 	percent_thr = percent.copy()
@@ -60,10 +66,12 @@ for contrast in contrasts:
 
 	#Defines a path for the output file path, turns it into a NIFTI image, and then saves it.
 	percent_file = os.path.join(output_dir, 'Activation_count_P{}_{}.nii.gz'.format(pipeline, contrast))
-	percent_img = nb.Nifti1Image(percent, contrast_load.affine, contrast_load.header)
-	nb.save(percent_img, percent_file)
+	percent_img = nb.Nifti1Image(percent, accumulator.affine, accumulator.header)
+	with span('write_map', contrast=contrast):
+		save(percent_img, percent_file, 'map')
 
 	#This process is repeated for the thresholded version of the output array.
 	percent_thr_file = os.path.join(output_dir, 'Activation_count_P{}_{}_thr5.nii.gz'.format(pipeline, contrast))
-	percent_thr_img = nb.Nifti1Image(percent_thr, contrast_load.affine, contrast_load.header)
-	nb.save(percent_thr_img, percent_thr_file)
+	percent_thr_img = nb.Nifti1Image(percent_thr, accumulator.affine, accumulator.header)
+	with span('write_map', contrast=contrast):
+		save(percent_thr_img, percent_thr_file, 'map')
@@ -0,0 +1,158 @@
+#Imports relevant modules.
+import os
+import csv
+import sys
+import nibabel as nb
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+#The shared tracing, BIDS index and NIFTI writer functions are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tracing import span, traced
+from BIDS_index import load_index
+from Nifti_writer import save
+
+#Calculates several quality control measures for each preprocessed BOLD run in a single pass, reading one volume at a
+#time: voxelwise mean, standard deviation (SD) and temporal signal-to-noise ratio (tSNR) maps, a DVARS time series, and
+#global signal statistics. Framewise displacement (FD) is taken from fMRIPrep's confounds file.
+
+#Defines the pipelines to run quality control for.
+pipelines = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+
+#Defines the directory containing fMRIPrep output for each pipeline.
+fmriprep_dir = '/<directory root>/fMRIPrep' #Full path removed for purpose of public sharing.
+
+#Defines the output directory for the group maps and tables. If this directory doesn't exist, it's created.
+output_dir = '/<directory root>/Sustainability_Output/BOLD_QC' #Full path removed for purpose of public sharing.
+
+#Volumes with FD above this value (mm) are counted as high motion, and the number of worker processes used.
+fd_threshold = 0.5
+n_workers = 8
+
+#The per-subject measures written to the table.
+fieldnames = ['Pipeline', 'Subject', 'Volumes', 'Voxels', 'Mean', 'SD', 'tSNR_mean', 'tSNR_median', 'DVARS_mean', 'DVARS_max',
+	'Global_mean', 'Global_SD', 'FD_mean', 'FD_max', 'FD_over_threshold']
+
+#A function to find the functional files for a subject, from the index of their pipeline's derivatives folder (see
+#BIDS_index.py). The resolution of the volumetric output space is found from the subject's functional files in that
+#space, using the same rule as Timeseries_SD_Map.py (2mm if there is one). Returns the BOLD run, brain mask, and
+#confounds file.
+def subject_files(index, subject):
+	resolutions = index.values('res', sub=subject, datatype='func', space='MNI152NLin6Asym')
+	resolution = '2' if '2' in resolutions else '1'
+	func = {'sub': subject, 'datatype': 'func', 'task': 'stopsignal'}
+	return (index.get(space='MNI152NLin6Asym', res=resolution, desc='preproc', suffix='bold', extension='.nii.gz', **func),
+		index.get(space='MNI152NLin6Asym', res=resolution, desc='brain', suffix='mask', extension='.nii.gz', **func),
+		index.get(desc='confounds', suffix='timeseries', extension='.tsv', **func))
+
+#A function to read FD from a confounds file. The first value is 'n/a' (there's no previous volume), and is dropped.
+def read_fd(confounds_file):
+	with open(confounds_file, newline='') as f:
+		values = [row['framewise_displacement'] for row in csv.DictReader(f, delimiter='\t')]
+	return np.array([float(value) for value in values if value not in ('n/a', '')])
+
+#A function to calculate every measure for one subject. Volumes are read one at a time (in order, so the compressed
+#file is only read once), keeping running sums and sums of squares for each voxel within the brain mask, and the
+#difference from the previous volume for DVARS. Returns the subject's row for the table, the DVARS time series, and the
+#mean, SD and tSNR maps within the mask.
+@traced('subject', subject_arg='subject')
+def process_subject(files, pipeline, subject):
+	bold_file, mask_file, confounds_file = files
+	mask = np.asanyarray(nb.load(mask_file).dataobj) > 0
+	bold = nb.load(bold_file, keep_file_open=True)
+	n_vols = bold.shape[3]
+
+	total = np.zeros(mask.sum())
+	total_squares = np.zeros(mask.sum())
+	global_signal = np.empty(n_vols)
+	dvars = np.empty(n_vols - 1)
+	previous = None
+	with span('read_bold'):
+		for t in range(n_vols):
+			volume = np.asanyarray(bold.dataobj[..., t], dtype=np.float64)[mask]
+			total += volume
+			total_squares += volume ** 2
+			global_signal[t] = volume.mean()
+			if previous is not None:
+				dvars[t - 1] = np.sqrt(np.mean((volume - previous) ** 2))
+			previous = volume
+
+	#The SD uses n (not n - 1) as its denominator, as with np.std in Timeseries_SD_Map.py.
+	mean = total / n_vols
+	sd = np.sqrt(np.maximum(total_squares / n_vols - mean ** 2, 0))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		tsnr = np.where(sd > 0, mean / sd, 0)
+	fd = read_fd(confounds_file)
+
+	row = {'Pipeline': pipeline,
+		'Subject': subject,
+		'Volumes': n_vols,
+		'Voxels': int(mask.sum()),
+		'Mean': mean.mean(),
+		'SD': sd.mean(),
+		'tSNR_mean': tsnr.mean(),
+		'tSNR_median': np.median(tsnr),
+		'DVARS_mean': dvars.mean(),
+		'DVARS_max': dvars.max(),
+		'Global_mean': global_signal.mean(),
+		'Global_SD': global_signal.std(),
+		'FD_mean': fd.mean(),
+		'FD_max': fd.max(),
+		'FD_over_threshold': int((fd > fd_threshold).sum())}
+	return row, dvars, mask, {'mean': mean, 'sd': sd, 'tsnr': tsnr}
+
+if __name__ == '__main__':
+
+	if not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+
+	rows = []
+	for pipeline in pipelines:
+		derivatives_dir = os.path.join(fmriprep_dir, 'Pipeline_{}'.format(pipeline), 'derivatives')
+		with span('index', pipeline=pipeline):
+			index = load_index(derivatives_dir)
+		subjects = index.subjects()
+		if not subjects:
+			print("No subjects found for pipeline {}, skipping.".format(pipeline))
+			continue
+
+		#Subjects are spread across a pool of worker processes. Each subject's maps are added to the group sums as soon
+		#as they're returned, along with the number of subjects whose mask includes each voxel.
+		sums = None
+		count = None
+		dvars_rows = []
+		with ProcessPoolExecutor(max_workers=n_workers) as executor:
+			futures = [executor.submit(process_subject, subject_files(index, subject), pipeline, subject) for subject in subjects]
+			for done, future in enumerate(as_completed(futures), 1):
+				row, dvars, mask, maps = future.result()
+				if sums is None:
+					sums = {name: np.zeros(mask.shape) for name in maps}
+					count = np.zeros(mask.shape)
+				for name, values in maps.items():
+					sums[name][mask] += values
+				count[mask] += 1
+				rows.append(row)
+				dvars_rows.append([row['Subject']] + list(dvars))
+				print("Finished {} for Pipeline {}, {}/{} subjects.".format(row['Subject'], pipeline, done, len(subjects)))
+
+		#Saves the group maps for this pipeline: the mean of each map across the subjects whose mask includes each voxel.
+		#The first subject's BOLD run is used as a reference for the affine and header.
+		reference = nb.load(subject_files(index, subjects[0])[0])
+		header = reference.header.copy()
+		header.set_data_shape(count.shape)
+		header.set_data_dtype(np.float32)
+		for name, total in sums.items():
+			with np.errstate(invalid='ignore'):
+				group_map = np.nan_to_num(total / count).astype(np.float32)
+			with span('write_map', pipeline=pipeline):
+				save(nb.Nifti1Image(group_map, reference.affine, header), os.path.join(output_dir, 'P{}_{}_map.nii.gz'.format(pipeline, name)), 'map')
+
+		#Writes the DVARS time series for every subject in this pipeline, one row per subject.
+		with open(os.path.join(output_dir, 'P{}_DVARS.csv'.format(pipeline)), 'w', newline = '') as output:
+			csv.writer(output).writerows(sorted(dvars_rows))
+
+	#Writes the per-subject measures for every pipeline into one table.
+	with open(os.path.join(output_dir, 'BOLD_QC.csv'), 'w', newline = '') as output:
+		writer = csv.DictWriter(output, fieldnames = fieldnames)
+		writer.writeheader()
+		writer.writerows(sorted(rows, key=lambda row: (row['Pipeline'], row['Subject'])))
@@ -0,0 +1,217 @@
+#Imports relevant modules.
+import os
+import json
+import shutil
+import hashlib
+import nibabel as nb
+import numpy as np
+
+#Persisted group accumulators for the group maps in this folder (Activation_count.py, Activation_SD_Map.py and
+#Timeseries_SD_Map.py). Each accumulator is a directory holding the running totals for a map (e.g. counts, sums and
+#sums of squares), the subjects included with a fingerprint of their input files, and each subject's contribution to
+#the totals. This means subjects can be added, removed, or replaced when their input changes, without a full pass over
+#every subject, and that accumulators built on different nodes can be merged.
+
+#Totals are stored as fixed-point integers with this many fractional bits, so that adding, removing and merging
+#subjects gives exactly the same totals whatever the order. At 24 bits values are kept to within 6e-8.
+fraction_bits = 24
+
+#When run directly, merges the accumulators listed here (e.g. partial accumulators built on different nodes) into the
+#accumulator in 'merged_dir'.
+merge_dirs = []
+merged_dir = '/<directory root>/Sustainability_Output/Accumulators' #Full path removed for purpose of public sharing.
+
+#A function to convert values to fixed-point integers.
+def to_fixed(values):
+	return np.rint(np.asarray(values, dtype=np.float64) * 2.0 ** fraction_bits).astype(np.int64)
+
+#A function to store values in the smallest of these types that holds them exactly (e.g. uint8 for counts, float32 for
+#values read from most NIFTI files), so that each subject's contribution takes little space without compression.
+def compact(values):
+	for dtype in [np.uint8, np.float32]:
+		if np.array_equal(values.astype(dtype), values):
+			return values.astype(dtype)
+	return values.astype(np.float64)
+
+#A function to fingerprint a subject's input files, with the size, modification time and SHA-256 hash of each. If the
+#subject's previous fingerprint is given, files with the same size and modification time keep their previous hash
+#rather than being read again.
+def fingerprint(files, previous=None):
+	result = {}
+	for path in files:
+		name = os.path.basename(path)
+		stat = os.stat(path)
+		old = (previous or {}).get(name)
+		if old and old['size'] == stat.st_size and old['mtime_ns'] == stat.st_mtime_ns:
+			result[name] = old
+			continue
+		digest = hashlib.sha256()
+		with open(path, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''):
+				digest.update(block)
+		result[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+	return result
+
+#A function to check whether two fingerprints have the same content (the same files, with the same hashes).
+def same_content(first, second):
+	return {name: file['sha256'] for name, file in first.items()} == {name: file['sha256'] for name, file in second.items()}
+
+#A class holding one accumulator. It's loaded from its directory if this exists, and only written back by save().
+class Accumulator:
+
+	def __init__(self, path):
+		self.path = path
+		self.totals = {}
+		self.subjects = {}
+		self.affine = None
+		self.header = None
+		self.removed = set()
+		accumulator_file = os.path.join(path, 'accumulator.npz')
+		if os.path.exists(accumulator_file):
+			with np.load(accumulator_file) as data:
+				self.subjects = json.loads(str(data['subjects']))
+				self.totals = {name[len('total_'):]: data[name] for name in data.files if name.startswith('total_')}
+				if 'affine' in data.files:
+					self.affine = data['affine']
+					self.header = nb.Nifti1Header(data['header'].tobytes())
+
+	#The number of subjects included.
+	@property
+	def n(self):
+		return len(self.subjects)
+
+	#The file holding a subject's contribution. The name includes a hash of the subject's fingerprint, so that replacing
+	#a subject never overwrites the contribution the saved totals still refer to.
+	def contribution_file(self, subject, subject_fingerprint=None):
+		files = subject_fingerprint or self.subjects[subject]
+		key = hashlib.sha256(''.join(files[name]['sha256'] for name in sorted(files)).encode()).hexdigest()[:12]
+		return os.path.join(self.path, 'subjects', '{}_{}.npz'.format(subject, key))
+
+	#Adds a subject, given the fingerprint of their input files and their contribution as a dictionary of arrays, each
+	#added to the total of the same name. The first subject's image (if given) provides the affine and header for output.
+	#Each contribution is stored as its values where it's non-zero (usually a fraction of the volume), and converted to
+	#fixed-point again when loaded, which gives exactly the same integers.
+	def add(self, subject, subject_fingerprint, contribution, reference=None):
+		if subject in self.subjects:
+			raise ValueError("{} is already in the accumulator at {}".format(subject, self.path))
+		stored = {}
+		for name, values in contribution.items():
+			values = np.asarray(values, dtype=np.float64)
+			fixed = to_fixed(values)
+			if name in self.totals:
+				self.totals[name] += fixed
+			else:
+				self.totals[name] = fixed.copy()
+			nonzero = values != 0
+			stored[name + '_shape'] = np.array(values.shape)
+			stored[name + '_nonzero'] = np.packbits(nonzero)
+			stored[name + '_values'] = compact(values[nonzero])
+		if self.affine is None and reference is not None:
+			self.affine = reference.affine
+			self.header = reference.header.copy()
+
+		os.makedirs(os.path.join(self.path, 'subjects'), exist_ok=True)
+		np.savez(self.contribution_file(subject, subject_fingerprint), **stored)
+		self.subjects[subject] = subject_fingerprint
+
+	#Loads a subject's contribution, as fixed-point arrays.
+	def load_contribution(self, subject):
+		contribution = {}
+		with np.load(self.contribution_file(subject)) as data:
+			for name in [name[:-len('_shape')] for name in data.files if name.endswith('_shape')]:
+				shape = tuple(data[name + '_shape'])
+				nonzero = np.unpackbits(data[name + '_nonzero'], count=int(np.prod(shape))).astype(bool).reshape(shape)
+				values = np.zeros(shape, dtype=np.int64)
+				values[nonzero] = to_fixed(data[name + '_values'])
+				contribution[name] = values
+		return contribution
+
+	#Removes a subject, subtracting their stored contribution from the totals. Their contribution file is deleted when
+	#the accumulator is saved.
+	def remove(self, subject):
+		for name, values in self.load_contribution(subject).items():
+			self.totals[name] -= values
+		self.removed.add(self.contribution_file(subject))
+		del self.subjects[subject]
+
+	#Brings a subject up to date with their input files. If the subject is new, or their files have changed since they
+	#were added, 'compute' is called with the files to find their contribution (returning the contribution and a
+	#reference image), and the subject is added or replaced. Returns 'Added', 'Replaced' or 'Unchanged'.
+	def update(self, subject, files, compute):
+		previous = self.subjects.get(subject)
+		current = fingerprint(files, previous)
+		if previous is not None and same_content(previous, current):
+			self.subjects[subject] = current
+			return 'Unchanged'
+		contribution, reference = compute(files)
+		if previous is not None:
+			self.remove(subject)
+		self.add(subject, current, contribution, reference)
+		return 'Added' if previous is None else 'Replaced'
+
+	#Removes every subject not in the given list. Returns the subjects removed.
+	def prune(self, subjects):
+		stale = sorted(set(self.subjects) - set(subjects))
+		for subject in stale:
+			self.remove(subject)
+		return stale
+
+	#Merges another accumulator (e.g. built on another node) into this one. Subjects in both must have the same input
+	#files, and are only counted once: their contribution is subtracted from the other accumulator's totals first.
+	def merge(self, other):
+		totals = {name: values.copy() for name, values in other.totals.items()}
+		for subject, subject_fingerprint in other.subjects.items():
+			if subject in self.subjects:
+				if not same_content(self.subjects[subject], subject_fingerprint):
+					raise ValueError("{} has different input files in {} and {}".format(subject, self.path, other.path))
+				for name, values in other.load_contribution(subject).items():
+					totals[name] -= values
+			else:
+				os.makedirs(os.path.join(self.path, 'subjects'), exist_ok=True)
+				shutil.copyfile(other.contribution_file(subject), self.contribution_file(subject, subject_fingerprint))
+				self.subjects[subject] = subject_fingerprint
+		for name, values in totals.items():
+			if name in self.totals:
+				self.totals[name] += values
+			else:
+				self.totals[name] = values
+		if self.affine is None:
+			self.affine, self.header = other.affine, other.header
+
+	#The total of the given name across subjects.
+	def total(self, name):
+		return self.totals[name] / 2.0 ** fraction_bits
+
+	#The mean of the given name across subjects.
+	def mean(self, name):
+		return self.total(name) / self.n
+
+	#Writes the accumulator to its directory. The totals are written to a temporary file that then replaces the old one,
+	#so an interrupted run leaves the previous accumulator intact. Old contributions of removed or replaced subjects are
+	#then deleted.
+	def save(self):
+		os.makedirs(self.path, exist_ok=True)
+		arrays = {'total_' + name: values for name, values in self.totals.items()}
+		arrays['subjects'] = np.array(json.dumps(self.subjects))
+		if self.affine is not None:
+			arrays['affine'] = self.affine
+			arrays['header'] = np.frombuffer(self.header.binaryblock, dtype=np.uint8)
+		temporary = os.path.join(self.path, 'accumulator.tmp.npz')
+		np.savez(temporary, **arrays)
+		os.replace(temporary, os.path.join(self.path, 'accumulator.npz'))
+
+		current = {self.contribution_file(subject) for subject in self.subjects}
+		for contribution_file in self.removed - current:
+			if os.path.exists(contribution_file):
+				os.remove(contribution_file)
+		self.removed.clear()
+
+if __name__ == '__main__':
+
+	merged = Accumulator(merged_dir)
+	for merge_dir in merge_dirs:
+		other = Accumulator(merge_dir)
+		merged.merge(other)
+		print("Merged {} subject(s) from {}.".format(other.n, merge_dir))
+	merged.save()
+	print("{} now holds {} subject(s).".format(merged_dir, merged.n))
@@ -1,7 +1,12 @@
 #Imports relevant modules
 import os
+import sys
 import shutil
 
+#The shared tracing functions are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tracing import span
+
 #Defines the pipline ID as a variable. WIll need to be updated.
 pipeline = '0'
 
@@ -18,6 +23,7 @@ contrasts = {'Go': '1', 'Stop': '2'}
 
 #For each contrast, defines the specific input and output filepaths for each contrast, then copies the file over.
 for contrast in contrasts:
-	in_path =  os.path.join(in_dir, 'cope{}.feat'.format(contrasts[contrast]), 'thresh_zstat1.nii.gz')
-	out_path = os.path.join(out_dir, '{}_Group_P{}.nii.gz'.format(contrast, pipeline))
-	shutil.copyfile(in_path, out_path)
+	with span('copy', pipeline=pipeline, contrast=contrast):
+		in_path =  os.path.join(in_dir, 'cope{}.feat'.format(contrasts[contrast]), 'thresh_zstat1.nii.gz')
+		out_path = os.path.join(out_dir, '{}_Group_P{}.nii.gz'.format(contrast, pipeline))
+		shutil.copyfile(in_path, out_path)
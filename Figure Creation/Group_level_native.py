@@ -0,0 +1,206 @@
+#Imports relevant modules.
+import os
+import sys
+import csv
+import nibabel as nb
+import numpy as np
+from scipy import special, stats
+from concurrent.futures import ThreadPoolExecutor
+
+#The shared NIFTI writer, cluster thresholding and tracing functions are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tracing import span
+from Nifti_writer import save
+from Cluster_threshold import estimate_smoothness, cluster_threshold, write_cluster_table, write_smoothness, z_threshold
+
+#An in-process alternative to the group-level FEAT analysis (Group_template.fsf) and Group_level_extract.py, for every
+#pipeline and contrast in one run. Each subject's first-level copes and varcopes are read directly (every subject is
+#already in the same standard space, so no registration is needed), and a one-sample group mean is fitted in chunks of
+#voxels with two models: ordinary least squares, and a mixed-effects model in the spirit of FLAME 1, where each
+#subject is weighted by the inverse of their own variance (varcope) plus a between-subject variance estimated at each
+#voxel. Each z-statistic map can be cluster-thresholded, and the thresholded map for each contrast is written where
+#Group_level_extract.py would put it.
+
+#Defines the pipelines analysed, and the contrasts of interest with their cope numbers.
+pipelines = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+contrasts = {'Go': '1', 'Stop': '2'}
+
+#Defines the directory holding each pipeline's FEAT output, the directory the group-level output for each pipeline is
+#written to, and the directory the thresholded maps are copied to (as by Group_level_extract.py).
+feat_dir = '/<directory root>/FEAT/' #Full path removed for purpose of public sharing.
+group_dir = '/<directory root>/Group_Level/' #Full path removed for purpose of public sharing.
+out_dir = '/<directory root>/Sustainability_Output/Group_Level/' #Full path removed for purpose of public sharing.
+
+#The name of the native output folder within each pipeline's group-level folder, and the summary file written across
+#every pipeline, contrast and model.
+native_name = 'Native'
+summary_file = os.path.join(out_dir, 'Group_level_native_summary.csv')
+
+#The models fitted, and the model whose map is copied to the output directory. Cluster thresholding (Z > 3.1, cluster
+#p < 0.05, see Cluster_threshold.py) can be switched off, in which case the unthresholded z-statistic map is copied.
+models = ['ols', 'flame1']
+extracted_model = 'flame1'
+cluster_thresholding = True
+
+#The number of iterations used to estimate the between-subject variance, the number of voxels fitted together in each
+#chunk, and the number of threads used to read subjects' images.
+reml_iterations = 50
+chunk_size = 20000
+n_threads = 16
+
+#A function to convert t-statistics to z-statistics with the same p-value. The upper tail is found on the log scale, so
+#that very large t-statistics don't become infinite.
+def t_to_z(t, dof):
+	return np.sign(t) * -special.ndtri_exp(stats.t.logsf(np.abs(t), dof))
+
+#A function to find the first-level output folder of each subject in a pipeline that has a mask.
+def find_subjects(pipeline):
+	pipeline_dir = os.path.join(feat_dir, 'Pipeline_{}'.format(pipeline))
+	subjects = []
+	if not os.path.isdir(pipeline_dir):
+		return subjects
+	for subject in sorted(os.listdir(pipeline_dir)):
+		stats_dir = os.path.join(pipeline_dir, subject, 'Results', '.feat')
+		if 'sub' in subject and os.path.exists(os.path.join(stats_dir, 'mask.nii.gz')):
+			subjects.append((subject, stats_dir))
+	return subjects
+
+#A function to read one subject's copes and varcopes for every contrast, within the group mask. Returns an array of
+#(contrasts x 2 x voxels).
+def read_subject(stats_dir, mask):
+	images = []
+	for number in contrasts.values():
+		for image in ['cope', 'varcope']:
+			images.append(np.asanyarray(nb.load(os.path.join(stats_dir, 'stats', '{}{}.nii.gz'.format(image, number))).dataobj, dtype=np.float32)[mask])
+	return np.array(images).reshape(len(contrasts), 2, -1)
+
+#A function to fit the one-sample OLS model to a chunk of copes (subjects x voxels). Returns the group cope and
+#varcope, and the residuals.
+def fit_ols(copes):
+	n_subjects = len(copes)
+	cope = copes.mean(axis=0)
+	residuals = copes - cope
+	return cope, (residuals ** 2).sum(axis=0) / (n_subjects - 1) / n_subjects, residuals
+
+#A function to fit the one-sample mixed-effects model to a chunk of copes and varcopes (subjects x voxels). The
+#between-subject variance is estimated at each voxel by restricted maximum likelihood, starting from the
+#DerSimonian-Laird (method of moments) estimate and updated for a fixed number of iterations, for every voxel at once.
+#Each subject is then weighted by the inverse of their total variance. Returns the group cope and varcope, the
+#between-subject variance, and the residuals.
+def fit_flame1(copes, varcopes):
+	n_subjects = len(copes)
+	varcopes = np.maximum(varcopes, 1e-12)
+	weights = 1 / varcopes
+	fixed = (weights * copes).sum(axis=0) / weights.sum(axis=0)
+	q = (weights * (copes - fixed) ** 2).sum(axis=0)
+	scale = weights.sum(axis=0) - (weights ** 2).sum(axis=0) / weights.sum(axis=0)
+	between = np.maximum((q - (n_subjects - 1)) / scale, 0)
+	for _ in range(reml_iterations):
+		weights = 1 / (varcopes + between)
+		cope = (weights * copes).sum(axis=0) / weights.sum(axis=0)
+		between = np.maximum(((weights ** 2) * ((copes - cope) ** 2 - varcopes)).sum(axis=0) / (weights ** 2).sum(axis=0) + 1 / weights.sum(axis=0), 0)
+	weights = 1 / (varcopes + between)
+	cope = (weights * copes).sum(axis=0) / weights.sum(axis=0)
+	return cope, 1 / weights.sum(axis=0), between, copes - cope
+
+#A function to fit both models for one contrast, chunk by chunk. Returns a dictionary of maps (as in-mask values) for
+#each model, and each model's residuals (subjects x voxels) for estimating smoothness.
+def fit_contrast(copes, varcopes):
+	n_voxels = copes.shape[1]
+	maps = {model: {name: np.zeros(n_voxels, dtype=np.float32) for name in ['cope', 'varcope', 'tstat', 'zstat', 'mean_random_effects_var']} for model in models}
+	residuals = {model: np.zeros(copes.shape, dtype=np.float32) for model in models}
+	dof = len(copes) - 1
+	for start in range(0, n_voxels, chunk_size):
+		chunk = slice(start, start + chunk_size)
+		chunk_copes = copes[:, chunk].astype(np.float64)
+		for model in models:
+			if model == 'ols':
+				cope, varcope, residuals[model][:, chunk] = fit_ols(chunk_copes)
+			else:
+				cope, varcope, maps[model]['mean_random_effects_var'][chunk], residuals[model][:, chunk] = fit_flame1(chunk_copes, varcopes[:, chunk].astype(np.float64))
+			with np.errstate(divide='ignore', invalid='ignore'):
+				tstat = np.where(varcope > 0, cope / np.sqrt(varcope), 0)
+			maps[model]['cope'][chunk], maps[model]['varcope'][chunk], maps[model]['tstat'][chunk] = cope, varcope, tstat
+			maps[model]['zstat'][chunk] = t_to_z(tstat, dof)
+	return maps, residuals
+
+if __name__ == '__main__':
+
+	summary = []
+	for pipeline in pipelines:
+
+		#Finds each subject, and builds the group mask from the voxels inside every subject's first-level mask.
+		subjects = find_subjects(pipeline)
+		if len(subjects) < 2:
+			print("Fewer than two subjects with first-level output for pipeline {}, skipping.".format(pipeline))
+			continue
+		with span('mask', pipeline=pipeline):
+			mask_load = nb.load(os.path.join(subjects[0][1], 'mask.nii.gz'))
+			mask = np.ones(mask_load.shape, dtype=bool)
+			for subject, stats_dir in subjects:
+				subject_mask = np.asanyarray(nb.load(os.path.join(stats_dir, 'mask.nii.gz')).dataobj) > 0
+				if subject_mask.shape != mask.shape:
+					raise ValueError("The mask for {} in pipeline {} isn't in the same space as the other subjects".format(subject, pipeline))
+				mask &= subject_mask
+
+		#Reads every subject's copes and varcopes within the mask, across a pool of threads, into (contrasts x subjects
+		#x voxels) arrays.
+		n_voxels = np.count_nonzero(mask)
+		copes = np.zeros((len(contrasts), len(subjects), n_voxels), dtype=np.float32)
+		varcopes = np.zeros((len(contrasts), len(subjects), n_voxels), dtype=np.float32)
+		with span('read_subjects', pipeline=pipeline), ThreadPoolExecutor(max_workers=n_threads) as executor:
+			for number, images in enumerate(executor.map(lambda subject: read_subject(subject[1], mask), subjects)):
+				copes[:, number], varcopes[:, number] = images[:, 0], images[:, 1]
+		print("Read {} subjects for pipeline {}, {} voxels in the group mask.".format(len(subjects), pipeline, n_voxels))
+
+		#Each map is written with the header of the first subject's mask (as float32).
+		header = mask_load.header.copy()
+		header.set_data_dtype(np.float32)
+		def to_volume(values):
+			volume = np.zeros(mask.shape, dtype=np.float32)
+			volume[mask] = values
+			return volume
+
+		pipeline_out = os.path.join(out_dir, 'Pipeline_{}'.format(pipeline))
+		if not os.path.exists(pipeline_out):
+			os.makedirs(pipeline_out)
+
+		#Fits each contrast, and writes each model's maps into a folder for the contrast.
+		for contrast_number, contrast in enumerate(contrasts):
+			with span('contrast', pipeline=pipeline, contrast=contrast):
+				contrast_dir = os.path.join(group_dir, 'Pipeline_{}'.format(pipeline), native_name, 'cope{}'.format(contrasts[contrast]))
+				if not os.path.exists(contrast_dir):
+					os.makedirs(contrast_dir)
+				save(nb.Nifti1Image(mask.astype(np.uint8), mask_load.affine), os.path.join(contrast_dir, 'mask.nii.gz'), 'mask')
+
+				maps, residuals = fit_contrast(copes[contrast_number], varcopes[contrast_number])
+				for model in models:
+					for name, values in maps[model].items():
+						if name != 'mean_random_effects_var' or model == 'flame1':
+							save(nb.Nifti1Image(to_volume(values), mask_load.affine, header), os.path.join(contrast_dir, '{}_{}.nii.gz'.format(model, name)), 'map')
+					zstat = to_volume(maps[model]['zstat'])
+					row = {'Pipeline': pipeline, 'Contrast': contrast, 'Model': model, 'Subjects': len(subjects), 'Mask_voxels': n_voxels,
+						'Max_z': float(zstat.max()), 'Voxels_above_z': int((maps[model]['zstat'] > z_threshold).sum()), 'Clusters': '', 'Thresholded_voxels': ''}
+
+					#Cluster-thresholds the z-statistic map, using the smoothness of this model's residuals.
+					output = zstat
+					if cluster_thresholding:
+						fwhm, dlh, resel_size = estimate_smoothness(residuals[model].T, mask)
+						write_smoothness(os.path.join(contrast_dir, '{}_smoothness'.format(model)), dlh, n_voxels, resel_size)
+						output, table = cluster_threshold(zstat, mask, dlh)
+						save(nb.Nifti1Image(output, mask_load.affine, header), os.path.join(contrast_dir, '{}_thresh_zstat.nii.gz'.format(model)), 'map')
+						write_cluster_table(os.path.join(contrast_dir, '{}_cluster_zstat.txt'.format(model)), table)
+						row['Clusters'], row['Thresholded_voxels'] = len(table), sum(cluster['Voxels'] for cluster in table)
+					summary.append(row)
+
+					#The chosen model's map is written where Group_level_extract.py would copy FEAT's.
+					if model == extracted_model:
+						save(nb.Nifti1Image(output, mask_load.affine, header), os.path.join(pipeline_out, '{}_Group_P{}.nii.gz'.format(contrast, pipeline)), 'map')
+				print("Fitted {} for pipeline {}.".format(contrast, pipeline))
+
+	#Writes the summary across every pipeline, contrast and model.
+	if summary:
+		with open(summary_file, 'w', newline='') as output_file:
+			writer = csv.DictWriter(output_file, fieldnames=list(summary[0].keys()))
+			writer.writeheader()
+			writer.writerows(summary)
@@ -0,0 +1,141 @@
+#Imports relevant modules.
+import os
+import sys
+import nibabel as nb
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+#The shared tracing functions and NIFTI writer are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tracing import traced
+from Nifti_writer import save
+
+#Defines the pipelines to be compared. Each pipeline listed in 'pipelines' is compared against the baseline.
+baseline = '0'
+pipelines = ['1', '2', '3', '4', '5', '6', '7', '8', '9']
+
+#The first-level image that is compared between pipelines (e.g. 'zstat1' or 'cope1').
+image = 'zstat1'
+
+#Defines the directory in which FEAT output is stored for each pipeline.
+feat_dir = '/<directory root>/FEAT/' #Full path removed for purpose of public sharing.
+
+#Defines the output directory for the difference maps. If this directory doesn't exist, it's created.
+output_dir = '/<directory root>/Sustainability_Output/Difference_Maps/' #Full path removed for purpose of public sharing.
+
+#A standard space brain mask, used to limit the voxels that are tested.
+mask_file = os.path.join(os.environ.get('FSLDIR', ''), 'data', 'standard', 'MNI152_T1_2mm_brain_mask.nii.gz')
+
+#The number of sign-flip permutations, a fixed seed so that results can be reproduced, the number of voxels processed
+#together in each chunk, and the number of worker processes.
+n_perm = 5000
+seed = 1234
+chunk_size = 2000
+n_workers = 8
+
+#A function to find the path of a subject's first-level image for a given pipeline.
+def image_path(pipeline, subject):
+	return os.path.join(feat_dir, 'Pipeline_{}'.format(pipeline), subject, 'Results', '.feat', 'stats', '{}.nii.gz'.format(image))
+
+#A function to find the path of the (subjects x voxels) array of differences for a given comparison. These are stored
+#on disk, so that memory use doesn't grow with the number of subjects.
+def differences_path(pipeline):
+	return os.path.join(output_dir, 'P{}_vs_P{}_{}_differences.npy'.format(baseline, pipeline, image))
+
+#A function to read one subject's images for the baseline and every other pipeline, writing the paired differences
+#(baseline minus pipeline) within the mask into row 's' of each comparison's array. Voxels that are zero in either image
+#(i.e. outside that subject's brain) are stored as NaN.
+@traced('subject', subject_arg='subject')
+def write_subject(s, subject, mask):
+	baseline_data = np.asanyarray(nb.load(image_path(baseline, subject)).dataobj, dtype=np.float32)[mask]
+	for pipeline in pipelines:
+		pipeline_data = np.asanyarray(nb.load(image_path(pipeline, subject)).dataobj, dtype=np.float32)[mask]
+		differences = np.lib.format.open_memmap(differences_path(pipeline), mode='r+')
+		differences[s] = np.where((baseline_data == 0) | (pipeline_data == 0), np.nan, baseline_data - pipeline_data)
+		differences.flush()
+	return subject
+
+#The (permutations x subjects) sign-flip matrix, set once in each worker process when the pool starts (see below), so
+#it isn't sent with every chunk.
+signs = None
+
+#A function to set the sign-flip matrix in a worker process.
+def set_signs(worker_signs):
+	global signs
+	signs = worker_signs
+
+#A function to calculate paired t-values for a chunk of voxels, along with the maximum |t| within the chunk for every
+#sign-flip permutation. Flipping signs doesn't change the sum of squares, so each permutation's mean differences come
+#from one matrix product of the (permutations x subjects) sign matrix with the chunk.
+@traced('chunk')
+def process_chunk(pipeline, start):
+	differences = np.load(differences_path(pipeline), mmap_mode='r')[:, start:start + chunk_size]
+	valid = ~np.isnan(differences)
+	filled = np.where(valid, differences, 0).astype(np.float64)
+	n = valid.sum(axis=0)
+	sum_squares = (filled ** 2).sum(axis=0)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		mean = filled.sum(axis=0) / n
+		t = mean / np.sqrt((sum_squares - n * mean ** 2) / (n - 1) / n)
+		permuted_mean = signs @ filled / n
+		permuted_t = permuted_mean / np.sqrt((sum_squares - n * permuted_mean ** 2) / (n - 1) / n)
+
+	#Voxels with fewer than 3 subjects are not tested.
+	t[n < 3] = np.nan
+	permuted_t[:, n < 3] = 0
+	return start, t, np.nanmax(np.abs(np.nan_to_num(permuted_t)), axis=1)
+
+#A function to save a map of values within the mask as a NIFTI file.
+@traced('write_map')
+def save_map(values, mask, mask_load, output_file):
+	volume = np.zeros(mask.shape, dtype=np.float32)
+	volume[mask] = values
+	save(nb.Nifti1Image(volume, mask_load.affine), output_file, 'map')
+
+if __name__ == '__main__':
+
+	if not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+
+	#Loads the mask, and finds the subjects with first-level results for every pipeline being compared.
+	mask_load = nb.load(mask_file)
+	mask = np.asanyarray(mask_load.dataobj) > 0
+	n_voxels = int(mask.sum())
+	subjects = sorted(subject for subject in os.listdir(os.path.join(feat_dir, 'Pipeline_{}'.format(baseline)))
+		if 'sub' in subject and all(os.path.exists(image_path(pipeline, subject)) for pipeline in [baseline] + pipelines))
+
+	#Creates the on-disk array of differences for each comparison, then fills in each subject's row in parallel.
+	for pipeline in pipelines:
+		np.lib.format.open_memmap(differences_path(pipeline), mode='w+', dtype=np.float32, shape=(len(subjects), n_voxels))
+
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		for count, subject in enumerate(executor.map(write_subject, range(len(subjects)), subjects, [mask] * len(subjects)), 1):
+			print("Finished {}, {}/{} subjects loaded.".format(subject, count, len(subjects)))
+
+	#The same sign-flip matrix is used for every chunk, so that the maximum |t| can be taken across the whole brain. It's
+	#sent to each worker process once, when the pool starts, and the pool is shared by every comparison.
+	flips = np.random.default_rng(seed).choice([-1.0, 1.0], size=(n_perm, len(subjects)))
+	with ProcessPoolExecutor(max_workers=n_workers, initializer=set_signs, initargs=(flips,)) as executor:
+
+		#Iterates over each comparison. Chunks of voxels are spread across the worker processes.
+		for pipeline in pipelines:
+			t = np.zeros(n_voxels)
+			max_null = np.zeros(n_perm)
+			starts = list(range(0, n_voxels, chunk_size))
+			for start, chunk_t, chunk_max in executor.map(process_chunk, [pipeline] * len(starts), starts):
+				t[start:start + chunk_size] = chunk_t
+				max_null = np.maximum(max_null, chunk_max)
+
+			#The family-wise corrected p-value for each voxel is the proportion of permutations with a maximum |t| at least
+			#as large as the voxel's own |t|.
+			exceed = n_perm - np.searchsorted(np.sort(max_null), np.abs(np.nan_to_num(t)), side='left')
+			corrected_p = (1 + exceed) / (n_perm + 1)
+			corrected_p[np.isnan(t)] = 1
+
+			#Saves out the t map and corrected p map for this comparison, and removes the array of differences.
+			save_map(np.nan_to_num(t), mask, mask_load, os.path.join(output_dir, 'P{}_vs_P{}_{}_tstat.nii.gz'.format(baseline, pipeline, image)))
+			save_map(corrected_p, mask, mask_load, os.path.join(output_dir, 'P{}_vs_P{}_{}_corrp.nii.gz'.format(baseline, pipeline, image)))
+			os.remove(differences_path(pipeline))
+			print("Finished difference map for P{} vs P{}.".format(baseline, pipeline))
+
@@ -1,7 +1,15 @@
 #Imports relevant modules.
 import os
+import sys
 import nibabel as nb
 import numpy as np
+from Group_accumulator import Accumulator
+
+#The shared tracing, BIDS index and NIFTI writer functions are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tracing import span, traced, each
+from BIDS_index import load_index
+from Nifti_writer import save
 
 #Defines the pipeline that we want to generate the SD map for. This will need to be updated each time.
 pipeline = '0'
@@ -9,112 +17,65 @@ pipeline = '0'
 #Based on the above variable, finds the directory corresponding to this pipeline which contains fMRIPrep output.
 pipeline_dir = '/mnt/lustre/users/psych/ns605/Sustainability/fMRIPrep/Pipeline_{}/derivatives/'.format(pipeline)
 
-#Creates an empty object that we'll use to create a single 'union' mask for this pipeline.
-union_mask_data = None
-affine = None
-
-#Here, we'll make our mask for this pipeline. The result will be a mask that accounts for all voxels that
-#are non-zero in any subject in the sample. First, iterates over each subject.
-for subject in sorted(os.listdir(pipeline_dir)):
-
-	#Skips any that don't correspond to a subject folder.
-	if 'sub' not in subject or 'html' in subject:
-		continue
-
-	#Prints that this subject is being iterated over.
-	print("Processing mask for {}".format(subject))
-
-	#Defines a path containing the functional output data for this subject.
-	func_path = os.path.join(pipeline_dir, subject, 'func')
-
-	#Checks for the occurrence of the below strings in this folder. The resolution of
-	#the volumetric output space used is accordingly defined as a variable.
-	for filename in os.listdir(func_path):
-		if 'res-2' in filename:
-			resolution = '2'
-			break
-		elif 'res-1' in filename:
-			resolution = '1'
-			break
-
-	#Reads in this subject's individual mask.
-	mask_file = os.path.join(func_path, '{}_task-stopsignal_space-MNI152NLin6Asym_res-{}_desc-brain_mask.nii.gz'.format(subject, resolution))
-	mask_img = nb.load(mask_file)
-	mask_data = mask_img.get_fdata().astype(bool)
-	
-	#If union_mask_data is not initialized, initialize it with the shape of the first mask.
-	if union_mask_data is None:
-		union_mask_data = np.zeros(mask_data.shape, dtype=bool)
-		affine = mask_img.affine
-
-	#Take the union of the current mask with the union_mask_data.
-	union_mask_data = np.logical_or(union_mask_data, mask_data)
-
-#Saves the resulting union mask out as a variable.
-brain = union_mask_data.astype(np.uint8)
-
-#Now we can move on to create the SD map. First, creates a variable to store the running sum of SD maps.
-running_sum = None
-
-#This variable will be used to keep track of how many subjects have been iterated over.
-count = 0
-
-#Iterates over each subject in the fMRIPrep directory, again.
-for subject in sorted(os.listdir(pipeline_dir)):
-
-	#Ignores a given folder if it doesn't correspond to a specific subject.
-	if 'sub' not in subject or 'html' in subject:
-		continue
-
-	#1 is added to the subject count.
-	count += 1
-
-	#Defines a path containing the functional output data for this subject.
-	func_path = os.path.join(pipeline_dir, subject, 'func')
-
-	#Checks for the occurrence of the below strings in this folder. The resolution of
-	#the volumetric output space used is accordingly defined as a variable.
-	for filename in os.listdir(func_path):
-		if 'res-2' in filename:
-			resolution = '2'
-			break
-		elif 'res-1' in filename:
-			resolution = '1'
-			break
-
-	#Finds and opens the preprocessed timeseries file.
-	timeseries_file = os.path.join(func_path, '{}_task-stopsignal_space-MNI152NLin6Asym_res-{}_desc-preproc_bold.nii.gz'.format(subject, resolution))
-	timeseries_load = nb.load(timeseries_file)
-	timeseries_raw = timeseries_load.get_fdata()
-
-	#This subject-specific data is multiplied by our above brain file, such that the timeseries data is masked by the sample's union brain mask.
-	#The 3D array is adjusted to account for the fact it's being multiplied by a 4D array.
-	timeseries = timeseries_raw * brain[..., np.newaxis]
-
-	#Calculate the SD of timeseries values within each voxel across the fourth dimension (time) for this subject.
-	timeseries_sd = np.std(timeseries, axis=3)
-
-	#Update the running sum with the current SD map
-	if running_sum is None:
-		running_sum = timeseries_sd
-	else:
-		running_sum += timeseries_sd
+#The name of the output file for this pipeline is defined.
+output_file = '/research/cisc2/projects/rae_sustainability/Sustainability_Output/SD_Map/P{}_SD_Map.nii.gz'.format(pipeline)
+
+#Defines the directory holding the accumulator for this pipeline (see Group_accumulator.py). On each run, only subjects
+#that are new or whose timeseries or mask has changed are read, and subjects without a folder are removed.
+accumulator_dir = os.path.join(os.path.dirname(output_file), 'Accumulators', 'P{}_Timeseries_SD'.format(pipeline))
+
+#The subjects to include (all if empty), e.g. to build a partial accumulator on one node to be merged later.
+only_subjects = []
+
+#A function to find the preprocessed timeseries and brain mask for a subject, from the index of the derivatives folder
+#(see BIDS_index.py). The resolution of the volumetric output space used is found from the subject's functional files.
+def subject_files(subject):
+	resolutions = index.values('res', sub=subject, datatype='func', space='MNI152NLin6Asym')
+	resolution = '2' if '2' in resolutions else '1'
+	files = {'suffix': 'bold', 'desc': 'preproc'}, {'suffix': 'mask', 'desc': 'brain'}
+	return [index.get(sub=subject, datatype='func', task='stopsignal', space='MNI152NLin6Asym', res=resolution, extension='.nii.gz', **entities) for entities in files]
+
+#A function to find a subject's contribution: the SD of timeseries values within each voxel across the fourth dimension
+#(time), and their brain mask. Returns this along with the loaded timeseries, which provides the affine and header.
+@traced('read_timeseries')
+def sd_contribution(files):
+	timeseries_load = nb.load(files[0])
+	timeseries_sd = np.std(timeseries_load.get_fdata(), axis=3)
+	mask_data = nb.load(files[1]).get_fdata().astype(bool)
+	return {'sd': timeseries_sd, 'mask': mask_data}, timeseries_load
+
+#Loads the index of the derivatives folder, bringing it up to date, and finds the subjects in it. Loads the
+#accumulator, and removes any subjects that are no longer present.
+with span('index'):
+	index = load_index(pipeline_dir)
+subjects = [subject for subject in index.subjects() if not only_subjects or subject in only_subjects]
+accumulator = Accumulator(accumulator_dir)
+for subject in accumulator.prune(subjects):
+	print("Removed {}".format(subject))
+
+#Iterates over each subject in the fMRIPrep directory, bringing them up to date in the accumulator.
+for count, subject in enumerate(each(subjects, 'subject', pipeline=pipeline), 1):
+	status = accumulator.update(subject, subject_files(subject), sd_contribution)
 
 	#A message is printed, informing the user of the subject ID and the percent of participants now completed.
-	print("Finished {}, {:.1f}% done.".format(subject, count / 257 * 100))
+	print("{} {}, {:.1f}% done.".format(status, subject, count / len(subjects) * 100))
 
-print("Calculating the mean map...")
+with span('save_accumulator'):
+	accumulator.save()
 
-#Calculate the mean map by dividing the running sum by the number of subjects
-mean_map = running_sum / count
+print("Calculating the mean map...")
 
-#The name of the output file for this pipeline is defined.
-output_file = '/research/cisc2/projects/rae_sustainability/Sustainability_Output/SD_Map/P{}_SD_Map.nii.gz'.format(pipeline)
+#The mask for this pipeline accounts for all voxels that are non-zero in any subject in the sample. Masking each
+#subject's timeseries by this 'union' mask sets their SD outside it to zero, so the mean map is the mean of subjects'
+#SD maps, multiplied by the union mask.
+brain = accumulator.total('mask') > 0
+mean_map = accumulator.mean('sd') * brain
 
 #Creates a new NIFTI header for the output file given that it's now 3D, not 4D.
-header = timeseries_load.header.copy()
+header = accumulator.header.copy()
 header.set_data_shape(mean_map.shape)
 
 #The output file is created and saved.
-mean_map_file = nb.Nifti1Image(mean_map, timeseries_load.affine, header)
-nb.save(mean_map_file, output_file)
+mean_map_file = nb.Nifti1Image(mean_map, accumulator.affine, header)
+with span('write_map'):
+	save(mean_map_file, output_file, 'map')
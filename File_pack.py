@@ -0,0 +1,252 @@
+#Imports relevant modules.
+import os
+import io
+import glob
+import json
+import zlib
+import fcntl
+import struct
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+#Packs the many small files written for each subject (FEATQUERY reports, smoothness estimates, fMRIPrep logs and the
+#Calc_carbon job JSON files) into one container file per folder, so that scripts reading them open one file instead of
+#tens of thousands (each of which is a request to the Lustre metadata server). A container holds the contents of each
+#file one after another, followed by an offset table (the position, length and modification time of each file, by its
+#path relative to the packed folder) and a short footer giving the position of the table. Packing is incremental: new
+#or changed files are appended, with a new table, and files that are already packed are skipped. The space taken by
+#replaced files is reclaimed once it's more than half of the container. Scripts read files through the 'Pack' class
+#below, which falls back to the original file for any file that hasn't been packed yet, or whose original has been
+#rewritten since it was packed (e.g. when a subject's FEATQUERY or smoothness run is redone).
+
+#Defines the pipelines to pack, and the directories containing FEAT and fMRIPrep output and the job JSON files.
+pipelines = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+feat_dir = '/<directory root>/FEAT' #Full path removed for purpose of public sharing.
+fmriprep_dir = '/<directory root>/fMRIPrep' #Full path removed for purpose of public sharing.
+job_json_dir = '/<directory root>/Calc_Carbon/Job_JSONs' #Full path removed for purpose of public sharing.
+
+#The files packed in each folder, as patterns relative to it.
+feat_patterns = [os.path.join('sub-*', 'Results', '.feat', 'featquery_*', 'report.txt'), os.path.join('sub-*', 'Results', 'Smoothness', 'smoothness_*')]
+log_patterns = [os.path.join('logs', '*')]
+job_json_patterns = ['calc_carbon_*.json']
+
+#If True, original files are deleted once they've been packed. Files that are deleted are kept in the container, while
+#if this is False, files whose original no longer exists are dropped from it.
+remove_originals = False
+
+#The name of the container in each packed folder, and the number of threads used to check and read the original files.
+pack_name = 'Small_files.pack'
+n_threads = 16
+
+#The footer is a fixed string, followed by the position and length of the (compressed JSON) offset table.
+magic = b'SMALLPK1'
+footer = struct.Struct('<8sQQ')
+
+#A function to find the offset table at the end of a container, given its open file descriptor and size. Returns the
+#table and the position of the end of the footer, or None if the file doesn't end with a valid footer.
+def read_table(fd, size):
+	if size < footer.size:
+		return None
+	found, table_offset, table_length = footer.unpack(os.pread(fd, footer.size, size - footer.size))
+	if found != magic or table_offset + table_length + footer.size != size:
+		return None
+	return json.loads(zlib.decompress(os.pread(fd, table_length, table_offset))), size
+
+#A function to find the last complete offset table in a container whose end wasn't written (e.g. if packing was
+#stopped partway through appending), by searching back for the footer string. Returns the table and the position of
+#the end of its footer, or an empty table if none is found.
+def recover_table(fd, size):
+	with open(fd, 'rb', closefd=False) as f:
+		data = f.read(size)
+	end = len(data)
+	while True:
+		position = data.rfind(magic, 0, end)
+		if position == -1:
+			return {}, 0
+		found = read_table(fd, position + footer.size)
+		if found is not None:
+			return found
+		end = position
+
+#A class for reading files from a container. The container is opened once, and each file is read with a single
+#positioned read (so one instance can be shared between threads). Files that aren't in the container are read from the
+#packed folder instead. Packed files are only returned if they're still current: if the original still exists and its
+#size or modification time differs from when it was packed, the original is read instead, so results are never stale
+#before File_pack.py is run again. This costs one stat of the original per file (rather than an open and read), and can
+#be switched off with 'check_originals' where the container is known to be up to date.
+class Pack:
+
+	def __init__(self, root, pack_file=None, check_originals=True):
+		self.root = root
+		self.pack_file = pack_file or os.path.join(root, pack_name)
+		self.check_originals = check_originals
+		self.fd = None
+		self.files = {}
+		if os.path.exists(self.pack_file):
+			self.fd = os.open(self.pack_file, os.O_RDONLY)
+			found = read_table(self.fd, os.fstat(self.fd).st_size)
+			if found is None:
+				print("Could not read the offset table of {}, reading the original files.".format(self.pack_file))
+			else:
+				self.files = found[0]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+	def __contains__(self, relative_path):
+		return relative_path in self.files
+
+	#A function to list the packed files whose paths match a pattern (e.g. 'logs/*'), in sorted order.
+	def names(self, pattern='*'):
+		return sorted(name for name in self.files if fnmatch.fnmatchcase(name, pattern))
+
+	#A function to check whether the packed copy of a file is current, i.e. its original has been removed, or has the
+	#same size and modification time as when it was packed.
+	def is_current(self, relative_path):
+		if not self.check_originals:
+			return True
+		offset, length, mtime = self.files[relative_path]
+		try:
+			stat = os.stat(os.path.join(self.root, relative_path))
+		except FileNotFoundError:
+			return True
+		return (stat.st_size, stat.st_mtime_ns) == (length, mtime)
+
+	#A function to read the contents of one file, given its path relative to the packed folder.
+	def read(self, relative_path):
+		if relative_path in self.files and self.is_current(relative_path):
+			offset, length = self.files[relative_path][:2]
+			return os.pread(self.fd, length, offset)
+		with open(os.path.join(self.root, relative_path), 'rb') as f:
+			return f.read()
+
+	#A function to read several files at once, in the order they're stored in the container. Returns a dictionary of
+	#path: contents.
+	def read_many(self, relative_paths):
+		order = sorted(relative_paths, key=lambda name: self.files[name][0] if name in self.files else -1)
+		return {name: self.read(name) for name in order}
+
+	#Functions to read one file as text, or as a file object (e.g. for np.loadtxt or csv).
+	def text(self, relative_path):
+		return self.read(relative_path).decode()
+
+	def open(self, relative_path):
+		return io.StringIO(self.text(relative_path))
+
+#A function to find the files to pack in a folder, with their size and modification time. Files are checked across a
+#pool of threads, as each check is a request to the metadata server.
+def find_files(executor, root, patterns):
+	paths = sorted({path for pattern in patterns for path in glob.glob(os.path.join(glob.escape(root), pattern)) if os.path.basename(path) != pack_name})
+	def check(path):
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		return (stat.st_size, stat.st_mtime_ns) if os.path.isfile(path) else None
+	return {os.path.relpath(path, root): found for path, found in zip(paths, executor.map(check, paths)) if found is not None}
+
+#A function to write a container with only the files that are still in its table, replacing the old container once
+#it's complete. Returns the new table and size.
+def compact(pack_file, fd, files):
+	temporary = '{}.{}.tmp'.format(pack_file, os.getpid())
+	compacted = {}
+	with open(temporary, 'wb') as f:
+		for name, (offset, length, mtime) in sorted(files.items(), key=lambda item: item[1][0]):
+			compacted[name] = [f.tell(), length, mtime]
+			f.write(os.pread(fd, length, offset))
+		write_table(f, compacted)
+		size = f.tell()
+		os.fsync(f.fileno())
+	os.replace(temporary, pack_file)
+	return compacted, size
+
+#A function to write an offset table and footer at the current end of a container.
+def write_table(f, files):
+	table = zlib.compress(json.dumps(files, separators=(',', ':')).encode())
+	table_offset = f.tell()
+	f.write(table)
+	f.write(footer.pack(magic, table_offset, len(table)))
+
+#A function to open a container for writing, creating it if needed. It's locked, so that only one process packs a
+#folder at a time. If the container was replaced (compacted) by another process while waiting, the new one is opened.
+def lock_container(pack_file):
+	while True:
+		fd = os.open(pack_file, os.O_RDWR | os.O_CREAT, 0o644)
+		fcntl.flock(fd, fcntl.LOCK_EX)
+		if os.path.exists(pack_file) and os.fstat(fd).st_ino == os.stat(pack_file).st_ino:
+			return fd
+		os.close(fd)
+
+#A function to pack the files in a folder matching the given patterns into its container, creating it if needed. Only
+#files that are new, or whose size or modification time has changed, are read, across a pool of threads, and appended.
+#If originals are being removed, each is only removed if it hasn't changed since it was packed. Returns the numbers of
+#files packed, unchanged and dropped.
+def pack_folder(root, patterns, pack_file=None):
+	pack_file = pack_file or os.path.join(root, pack_name)
+	with ThreadPoolExecutor(max_workers=n_threads) as executor:
+		current = find_files(executor, root, patterns)
+
+		fd = lock_container(pack_file)
+		with open(fd, 'r+b') as f:
+			size = os.fstat(fd).st_size
+			found = read_table(fd, size)
+			if found is None and size > 0:
+				print("{} doesn't end with an offset table, recovering the last complete one.".format(pack_file))
+				found = recover_table(fd, size)
+			files, end = found if found is not None else ({}, 0)
+
+			#Files are compared on their size and modification time. Files whose original is gone are dropped, unless
+			#originals are being removed.
+			changed = sorted(name for name in current if name not in files or tuple(files[name][1:]) != current[name])
+			dropped = [] if remove_originals else [name for name in files if name not in current]
+			for name in dropped:
+				del files[name]
+
+			#The changed files are read in parallel, and appended after the old table in order. Each is stored with its
+			#modification time from before it was read, so a file that changes while it's being read is read again on
+			#the next run.
+			f.truncate(end)
+			f.seek(end)
+			def read(name):
+				with open(os.path.join(root, name), 'rb') as source:
+					return source.read()
+			for name, contents in zip(changed, executor.map(read, changed)):
+				files[name] = [f.tell(), len(contents), current[name][1]]
+				f.write(contents)
+			if changed or dropped or found is None:
+				write_table(f, files)
+			f.flush()
+			os.fsync(fd)
+			size = f.tell()
+
+			#The container is rewritten once more than half of it is taken by files that have been replaced or dropped.
+			live = sum(length for offset, length, mtime in files.values())
+			if size > 2 * live + (1 << 20):
+				files = compact(pack_file, fd, files)[0]
+
+	if remove_originals:
+		for name in changed:
+			if os.stat(os.path.join(root, name)).st_mtime_ns == files[name][2]:
+				os.remove(os.path.join(root, name))
+	return len(changed), len(current) - len(changed), len(dropped)
+
+if __name__ == '__main__':
+
+	#Packs the FEAT outputs and fMRIPrep logs for each pipeline, and the job JSON files.
+	folders = [(os.path.join(feat_dir, 'Pipeline_{}'.format(pipeline)), feat_patterns) for pipeline in pipelines]
+	folders += [(os.path.join(fmriprep_dir, 'Pipeline_{}'.format(pipeline)), log_patterns) for pipeline in pipelines]
+	folders += [(job_json_dir, job_json_patterns)]
+	for root, patterns in folders:
+		if not os.path.isdir(root):
+			print("Skipping {}, which doesn't exist.".format(root))
+			continue
+		packed, unchanged, dropped = pack_folder(root, patterns)
+		print("{}: {} files packed, {} unchanged, {} dropped.".format(root, packed, unchanged, dropped))
@@ -1,6 +1,8 @@
 #Imports relevant modules.
 import os
 import csv
+import numpy as np
+from Multiple_comparisons import benjamini_hochberg, benjamini_yekutieli, holm
 
 #Defines the path of the FDR directory.
 FDR_dir = '\\<directory root>\\JASP\\FDR'
@@ -9,45 +11,46 @@ FDR_dir = '\\<directory root>\\JASP\\FDR'
 Input_dir = os.path.join(FDR_dir, 'Input')
 Corrected_dir = os.path.join(FDR_dir, 'Corrected')
 
-#Iterates over the input files (one per DV).
-for input_file in os.listdir(Input_dir):
-    
-    #This file is opened, and the first line is read out.
-    input_f = open(os.path.join(Input_dir, input_file), 'r')    
-    input_f.readline()
-
-    #Creates a list to store data for each of our comparisons.
-    comparisons = []
-    
-    #Iterates over each row in the input file, which is stripped and split by comma.
-    for line in input_f.readlines():        
-        line = line.strip().split(',')
-       
-        #We add a dictionary to our above list containing the identity of this comparison,
-        #t-value, and p-value (converted to float so we can sort them)
-        comparisons.append({'Comparison': line[0], 't_val': float(line[1]), 'p_val': float(line[2])})        
-    
-    #Our comparisons list is sorted in ascending by the p-value of each dictionary.
+#Creates a dictionary to store the comparisons for each of our input files (one per DV).
+DV_comparisons = {}
+
+#Iterates over the input files. Each row is added to a list for this DV as a dictionary containing the identity of the
+#comparison, t-value, and p-value (converted to float so we can sort them).
+for input_file in sorted(os.listdir(Input_dir)):
+    with open(os.path.join(Input_dir, input_file), 'r', newline = '') as input_f:
+        reader = csv.reader(input_f)
+        next(reader)
+        DV_comparisons[input_file] = [{'Comparison': line[0], 't_val': float(line[1]), 'p_val': float(line[2])} for line in reader if line]
+
+#All p-values are placed in one array, with a row for each DV (padded with NaN where a DV has fewer comparisons),
+#so that every DV is corrected at once. Corrections use the Benjamini-Hochberg (FDR), Benjamini-Yekutieli, and
+#Holm methods.
+width = max(len(comparisons) for comparisons in DV_comparisons.values())
+p_values = np.full((len(DV_comparisons), width), np.nan)
+for i, comparisons in enumerate(DV_comparisons.values()):
+    p_values[i, :len(comparisons)] = [comparison['p_val'] for comparison in comparisons]
+
+corrected = {'p_corr': benjamini_hochberg(p_values), 'p_BY': benjamini_yekutieli(p_values), 'p_Holm': holm(p_values)}
+
+#Creates an output file for each DV.
+for i, (input_file, comparisons) in enumerate(DV_comparisons.items()):
+
+    #Adds the corrected p-values to each comparison, then sorts them in ascending order by their p-value.
+    for j, comparison in enumerate(comparisons):
+        for method in corrected:
+            comparison[method] = corrected[method][i, j]
     comparisons.sort(key = lambda x: x['p_val'])
-    
+
     #The output file is defined and opened, and the header row is written.
-    output_f = open(os.path.join(Corrected_dir, '{}_corrected.csv'.format(input_file[:-4])), 'w')    
-    writer = csv.DictWriter(output_f, lineterminator='\n', fieldnames = ['Comparison', 't', 'p', 'p_corr'])
-    writer.writeheader()    
-    
-    #Again, iterates over each of our comparisons, tracking index.
-    for i, comparison in enumerate(comparisons):
-        
-        #Saves out info into the output file. This includes all information in the input
-        #dictionary as well as corrected p-value. This is calculated using the Benjamini-Hochberg method.
-        #Specificially, the p-value is multiplied by the number of comparisons. This value
-        #is divided by the rank of the p-value relative to others.
-        comp_row = {'Comparison': comparisons[i]['Comparison'],
-                    't': comparisons[i]['t_val'],
-                    'p': comparisons[i]['p_val'],
-                    'p_corr': (comparison['p_val'] * len(comparisons))/(i+1)}
-        writer.writerow(comp_row)        
-    
-    #Both the input and output files are closed.
-    input_f.close()
-    output_f.close()
+    with open(os.path.join(Corrected_dir, '{}_corrected.csv'.format(input_file[:-4])), 'w', newline = '') as output_f:
+        writer = csv.DictWriter(output_f, lineterminator='\n', fieldnames = ['Comparison', 't', 'p', 'p_corr', 'p_BY', 'p_Holm'])
+        writer.writeheader()
+
+        #Saves out info into the output file. This includes all information in the input dictionary as well as corrected p-values.
+        for comparison in comparisons:
+            writer.writerow({'Comparison': comparison['Comparison'],
+                             't': comparison['t_val'],
+                             'p': comparison['p_val'],
+                             'p_corr': comparison['p_corr'],
+                             'p_BY': comparison['p_BY'],
+                             'p_Holm': comparison['p_Holm']})
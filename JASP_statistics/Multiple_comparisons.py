@@ -0,0 +1,129 @@
+#Imports relevant modules
+import itertools
+import numpy as np
+
+#Shared functions for correcting p-values for multiple comparisons, used by FDR_correction.py and Pipeline_statistics.py.
+#P-values are given as an array with one row per DV and one column per comparison, so that every DV is corrected at
+#once. Rows with fewer comparisons can be padded with NaN, which are ignored and returned as NaN.
+
+#A function to sort each row of p-values in ascending order (with NaN last). Returns the sorted values, the order used,
+#and the number of (non-missing) comparisons in each row.
+def sort_rows(p):
+    p = np.atleast_2d(np.asarray(p, dtype=float))
+    order = np.argsort(np.where(np.isnan(p), np.inf, p), axis=-1)
+    return np.take_along_axis(p, order, axis=-1), order, (~np.isnan(p)).sum(axis=-1, keepdims=True)
+
+#A function to put sorted, adjusted p-values back into their original order, capping them at 1.
+def unsort_rows(adjusted, order):
+    output = np.empty(adjusted.shape)
+    np.put_along_axis(output, order, np.minimum(adjusted, 1), axis=-1)
+    return output
+
+#A function to apply the Benjamini-Hochberg (FDR) correction. Each sorted p-value is multiplied by the number of
+#comparisons and divided by its rank, and the step-up procedure is enforced by taking the cumulative minimum from the
+#largest rank downwards. With 'dependent' set to True, the Benjamini-Yekutieli correction is applied instead, which
+#further multiplies each value by the sum of 1/i for i = 1 to the number of comparisons.
+def benjamini_hochberg(p, dependent=False):
+    sorted_p, order, m = sort_rows(p)
+    rank = np.arange(1, sorted_p.shape[-1] + 1)
+    adjusted = sorted_p * m / rank
+    if dependent:
+        adjusted *= np.array([(1 / np.arange(1, count + 1)).sum() for count in m.ravel()])[:, None]
+    missing = np.isnan(adjusted)
+    adjusted = np.minimum.accumulate(np.where(missing, np.inf, adjusted)[..., ::-1], axis=-1)[..., ::-1]
+    adjusted[missing] = np.nan
+    return unsort_rows(adjusted, order)
+
+#A function to apply the Benjamini-Yekutieli correction, which is valid under any dependence between comparisons.
+def benjamini_yekutieli(p):
+    return benjamini_hochberg(p, dependent=True)
+
+#A function to apply the Holm (step-down) family-wise correction. Each sorted p-value is multiplied by the number of
+#comparisons remaining, and the cumulative maximum is taken from the smallest rank upwards.
+def holm(p):
+    sorted_p, order, m = sort_rows(p)
+    rank = np.arange(1, sorted_p.shape[-1] + 1)
+    adjusted = np.maximum.accumulate(np.nan_to_num(sorted_p * (m - rank + 1), nan=-np.inf), axis=-1)
+    adjusted[np.isnan(sorted_p)] = np.nan
+    return unsort_rows(adjusted, order)
+
+#A function to list every pair of pipelines (columns) to be compared. For ten pipelines this gives 45 comparisons.
+def all_pairs(n_pipelines):
+    return list(itertools.combinations(range(n_pipelines), 2))
+
+#A function to take paired differences between pipelines from a (subjects x pipelines) array, for each given pair of
+#columns. Returns a (subjects x comparisons) array, with NaN where either value is missing.
+def pair_differences(values, pairs):
+    first, second = zip(*pairs)
+    return values[:, list(first)] - values[:, list(second)]
+
+#A function to calculate one-sample t-values for every column of a (subjects x comparisons) array of differences,
+#ignoring missing values.
+def t_values(differences):
+    n = (~np.isnan(differences)).sum(axis=0)
+    return np.nanmean(differences, axis=0) / (np.nanstd(differences, axis=0, ddof=1) / np.sqrt(n))
+
+#A function to find the p-value for each observed t, given the maximum |t| in each permutation.
+def max_t_p(observed, max_null):
+    return (1 + (max_null[:, None] >= np.abs(observed)[None, :]).sum(axis=0)) / (len(max_null) + 1)
+
+#A function to apply sign-flip max-T family-wise correction to several sets of differences at once (e.g. one per DV).
+#Each set is a (subjects x comparisons) array, with the same subjects (rows) in every set and NaN where missing. For
+#each permutation, the sign of every subject's differences is flipped at random; as the sum of squares does not change,
+#the t-values for all comparisons of all DVs come from one matrix product per chunk of permutations. The family is each
+#DV by default, or every comparison of every DV if 'joint' is True. Returns a list of corrected p-value arrays.
+def sign_flip_max_t(difference_sets, n_perm=10000, rng=None, joint=False, chunk=2000):
+    rng = np.random.default_rng() if rng is None else rng
+    differences = np.concatenate(difference_sets, axis=1)
+    bounds = np.cumsum([0] + [d.shape[1] for d in difference_sets])
+
+    valid = ~np.isnan(differences)
+    filled = np.where(valid, differences, 0)
+    n = valid.sum(axis=0)
+    sum_squares = (filled ** 2).sum(axis=0)
+    observed = t_values(differences)
+
+    groups = [(0, bounds[-1])] if joint else list(zip(bounds[:-1], bounds[1:]))
+    max_null = np.zeros((len(groups), n_perm))
+    for start in range(0, n_perm, chunk):
+        signs = rng.choice([-1.0, 1.0], size=(min(chunk, n_perm - start), differences.shape[0]))
+        mean = signs @ filled / n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = mean / np.sqrt((sum_squares - n * mean ** 2) / (n - 1) / n)
+        for g, (low, high) in enumerate(groups):
+            max_null[g, start:start + len(signs)] = np.nanmax(np.abs(t[:, low:high]), axis=1)
+
+    if joint:
+        p = max_t_p(observed, max_null[0])
+        return [p[low:high] for low, high in zip(bounds[:-1], bounds[1:])]
+    return [max_t_p(observed[low:high], max_null[g]) for g, (low, high) in enumerate(groups)]
+
+#A function to apply permutation max-T family-wise correction to the comparisons of one DV, by shuffling the pipeline
+#labels within each subject. 'values' is a (subjects x pipelines) array, and only subjects with data for every pipeline
+#are used. Each chunk of permutations is drawn with rng.permuted as a (permutations x subjects x pipelines) index array.
+#Rather than forming every pair's differences, each permutation's t-values come from the sum of each pipeline's values
+#and the matrix of products between pipelines (one batched matrix product). Values are centred within each subject
+#first, which leaves the differences unchanged but keeps the sums of squares from losing precision.
+def permutation_max_t(values, pairs, n_perm=10000, rng=None, chunk=500):
+    rng = np.random.default_rng() if rng is None else rng
+    complete = values[~np.isnan(values).any(axis=1)]
+    first, second = [list(side) for side in zip(*pairs)]
+    observed = t_values(pair_differences(complete, pairs))
+
+    n = complete.shape[0]
+    centred = complete - complete.mean(axis=1, keepdims=True)
+    rows = np.arange(n)[None, :, None]
+    labels = np.arange(complete.shape[1])
+    max_null = np.zeros(n_perm)
+    for start in range(0, n_perm, chunk):
+        size = min(chunk, n_perm - start)
+        shuffled = centred[rows, rng.permuted(np.broadcast_to(labels, (size,) + complete.shape), axis=-1)]
+        sums = shuffled.sum(axis=1)
+        products = shuffled.transpose(0, 2, 1) @ shuffled
+        mean = (sums[:, first] - sums[:, second]) / n
+        sum_squares = products[:, first, first] - 2 * products[:, first, second] + products[:, second, second]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = mean / np.sqrt(np.maximum(sum_squares - n * mean ** 2, 0) / (n - 1) / n)
+        max_null[start:start + size] = np.abs(t).max(axis=1)
+
+    return max_t_p(observed, max_null)
@@ -0,0 +1,162 @@
+#Imports relevant modules
+import os
+import sys
+import csv
+import numpy as np
+from scipy import stats
+
+#The shared results store functions are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Results_store import connect, distinct, pivot
+from Multiple_comparisons import benjamini_hochberg, benjamini_yekutieli, holm, all_pairs, pair_differences, sign_flip_max_t, permutation_max_t
+
+#Defines the path of the directory containing compiled data for all pipelines.
+compiled_dir = '\\<directory root>\\Sustainability_Output\\Compiled'
+
+#Defines the path of the directory that full statistical results should be written into.
+stats_dir = '\\<directory root>\\JASP\\Statistics'
+
+#The pipeline that every other pipeline is compared against, and whether the paired comparisons are of the baseline
+#against each other pipeline ('baseline', 9 per DV) or of every pair of pipelines ('all_pairs', 45 per DV).
+baseline = '0'
+comparison_set = 'baseline'
+
+#The permutation scheme used for max-T correction: flipping the sign of each subject's paired differences
+#('sign_flip'), or shuffling the pipeline labels within each subject ('permutation'). Label shuffling only uses
+#subjects with data for every pipeline.
+max_t_method = 'sign_flip'
+
+#The number of bootstrap resamples used for confidence intervals, the width of those intervals, the number of sign-flip
+#permutations used for max-T correction, and a fixed seed so that results can be reproduced.
+n_boot = 10000
+n_perm = 10000
+ci_level = 95
+seed = 1234
+
+#A function to run a one-way repeated-measures ANOVA across pipelines, given a (subjects x pipelines) array. As in JASP,
+#only subjects with data for every pipeline are included. Returns F, both degrees of freedom, p, partial eta squared,
+#and the number of subjects used.
+def rm_anova(values):
+    complete = values[~np.isnan(values).any(axis=1)]
+    n, k = complete.shape
+    grand_mean = complete.mean()
+    ss_pipelines = n * ((complete.mean(axis=0) - grand_mean) ** 2).sum()
+    ss_subjects = k * ((complete.mean(axis=1) - grand_mean) ** 2).sum()
+    ss_error = ((complete - grand_mean) ** 2).sum() - ss_pipelines - ss_subjects
+    df_pipelines, df_error = k - 1, (n - 1) * (k - 1)
+    F = (ss_pipelines / df_pipelines) / (ss_error / df_error)
+    return {'F': F, 'df1': df_pipelines, 'df2': df_error, 'p': stats.f.sf(F, df_pipelines, df_error),
+            'partial_eta2': ss_pipelines / (ss_pipelines + ss_error), 'n': n}
+
+#A function to run every paired t-test at once. 'differences' is a (subjects x comparisons) array of the first pipeline
+#minus the second in each pair, with NaN where either value is missing (each test uses all subjects with data for both
+#pipelines). Returns arrays of n, mean difference, t, degrees of freedom, p, and Cohen's dz.
+def paired_tests(differences):
+    n = (~np.isnan(differences)).sum(axis=0)
+    mean = np.nanmean(differences, axis=0)
+    sd = np.nanstd(differences, axis=0, ddof=1)
+    t = mean / (sd / np.sqrt(n))
+    return {'n': n, 'mean_diff': mean, 't': t, 'df': n - 1, 'p': 2 * stats.t.sf(np.abs(t), n - 1), 'dz': mean / sd}
+
+#A function to produce percentile bootstrap confidence intervals for the mean difference and Cohen's dz of every
+#comparison. Subjects are resampled with replacement using one (resamples x subjects) index matrix, which is applied
+#to the whole differences array at once.
+def bootstrap_ci(differences, rng):
+    index = rng.integers(0, differences.shape[0], size=(n_boot, differences.shape[0]))
+    resampled = differences[index]
+    mean = np.nanmean(resampled, axis=1)
+    dz = mean / np.nanstd(resampled, axis=1, ddof=1)
+    tails = [(100 - ci_level) / 2, 100 - (100 - ci_level) / 2]
+    return np.nanpercentile(mean, tails, axis=0), np.nanpercentile(dz, tails, axis=0)
+
+#A function to list the pairs of pipelines (as column indices) compared, and a label for each comparison. Comparisons
+#against the baseline are labelled by the other pipeline alone, as in the JASP input files.
+def comparison_pairs(pipelines):
+    if comparison_set == 'all_pairs':
+        pairs = all_pairs(len(pipelines))
+        return pairs, ['P{}-P{}'.format(pipelines[first], pipelines[second]) for first, second in pairs]
+    others = [pipeline for pipeline in pipelines if pipeline != baseline]
+    return [(pipelines.index(baseline), pipelines.index(pipeline)) for pipeline in others], ['P{}'.format(pipeline) for pipeline in others]
+
+#A function to run all statistics for one DV. Returns the ANOVA results, a list of rows (one per comparison), the
+#(subjects x comparisons) differences used, with a row for every subject in 'subjects', and the (subjects x pipelines)
+#values with the pairs compared (for label-shuffling max-T correction).
+def analyse_DV(conn, DV, rng, subjects=None):
+    subjects, pipelines, values, _ = pivot(conn, 'subject', 'pipeline', row_labels=subjects, exclude_outliers=True, measure=DV)
+    pairs, labels = comparison_pairs(pipelines)
+    differences = pair_differences(values, pairs)
+
+    anova = rm_anova(values)
+    tests = paired_tests(differences)
+    mean_ci, dz_ci = bootstrap_ci(differences, rng)
+
+    comparisons = []
+    for i, label in enumerate(labels):
+        comparisons.append({'Comparison': label,
+                            'n': tests['n'][i],
+                            'mean_diff': tests['mean_diff'][i],
+                            't': tests['t'][i],
+                            'df': tests['df'][i],
+                            'p': tests['p'][i],
+                            'dz': tests['dz'][i],
+                            'mean_diff_ci_low': mean_ci[0, i],
+                            'mean_diff_ci_high': mean_ci[1, i],
+                            'dz_ci_low': dz_ci[0, i],
+                            'dz_ci_high': dz_ci[1, i]})
+    return anova, comparisons, differences, (values, pairs)
+
+#A function to correct the p-values of every comparison for every DV at once, adding the corrected values to each
+#comparison. Benjamini-Hochberg, Benjamini-Yekutieli, and Holm corrections are applied within each DV, along with
+#max-T family-wise correction within each DV, by sign-flipping the subjects' differences (all DVs at once), or by
+#shuffling pipeline labels within each subject (one DV at a time).
+def correct_DVs(DV_comparisons, DV_differences, DV_values, rng):
+    width = max(len(comparisons) for comparisons in DV_comparisons.values())
+    p_values = np.full((len(DV_comparisons), width), np.nan)
+    for i, comparisons in enumerate(DV_comparisons.values()):
+        p_values[i, :len(comparisons)] = [comparison['p'] for comparison in comparisons]
+
+    corrected = {'p_BH': benjamini_hochberg(p_values), 'p_BY': benjamini_yekutieli(p_values), 'p_Holm': holm(p_values)}
+    if max_t_method == 'permutation':
+        max_t = [permutation_max_t(values, pairs, n_perm, rng) for values, pairs in DV_values.values()]
+    else:
+        max_t = sign_flip_max_t(list(DV_differences.values()), n_perm, rng)
+
+    for i, comparisons in enumerate(DV_comparisons.values()):
+        for j, comparison in enumerate(comparisons):
+            for method in corrected:
+                comparison[method] = corrected[method][i, j]
+            comparison['p_maxT'] = max_t[i][j]
+
+if __name__ == '__main__':
+
+    #Opens the long-format results store written by Pipeline_data_compile.py. Every DV is given a row for every
+    #subject, so that permutations can be applied to all DVs at once.
+    conn = connect(os.path.join(compiled_dir, 'results.sqlite'))
+    subjects = distinct(conn, 'subject')
+    rng = np.random.default_rng(seed)
+
+    #Runs the statistics for every DV, and collects the ANOVA results into one table.
+    anova_rows = []
+    DV_comparisons = {}
+    DV_differences = {}
+    DV_values = {}
+    for DV in distinct(conn, 'measure'):
+        anova, DV_comparisons[DV], DV_differences[DV], DV_values[DV] = analyse_DV(conn, DV, rng, subjects)
+        anova_rows.append(dict(DV = DV, **anova))
+        print("Finished statistics for {}.".format(DV))
+
+    #The p-values for every DV are corrected for multiple comparisons together.
+    correct_DVs(DV_comparisons, DV_differences, DV_values, rng)
+
+    #Writes the full results of each paired comparison for each DV.
+    for DV, comparisons in DV_comparisons.items():
+        with open(os.path.join(stats_dir, '{}_comparisons.csv'.format(DV)), 'w', newline = '') as output:
+            writer = csv.DictWriter(output, lineterminator='\n', fieldnames = list(comparisons[0].keys()))
+            writer.writeheader()
+            writer.writerows(comparisons)
+
+    #Writes the repeated-measures ANOVA results for all DVs.
+    with open(os.path.join(stats_dir, 'RM_ANOVA.csv'), 'w', newline = '') as output:
+        writer = csv.DictWriter(output, lineterminator='\n', fieldnames = ['DV', 'F', 'df1', 'df2', 'p', 'partial_eta2', 'n'])
+        writer.writeheader()
+        writer.writerows(anova_rows)
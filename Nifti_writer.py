@@ -0,0 +1,141 @@
+#Imports relevant modules.
+import io
+import os
+import sys
+import zlib
+import threading
+import nibabel as nb
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from nibabel.fileholders import FileHolder
+
+#A writer for compressed NIFTI files ('.nii.gz') that compresses with several threads. The uncompressed file is split
+#into blocks, each block is compressed on its own in a pool of threads (zlib releases the GIL while compressing), and
+#the compressed blocks are written in order as a 'multi-member' gzip file: several complete gzip streams one after the
+#other. This is a valid gzip file, read by nibabel, FSL, AFNI and gunzip as normal. Compressing blocks separately makes
+#files very slightly larger than a single stream (well under 1% with 4MB blocks). Running this module directly
+#compresses an existing file, e.g. 'python Nifti_writer.py stopsignal_brain.nii stopsignal_brain.nii.gz timeseries'.
+
+#The compression level (1-9) used for each class of output. Timeseries are large and rewritten often, so they're
+#written at the fastest level (as nibabel does by default), while maps and masks are small and kept for longer.
+compression_levels = {'timeseries': 1, 'map': 6, 'mask': 9}
+
+#The size of each block compressed separately, and the number of threads used (all cores by default). Processes that
+#already run in parallel (e.g. one per subject) may want fewer threads each.
+block_size = 4 << 20
+n_threads = os.cpu_count() or 1
+
+#The thread pool is shared by every file written by a process, and created when first needed.
+pools = {}
+pools_lock = threading.Lock()
+
+#A function to find the shared thread pool for a number of threads.
+def thread_pool(threads):
+	with pools_lock:
+		if threads not in pools:
+			pools[threads] = ThreadPoolExecutor(max_workers=threads)
+		return pools[threads]
+
+#A function to compress one block as a complete gzip stream (with a header and trailer).
+def compress_block(block, level):
+	return zlib.compress(block, level, wbits=31)
+
+#A class for a file object that compresses everything written to it in blocks. Blocks are compressed as soon as they're
+#full, and written in order as they finish, with at most two blocks per thread waiting, so memory use stays small however
+#large the file is. The file is written under a temporary name, which replaces the output file when it's closed, so a
+#partial file is never left with the output name.
+class BlockGzipFile(io.RawIOBase):
+
+	def __init__(self, path, level=6, threads=None, block_size=block_size):
+		self.path = path
+		self.level = level
+		self.block_size = block_size
+		self.pool = thread_pool(threads or n_threads)
+		self.max_pending = 2 * (threads or n_threads)
+		self.temporary = '{}.{}.tmp'.format(path, os.getpid())
+		self.output = open(self.temporary, 'wb')
+		self.buffer = bytearray()
+		self.pending = deque()
+		self.position = 0
+
+	def writable(self):
+		return True
+
+	def seekable(self):
+		return False
+
+	#Writes data, compressing any full blocks. Returns the number of bytes written.
+	def write(self, data):
+		data = memoryview(data).cast('B')
+		self.buffer += data
+		self.position += len(data)
+		while len(self.buffer) >= self.block_size:
+			self.submit(bytes(self.buffer[:self.block_size]))
+			del self.buffer[:self.block_size]
+		return len(data)
+
+	#The position in the uncompressed file. Seeking is only possible to the current position (nibabel seeks to the start
+	#of the image data, and writes zeros to reach it if seeking fails).
+	def tell(self):
+		return self.position
+
+	def seek(self, offset, whence=0):
+		if (whence, offset) not in [(0, self.position), (1, 0)]:
+			raise io.UnsupportedOperation("BlockGzipFile can only be written in order")
+		return self.position
+
+	#Submits a block to be compressed, first writing out the oldest blocks if too many are waiting.
+	def submit(self, block):
+		while len(self.pending) >= self.max_pending:
+			self.output.write(self.pending.popleft().result())
+		self.pending.append(self.pool.submit(compress_block, block, self.level))
+
+	#Compresses what's left, writes every block, and moves the file to the output name. If there's been an error, the
+	#temporary file is removed instead.
+	def close(self, error=False):
+		if self.closed:
+			return
+		try:
+			if not error:
+				if self.buffer or not self.position:
+					self.submit(bytes(self.buffer))
+					self.buffer = bytearray()
+				while self.pending:
+					self.output.write(self.pending.popleft().result())
+			self.output.close()
+			if error:
+				os.remove(self.temporary)
+			else:
+				os.replace(self.temporary, self.path)
+		finally:
+			super().close()
+
+	def __exit__(self, exception_type, *args):
+		self.close(error=exception_type is not None)
+
+#A function to find the compression level for a class of output, or a level given directly.
+def find_level(output_class):
+	return output_class if isinstance(output_class, int) else compression_levels[output_class]
+
+#A function to save a NIFTI image. Compressed ('.nii.gz') files are written with the block writer, at the compression
+#level for the class of output (e.g. 'timeseries' or 'map', or a level from 1-9). Other files are saved by nibabel.
+def save(img, path, output_class='map', threads=None):
+	if not path.endswith('.nii.gz'):
+		nb.save(img, path)
+		return
+	img.set_filename(path)
+	with BlockGzipFile(path, find_level(output_class), threads) as f:
+		img.to_file_map({'image': FileHolder(filename=path, fileobj=f), 'header': FileHolder(filename=path, fileobj=f)})
+
+#A function to compress an existing uncompressed file (e.g. a '.nii' file written by another program), reading it one
+#block at a time.
+def compress_file(input_path, output_path, output_class='map', threads=None):
+	with open(input_path, 'rb') as source, BlockGzipFile(output_path, find_level(output_class), threads) as f:
+		for block in iter(lambda: source.read(block_size), b''):
+			f.write(block)
+
+if __name__ == '__main__':
+
+	#Compresses the file given as the first argument into the second, with an optional output class or level.
+	output_class = sys.argv[3] if len(sys.argv) > 3 else 'timeseries'
+	compress_file(sys.argv[1], sys.argv[2], int(output_class) if output_class.isdigit() else output_class)
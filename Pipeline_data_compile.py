@@ -2,144 +2,90 @@
 import os
 import numpy as np
 import csv
+from Robust_summary import load_columns, stack_padded, summarise
+from Results_store import connect, delete_pipeline, write_columns, write_outliers, pivot
+from Tracing import span
 
-#Defines the pipline ID. This will need to be updated.
-pipeline = '4'
+#Defines the pipline IDs to be compiled. This will need to be updated. Several pipelines can be compiled in one run.
+pipelines = ['4']
 
 #Defines the filepath containing all output files.
 data_folder = '/<directory root>/Sustainability_Output' #Full path removed for purpose of public sharing.
 
-#Defines the path of each specific file we'll need.
-carbon_file = os.path.join(data_folder, 'Calc_Carbon', 'Pipeline_{}_carbon_HPC.csv'.format(pipeline))
-smoothness_file = os.path.join(data_folder, 'Smoothness', 'Pipeline_{}_smoothness.csv'.format(pipeline))
-featquery_file = os.path.join(data_folder, 'Featquery', 'Pipeline_{}_Featquery.csv'.format(pipeline))
-
 #Creates a list containing all measures we're interested in.
 measures = ['Duration', 'Emissions', 'CPU_kWh', 'Memory_kWh', 'Smoothness_Pre', 'Smoothness_Post',
 'Motor', 'Pre-SMA', 'Auditory', 'Insula']
 
-#A dictionary to store data for each subject.
-subjects = {}
-
-#Opens the files for carbon, smoothness, and featquery. Iterates over each row for each and then adds
-#the relevant data to the respective subject's dictionary key.
-with open(carbon_file, newline = '') as carbon:
-
-	carbon_rows = csv.reader(carbon, delimiter = ',', quotechar = '"')	
-	next(carbon_rows)
-
-	for row in carbon_rows:
-
-		#Duration is converted from seconds to hours.
-		subjects[row[0]] = {'Duration': float(row[5])/3600,
-			'Emissions': row[16],
-			'CPU_kWh': row[7],
-			'Memory_kWh': row[10]}
-	
-with open(smoothness_file, newline = '') as smoothness:
-
-	smoothness_rows = csv.reader(smoothness, delimiter = ',', quotechar = '"')	
-	next(smoothness_rows)
-
-	for row in smoothness_rows:
-
-		subjects[row[0]]['Smoothness_Pre'] = row[1]
-		subjects[row[0]]['Smoothness_Post'] = row[2]
-
-with open(featquery_file, newline = '') as featquery:
-
-	featquery_rows = csv.reader(featquery, delimiter = ',', quotechar = '"')	
-	next(featquery_rows)
-
-	for row in featquery_rows:
-
-		subjects[row[0]]['Motor'] = row[1]
-		subjects[row[0]]['Pre-SMA'] = row[2]
-		subjects[row[0]]['Auditory'] = row[3]
-		subjects[row[0]]['Insula'] = row[4]
-
-#Adds keys for the mean and standard error of the mean to the subject dictionary.
-subjects['Mean'] = {}
-subjects['SEM'] = {}
-
-#Iterates over each of our measures.
-for measure in measures:
-
-	#An empty dictionary to store data points for each subject, and a list that will
-	#store the same values seperately from subject ID.
-	all_data_dict = {}
-	all_data_list = []
-
-	#Starts a count of the number of outliers identified.
-	outlier_count = 0
-
-	#Iterates over each subject, skips them if they refer to the mean of SEM of a measure.
-	for subject in subjects:
-
-		if subject == 'Mean' or subject == 'SEM':
-			continue
-
-		#The data point for this subject/measure is added to the list and dictionary.
-		all_data_dict[subject] = float(subjects[subject][measure])
-		all_data_list.append(float(subjects[subject][measure]))
-
-	#Defines a high and low cutoff for identifying outliers.
-	high = np.mean(all_data_list) + 3*np.std(all_data_list)
-	low = np.mean(all_data_list) - 3*np.std(all_data_list)
-
-	#Iterates over each subject again.
-	for subject in all_data_dict:
-
-		#Defines the value of this subject/measure
-		val = all_data_dict[subject]
-
-		#If a given value classes as an outlier, it's replaced by 'N/A'.
-		if val > high or val < low:
-			subjects[subject][measure] = 'N/A'
-			outlier_count += 1
-
-	#Prints how many outliers have been removed for a given measure.
-	print("{} outlier(s) removed for {}.".format(outlier_count, measure))
-
-	#Creates a new list to exclude any N/A values. Then iterates over each subject again
-	#and adds relevant values to this new list.
-	outliers_removed = []
-
-	for subject in subjects:
-
-		if subject == 'Mean' or subject == 'SEM':
-			continue
-
-		val = subjects[subject][measure]
-
-		if val != 'N/A':
-			outliers_removed.append(float(val))
-
-	#Adds the mean and SEM for this measure to the subject's dictionary.
-	subjects['Mean'][measure] = np.mean(outliers_removed)
-	subjects['SEM'][measure] = np.std(outliers_removed)/np.sqrt(len(outliers_removed))
-
-#Defines the filepath of the output file and puts all headers in a list.
-output_path = os.path.join(data_folder, 'Compiled', 'P{}_Compiled_HPC.csv'.format(pipeline))
-headers = ['Subject'] + measures
-
-#Opens the output file and writes the headers.
-with open(output_path, mode = 'w', newline = '') as output_file:
-	writer = csv.DictWriter(output_file, fieldnames = headers)
-	writer.writeheader()
-	
-	#Feeds the relevant information for each subject into the output file. Each row is written.
-	for subject in subjects:
-		print(subject)
-		out_data = {'Subject': subject,
-		'Duration': subjects[subject]['Duration'],
-		'Emissions': subjects[subject]['Emissions'],
-		'CPU_kWh': subjects[subject]['CPU_kWh'],
-		'Memory_kWh': subjects[subject]['Memory_kWh'],
-		'Smoothness_Pre': subjects[subject]['Smoothness_Pre'],
-		'Smoothness_Post': subjects[subject]['Smoothness_Post'],
-		'Motor': subjects[subject]['Motor'],
-		'Pre-SMA': subjects[subject]['Pre-SMA'],
-		'Auditory': subjects[subject]['Auditory'],
-		'Insula': subjects[subject]['Insula']}
-		writer.writerow(out_data)
+#A dictionary linking each source file to the columns we're interested in, and the measure each is stored as.
+sources = {'carbon': {'Wallclock': 'Duration', 'kgCO2': 'Emissions', 'CPU_kWh': 'CPU_kWh', 'Memory_kWh': 'Memory_kWh'},
+	'smoothness': {'Pre': 'Smoothness_Pre', 'Post': 'Smoothness_Post'},
+	'featquery': {'Motor': 'Motor', 'Pre-sma': 'Pre-SMA', 'Auditory': 'Auditory', 'Insula': 'Insula'}}
+
+#Opens the long-format results store, which holds every data point for every pipeline.
+conn = connect(os.path.join(data_folder, 'Compiled', 'results.sqlite'))
+
+#A function to load all measures for a given pipeline into the results store.
+def load_pipeline(pipeline):
+
+	#Defines the path of each specific file we'll need.
+	files = {'carbon': os.path.join(data_folder, 'Calc_Carbon', 'Pipeline_{}_carbon_HPC.csv'.format(pipeline)),
+		'smoothness': os.path.join(data_folder, 'Smoothness', 'Pipeline_{}_smoothness.csv'.format(pipeline)),
+		'featquery': os.path.join(data_folder, 'Featquery', 'Pipeline_{}_Featquery.csv'.format(pipeline))}
+
+	#Each file is loaded once. The pipeline's existing rows for these measures are then deleted, so that subjects dropped
+	#from a source file (or values that are now missing) aren't left in the store from an earlier run, and the columns are
+	#written into the store. Duration is converted from seconds to hours.
+	loaded = {source: load_columns(path, sources[source].keys()) for source, path in files.items()}
+	delete_pipeline(conn, pipeline, measures)
+	for source, (subjects, columns) in loaded.items():
+		write_columns(conn, pipeline, subjects, columns, sources[source], scale={'Wallclock': 1 / 3600})
+
+#Loads the data for every pipeline, then pulls each pipeline out of the store as an array with one row per measure and one
+#column per subject. Subjects missing from any of the source files are included, with missing values stored as NaN.
+pipeline_subjects = []
+pipeline_data = []
+for pipeline in pipelines:
+	with span('load_pipeline', pipeline=pipeline):
+		load_pipeline(pipeline)
+	subjects, _, data, _ = pivot(conn, 'subject', 'measure', column_labels=measures, pipeline=pipeline)
+	pipeline_subjects.append(subjects)
+	pipeline_data.append(data.T)
+
+#Summarises all measures for all pipelines at once. Values 3 standard deviations above or below the mean of the
+#respective measure are marked as outliers, and these flags are saved into the store.
+with span('summarise'):
+	summary = summarise(stack_padded(pipeline_data), rule='sd', k=3)
+	write_outliers(conn, [(subject, pipeline, measure, summary['outliers'][p, m, s])
+		for p, pipeline in enumerate(pipelines)
+		for s, subject in enumerate(pipeline_subjects[p])
+		for m, measure in enumerate(measures)])
+
+#Creates the output file for each pipeline.
+for p, pipeline in enumerate(pipelines):
+
+	#Prints how many outliers have been removed for each measure.
+	for m, measure in enumerate(measures):
+		print("{} outlier(s) removed for {} in pipeline {}.".format(summary['outlier_count'][p, m], measure, pipeline))
+
+	#Defines the filepath of the output file and puts all headers in a list.
+	output_path = os.path.join(data_folder, 'Compiled', 'P{}_Compiled_HPC.csv'.format(pipeline))
+	headers = ['Subject'] + measures
+
+	#Opens the output file and writes the headers.
+	with span('write_compiled', pipeline=pipeline), open(output_path, mode = 'w', newline = '') as output_file:
+		writer = csv.DictWriter(output_file, fieldnames = headers)
+		writer.writeheader()
+
+		#Feeds the relevant information for each subject into the output file. Outliers (and missing values) are
+		#written as 'N/A'. Each row is written.
+		values = summary['values'][p]
+		missing = np.ma.getmaskarray(values)
+		for s, subject in enumerate(pipeline_subjects[p]):
+			out_data = {'Subject': subject}
+			for m, measure in enumerate(measures):
+				out_data[measure] = 'N/A' if missing[m, s] else values.data[m, s]
+			writer.writerow(out_data)
+
+		#Adds rows for the mean and standard error of the mean for each measure.
+		writer.writerow(dict(Subject = 'Mean', **{measure: summary['mean'][p, m] for m, measure in enumerate(measures)}))
+		writer.writerow(dict(Subject = 'SEM', **{measure: summary['sem'][p, m] for m, measure in enumerate(measures)}))
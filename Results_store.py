@@ -0,0 +1,87 @@
+#Imports relevant modules.
+import sqlite3
+import numpy as np
+
+#Shared functions for the long-format results store. Every data point for every pipeline is kept as one row of a single
+#SQLite table (subject, pipeline, measure, value, outlier), indexed so that the data for any pipeline or dependent variable
+#can be pulled out directly. Subjects missing from one source simply have no row for that measure, and appear as NaN
+#when the data are pivoted into a wide (e.g. subject x pipeline) array.
+
+#A function to open (or create) the results store at the given path.
+def connect(store_path):
+	conn = sqlite3.connect(store_path)
+	conn.execute("""CREATE TABLE IF NOT EXISTS results (
+		subject TEXT NOT NULL,
+		pipeline TEXT NOT NULL,
+		measure TEXT NOT NULL,
+		value REAL,
+		outlier INTEGER NOT NULL DEFAULT 0,
+		PRIMARY KEY (pipeline, measure, subject)) WITHOUT ROWID""")
+	conn.execute("CREATE INDEX IF NOT EXISTS results_measure ON results (measure, pipeline)")
+	return conn
+
+#A function to write (or overwrite) rows of (subject, pipeline, measure, value) or (subject, pipeline, measure, value,
+#outlier). Missing values (NaN or None) are stored as NULL.
+def write_rows(conn, rows):
+	rows = [(row[0], str(row[1]), row[2], None if row[3] is None or np.isnan(row[3]) else float(row[3]), int(row[4]) if len(row) > 4 else 0)
+		for row in rows]
+	with conn:
+		conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows)
+
+#A function to delete a pipeline's rows for the given measures (or every measure), before the pipeline is loaded again,
+#so that subjects or values no longer in its source files don't keep their old rows.
+def delete_pipeline(conn, pipeline, measures=None):
+	with conn:
+		if measures is None:
+			conn.execute("DELETE FROM results WHERE pipeline = ?", (str(pipeline),))
+		else:
+			conn.executemany("DELETE FROM results WHERE pipeline = ? AND measure = ?", [(str(pipeline), measure) for measure in measures])
+
+#A function to write the values of the given columns of a CSV file (as loaded with Robust_summary.load_columns) into the
+#store for one pipeline. The 'measures' dictionary maps each CSV column to the measure name it's stored under, and
+#'scale' optionally gives a factor to multiply a column by (e.g. to convert seconds to hours).
+def write_columns(conn, pipeline, subjects, columns, measures, scale={}):
+	rows = []
+	for column, measure in measures.items():
+		values = columns[column] * scale.get(column, 1)
+		rows.extend((subject, pipeline, measure, value) for subject, value in zip(subjects, values))
+	write_rows(conn, rows)
+
+#A function to mark values as outliers (or not). Flags are given as (subject, pipeline, measure, outlier) rows.
+def write_outliers(conn, flags):
+	with conn:
+		conn.executemany("UPDATE results SET outlier = ? WHERE subject = ? AND pipeline = ? AND measure = ?",
+			[(int(outlier), subject, str(pipeline), measure) for subject, pipeline, measure, outlier in flags])
+
+#A function to list the distinct values of one column (subject, pipeline or measure), in sorted order.
+def distinct(conn, column):
+	return [row[0] for row in conn.execute("SELECT DISTINCT {0} FROM results ORDER BY {0}".format(column))]
+
+#A function to pivot the store into a wide array, with one of subject/pipeline/measure along the rows and another along
+#the columns. The third is fixed using a keyword argument, e.g. pivot(conn, 'subject', 'pipeline', measure='Emissions').
+#Returns the row labels, the column labels, the values (NaN where missing), and a boolean array of outlier flags.
+#Labels are sorted unless given in 'row_labels'/'column_labels', in which case only those are returned, in that order.
+#If exclude_outliers is True, outliers are also returned as NaN.
+def pivot(conn, rows, columns, row_labels=None, column_labels=None, exclude_outliers=False, **fixed):
+	(fixed_column, fixed_value), = fixed.items()
+	records = conn.execute("SELECT {}, {}, value, outlier FROM results WHERE {} = ?".format(rows, columns, fixed_column), (str(fixed_value),)).fetchall()
+
+	if row_labels is None:
+		row_labels = sorted(set(record[0] for record in records))
+	if column_labels is None:
+		column_labels = sorted(set(record[1] for record in records))
+	row_index = {label: i for i, label in enumerate(row_labels)}
+	column_index = {label: i for i, label in enumerate(column_labels)}
+
+	values = np.full((len(row_labels), len(column_labels)), np.nan)
+	outliers = np.zeros(values.shape, dtype=bool)
+	records = [record for record in records if record[0] in row_index and record[1] in column_index]
+	if records:
+		r = [row_index[record[0]] for record in records]
+		c = [column_index[record[1]] for record in records]
+		values[r, c] = [np.nan if record[2] is None else record[2] for record in records]
+		outliers[r, c] = [bool(record[3]) for record in records]
+
+	if exclude_outliers:
+		values[outliers] = np.nan
+	return row_labels, column_labels, values, outliers
@@ -0,0 +1,85 @@
+#Imports relevant modules.
+import csv
+import numpy as np
+
+#Shared functions used to summarise per-subject measures (e.g. by Smoothing_average.py and Pipeline_data_compile.py).
+#Data are held as float arrays in which the last axis holds the observations being summarised (volumes, subjects, etc.)
+#and any leading axes hold separate series (dimensions, measures, pipelines). Missing values are stored as NaN, so that
+#every series can be summarised in one batched call.
+
+#The values that are treated as missing when loading data.
+missing_values = ('', 'N/A', 'n/a', 'nan', 'NaN', None)
+
+#The scaling used to make the median absolute deviation a consistent estimate of the standard deviation.
+mad_scale = 1.4826
+
+#A function to convert a list of values (e.g. read from a CSV file) to a float array, with missing values as NaN.
+def to_array(values):
+	return np.array([np.nan if value in missing_values else float(value) for value in values], dtype=float)
+
+#A function to load the given columns of a CSV file into a dictionary of float arrays, along with the values of
+#the key column (e.g. subject IDs). Each column is read once, with missing values converted to NaN.
+def load_columns(csv_path, columns, key='Subject'):
+	with open(csv_path, newline='') as csv_file:
+		rows = list(csv.DictReader(csv_file))
+	keys = [row[key] for row in rows]
+	return keys, {column: to_array([row[column] for row in rows]) for column in columns}
+
+#A function to find outliers along the last axis of an array, ignoring missing (NaN) values. Rules are:
+#  'sd': values more than k standard deviations from the mean.
+#  'iterative': as 'sd', but repeated on the remaining values until no new outliers are found (or max_iter is reached).
+#  'mad': values more than k scaled median absolute deviations from the median.
+#Returns a boolean array of the same shape, which is True for outliers.
+def outlier_mask(data, rule='sd', k=3, max_iter=100):
+	data = np.asarray(data, dtype=float)
+	valid = ~np.isnan(data)
+
+	if rule == 'mad':
+		median = np.ma.median(np.ma.masked_array(data, ~valid), axis=-1, keepdims=True).filled(np.nan)
+		deviation = np.abs(data - median)
+		mad = np.ma.median(np.ma.masked_array(deviation, ~valid), axis=-1, keepdims=True).filled(np.nan) * mad_scale
+		with np.errstate(invalid='ignore'):
+			return valid & (deviation > k * mad)
+
+	if rule not in ('sd', 'iterative'):
+		raise ValueError("Unknown outlier rule: {}".format(rule))
+
+	outliers = np.zeros(data.shape, dtype=bool)
+	for _ in range(1 if rule == 'sd' else max_iter):
+		kept = np.ma.masked_array(data, ~valid | outliers)
+		mean = kept.mean(axis=-1, keepdims=True).filled(np.nan)
+		std = kept.std(axis=-1, keepdims=True).filled(np.nan)
+		with np.errstate(invalid='ignore'):
+			new = valid & ~outliers & (np.abs(data - mean) > k * std)
+		if not new.any():
+			break
+		outliers |= new
+	return outliers
+
+#A function to summarise every series in an array at once. Outliers are found with the given rule and excluded,
+#along with missing values. Returns a dictionary containing the values as a masked array (with outliers and missing
+#values masked), the outlier mask, and the mean, standard error of the mean, number of values used, and number of
+#outliers for each series.
+def summarise(data, rule='sd', k=3):
+	data = np.asarray(data, dtype=float)
+	outliers = outlier_mask(data, rule, k)
+	kept = np.ma.masked_array(data, np.isnan(data) | outliers)
+	n = kept.count(axis=-1)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		sem = kept.std(axis=-1).filled(np.nan) / np.sqrt(n)
+	return {'values': kept,
+		'outliers': outliers,
+		'mean': kept.mean(axis=-1).filled(np.nan),
+		'sem': sem,
+		'n': n,
+		'outlier_count': outliers.sum(axis=-1)}
+
+#A function to stack series of different lengths (e.g. one array of subjects per pipeline) into a single array,
+#padding shorter series with NaN so that they can be summarised together.
+def stack_padded(arrays):
+	arrays = [np.asarray(array, dtype=float) for array in arrays]
+	length = max(array.shape[-1] for array in arrays)
+	stacked = np.full((len(arrays),) + arrays[0].shape[:-1] + (length,), np.nan)
+	for i, array in enumerate(arrays):
+		stacked[i, ..., :array.shape[-1]] = array
+	return stacked
@@ -6,6 +6,9 @@ pipeline="0"
 #Defines a variable based on the location of files that have generated in fMRIPrep for processing in FEAT.
 feat_folders="<directory root>/FEAT/Pipeline_${pipeline}/" #Full path removed for purpose of public sharing.
 
+#Defines the top of the repository, where the shared NIFTI writer is kept.
+repo_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
+
 #Tells the script to just go one level deep such that we can iterate over subject subdirectories below.
 subdirs=$(find "$feat_folders" -maxdepth 1 -type d | sort)
 
@@ -51,8 +54,11 @@ do
 		#The resulting AFNI files are converted to NIFTI format.
 		3dAFNItoNIFTI stopsignal_brain+tlrc
 
-		#The new uncompressed NIFTI file is compressed.
-		fslchfiletype NIFTI_GZ stopsignal_brain.nii stopsignal_brain.nii.gz
+		#The new uncompressed NIFTI file is compressed, in blocks across several threads (see Nifti_writer.py). If
+		#this fails (e.g. if nibabel isn't available), fslchfiletype is used instead.
+		if ! python3 "${repo_dir}/Nifti_writer.py" stopsignal_brain.nii stopsignal_brain.nii.gz timeseries; then
+			fslchfiletype NIFTI_GZ stopsignal_brain.nii stopsignal_brain.nii.gz
+		fi
 		
 		#First, estimates the smoothness of the bold data that has not been smoothed. This is masked by the 'mask' file.
 		#The files used to generate the estimate are deleted to avoid overwriting issues, and then the same estimation
@@ -1,8 +1,15 @@
 #Imports relevant modules
 import os
+import sys
 import numpy as np
 import csv
 
+#The shared summary, tracing and container reading functions are kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Robust_summary import summarise
+from Tracing import span, each
+from File_pack import Pack
+
 #Defines the directory containing pipeline results.
 feat_dir = '/<directory root>/FEAT/' #Full path removed for purpose of public sharing.
 
@@ -16,57 +23,35 @@ pipeline_dir = os.path.join(feat_dir, 'Pipeline_{}'.format(pipeline))
 output_path = '/<directory root>/Smoothness/Pipeline_{}_smoothness.csv'.format(pipeline) #Full path removed for purpose of public sharing.
 headers = ['Subject', 'Pre', 'Post', 'Pre_x', 'Pre_y', 'Pre_z', 'Post_x', 'Post_y', 'Post_z']
 
-#The output file is opened and headers are written in.
-with open(output_path, mode = 'w', newline = '') as output_file:
+#The output file is opened and headers are written in. Smoothness files are read from the container of small files for
+#this pipeline, if they've been packed (see File_pack.py), or from the original files if not.
+with open(output_path, mode = 'w', newline = '') as output_file, Pack(pipeline_dir) as pack:
 	writer = csv.DictWriter(output_file, fieldnames = headers)
 	writer.writeheader()
 
-	#Iterates over each subject in the directory for this pipeline.
-	for subject in os.listdir(pipeline_dir):
-
-		#Ignores a given folder if it doesn't correspond to a specific subject.
-		if 'sub' not in subject:
-			continue
-
-		#This dictionary will store smoothness values for a given dimension for a given timepoint (pre-/post-smoothing).
-		dimensions = {'pre_x': [], 'pre_y': [], 'pre_z': [], 'post_x': [], 'post_y': [], 'post_z': []}
-
-		#Iterates over the possible variants of the smoothing estimate files (pre- and post-smoothing).
-		for suffix in ['pre', 'post']:
-
-			#Defines the smoothing file that we're interested in.
-			smoothing_file = os.path.join(pipeline_dir, subject, 'Results', 'Smoothness', 'smoothness_{}'.format(suffix))
-
-			#Opens and reads this file, then iterates over each row inside, which is stripped and split into numerical values.
-			with open(smoothing_file, 'r') as file:
-				for line in file:
-					row = line.strip().split()
-
-					#'float' versions of all values are appended to the respective list based on timepoint and dimension.
-					dimensions['{}_x'.format(suffix)].append(float(row[0]))
-					dimensions['{}_y'.format(suffix)].append(float(row[1]))
-					dimensions['{}_z'.format(suffix)].append(float(row[2]))
+	#Iterates over each subject in the directory for this pipeline, ignoring any folders that don't correspond to a
+	#specific subject.
+	for subject in each([subject for subject in os.listdir(pipeline_dir) if 'sub' in subject], 'subject', pipeline=pipeline):
 
-		#Iterates over each key in the dictionary.
-		for dimension in dimensions.keys():
+		#Loads the smoothing estimate files (pre- and post-smoothing) for this subject. Each file has one row per volume,
+		#with a column for each of the x, y, and z dimensions. These are stacked into a single array with one row per
+		#timepoint and dimension (pre_x, pre_y, pre_z, post_x, post_y, post_z).
+		with span('read_smoothness'):
+			estimates = np.concatenate([np.loadtxt(pack.open(os.path.join(subject, 'Results', 'Smoothness', 'smoothness_{}'.format(suffix))), usecols=(0, 1, 2), ndmin=2).T
+				for suffix in ['pre', 'post']])
 
-			#Defines a high and low cutoff for detecting outliers (+/-3 standard deviations from the mean of this dimension).
-			high_cutoff = np.mean(dimensions[dimension]) + 3*np.std(dimensions[dimension])
-			low_cutoff =  np.mean(dimensions[dimension]) - 3*np.std(dimensions[dimension])
+		#Values more than 3 standard deviations above or below the mean of the respective dimension are excluded.
+		values = summarise(estimates, rule='sd', k=3)['values']
 
-			#Any values found to exceed these cutoffs are removed from the repsective list.
-			for i in dimensions[dimension]:
-				if i >= high_cutoff or i <= low_cutoff:
-					dimensions[dimension].remove(i)					
-			
-		#Data for this subject are written into their output file, using the relevant mean values.
+		#Data for this subject are written into their output file, using the relevant mean values. The overall means
+		#are taken across all remaining values for the three dimensions.
 		subject_row = {'Subject': subject,
-			 	'Pre': np.mean(dimensions['pre_x'] + dimensions['pre_y'] + dimensions['pre_z']),
-			 	'Post': np.mean(dimensions['post_x'] + dimensions['post_y'] + dimensions['post_z']),
-			 	'Pre_x': np.mean(dimensions['pre_x']),
-			 	'Pre_y': np.mean(dimensions['pre_y']),
-			 	'Pre_z': np.mean(dimensions['pre_z']),
-			 	'Post_x': np.mean(dimensions['post_x']),
-			 	'Post_y': np.mean(dimensions['post_y']),
-			 	'Post_z': np.mean(dimensions['post_z'])}
-		writer.writerow(subject_row) 
+			 	'Pre': values[:3].mean(),
+			 	'Post': values[3:].mean(),
+			 	'Pre_x': values[0].mean(),
+			 	'Pre_y': values[1].mean(),
+			 	'Pre_z': values[2].mean(),
+			 	'Post_x': values[3].mean(),
+			 	'Post_y': values[4].mean(),
+			 	'Post_z': values[5].mean()}
+		writer.writerow(subject_row)
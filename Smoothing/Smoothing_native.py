@@ -0,0 +1,166 @@
+#Imports relevant modules.
+import os
+import sys
+import csv
+import math
+import nibabel as nb
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Smoothness_native import smoothness_subject
+
+#The shared NIFTI writer is kept at the top of the repository.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Nifti_writer import save
+
+#Defines the identity of the pipeline being run. Will need to be updated accordingly.
+pipeline = '0'
+
+#Defines a variable based on the location of files that have generated in fMRIPrep for processing in FEAT.
+feat_folders = '/<directory root>/FEAT/Pipeline_{}/'.format(pipeline) #Full path removed for purpose of public sharing.
+
+#The full width at half maximum (mm) of the Gaussian smoothing kernel, matching the 5mm used with 3dBlurInMask.
+fwhm = 5
+
+#The number of subjects that will be smoothed simultaneously, each in its own process, and the number of threads each
+#process uses to compress its smoothed file (see Nifti_writer.py).
+n_workers = 8
+compression_threads = max(1, (os.cpu_count() or 1) // n_workers)
+
+#Subjects listed here are smoothed into a separate 'native' file and compared against the existing AFNI output
+#(stopsignal_brain.nii.gz), rather than overwriting it. Leave empty to run smoothing for the whole pipeline.
+validation_subjects = []
+
+#Defines the output file that validation metrics are written into, if validation subjects are given.
+validation_file = '/<directory root>/Smoothness/Pipeline_{}_smoothing_validation.csv'.format(pipeline) #Full path removed for purpose of public sharing.
+
+#A function to build a 1D Gaussian kernel for a given FWHM (mm) and voxel size (mm). The kernel is truncated
+#at 3 standard deviations and normalised to sum to 1.
+def gaussian_kernel(fwhm, voxel_size):
+	sigma = fwhm / (2 * math.sqrt(2 * math.log(2))) / voxel_size
+	radius = max(1, int(math.ceil(3 * sigma)))
+	offsets = np.arange(-radius, radius + 1, dtype=np.float32)
+	kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+	return (kernel / kernel.sum()).astype(np.float32)
+
+#A function to convolve a 3D volume with a 1D kernel along one axis. Values beyond the edge of the volume are
+#treated as zeros, which is then corrected for by the normalised convolution below.
+def convolve_axis(volume, kernel, axis):
+	radius = len(kernel) // 2
+	moved = np.moveaxis(volume, axis, 0)
+	padded = np.zeros((moved.shape[0] + 2 * radius,) + moved.shape[1:], dtype=np.float32)
+	padded[radius:radius + moved.shape[0]] = moved
+	output = np.zeros(moved.shape, dtype=np.float32)
+	for offset, weight in enumerate(kernel):
+		output += weight * padded[offset:offset + moved.shape[0]]
+	return np.moveaxis(output, 0, axis)
+
+#A function to apply the separable Gaussian filter along all three spatial axes of a volume.
+def separable_filter(volume, kernels):
+	for axis, kernel in enumerate(kernels):
+		volume = convolve_axis(volume, kernel, axis)
+	return volume
+
+#A class holding everything needed to smooth volumes within a given brain mask. The smoothed mask (the
+#normalised convolution denominator) is the same for every volume in a run, so it is only computed once.
+class MaskedSmoother:
+
+	def __init__(self, mask, zooms, fwhm=fwhm):
+		self.mask = mask.astype(bool)
+		self.kernels = [gaussian_kernel(fwhm, zoom) for zoom in zooms[:3]]
+		weights = separable_filter(self.mask.astype(np.float32), self.kernels)
+		self.norm = np.zeros(weights.shape, dtype=np.float32)
+		self.norm[self.mask] = 1 / weights[self.mask]
+
+	#Smooths a single 3D volume. Only voxels inside the mask contribute to the result, and voxels outside the
+	#mask are set to zero (mirroring the brain extraction performed by 3dBlurInMask).
+	def smooth(self, volume):
+		masked = np.where(self.mask, volume, 0).astype(np.float32)
+		return separable_filter(masked, self.kernels) * self.norm
+
+	#Smooths every volume of a 4D run, one volume at a time, into a preallocated float32 array.
+	def smooth_run(self, bold_data):
+		smoothed = np.zeros(bold_data.shape, dtype=np.float32)
+		for t in range(bold_data.shape[3]):
+			smoothed[..., t] = self.smooth(bold_data[..., t])
+		return smoothed
+
+#A function to smooth the preprocessed BOLD run for one subject, writing a compressed NIFTI file directly (compressed in
+#blocks across several threads). If requested, smoothness is also estimated pre- and post-smoothing from the data
+#already in memory, so each run is only read once.
+def smooth_subject(subject_dir, output_name='stopsignal_brain.nii.gz', estimate=True):
+	func_dir = os.path.join(subject_dir, 'Functional')
+
+	#Loads the subject's BOLD run and brain mask.
+	bold_load = nb.load(os.path.join(func_dir, 'stopsignal_bold.nii.gz'))
+	mask = np.asanyarray(nb.load(os.path.join(func_dir, 'stopsignal_mask.nii.gz')).dataobj) > 0
+	bold_data = bold_load.get_fdata(dtype=np.float32)
+
+	#Smooths the data within the mask.
+	smoother = MaskedSmoother(mask, bold_load.header.get_zooms())
+	smoothed = smoother.smooth_run(bold_data)
+
+	#The output header is copied from the input, with the data type set to float32.
+	header = bold_load.header.copy()
+	header.set_data_dtype(np.float32)
+	output_file = os.path.join(func_dir, output_name)
+	save(nb.Nifti1Image(smoothed, bold_load.affine, header), output_file, 'timeseries', compression_threads)
+
+	if estimate:
+		smoothness_subject(subject_dir, bold_data, smoothed, mask, bold_load.header.get_zooms())
+	return output_file
+
+#A function to compare a natively smoothed file against AFNI's output within the brain mask. Returns the
+#correlation between the two, the RMS difference relative to the RMS of the AFNI data, and the largest difference.
+def compare_to_afni(native_file, afni_file, mask_file):
+	mask = np.asanyarray(nb.load(mask_file).dataobj) > 0
+	native = nb.load(native_file).get_fdata(dtype=np.float32)[mask]
+	afni = nb.load(afni_file).get_fdata(dtype=np.float32)[mask]
+	difference = native - afni
+	return {'Correlation': float(np.corrcoef(native.ravel(), afni.ravel())[0, 1]),
+		'Relative_RMS': float(np.sqrt(np.mean(difference ** 2)) / np.sqrt(np.mean(afni ** 2))),
+		'Max_abs_diff': float(np.max(np.abs(difference)))}
+
+#A function to run for each subject in the process pool. Validation subjects are written to a separate file
+#and compared against the AFNI output, others are smoothed into the file used by FEAT.
+def process_subject(subject_dir):
+	func_dir = os.path.join(subject_dir, 'Functional')
+	if not os.path.isdir(func_dir):
+		return None
+
+	if os.path.basename(subject_dir) in validation_subjects:
+		native_file = smooth_subject(subject_dir, 'stopsignal_brain_native.nii.gz', estimate=False)
+		return compare_to_afni(native_file, os.path.join(func_dir, 'stopsignal_brain.nii.gz'), os.path.join(func_dir, 'stopsignal_mask.nii.gz'))
+
+	smooth_subject(subject_dir)
+	return {}
+
+if __name__ == '__main__':
+
+	#Finds each subject directory for this pipeline.
+	subjects = sorted(subject for subject in os.listdir(feat_folders) if 'sub' in subject)
+	if validation_subjects:
+		subjects = [subject for subject in subjects if subject in validation_subjects]
+
+	#Subjects are distributed across the process pool. A message is printed as each one finishes.
+	validation_rows = []
+	count = 0
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		futures = {executor.submit(process_subject, os.path.join(feat_folders, subject)): subject for subject in subjects}
+		for future in as_completed(futures):
+			subject = futures[future]
+			count += 1
+			result = future.result()
+			if result is None:
+				print("Functional subfolder not found for {}, smoothing has not been performed.".format(subject))
+				continue
+			if result:
+				validation_rows.append(dict(Subject=subject, **result))
+			print("Smoothing and estimations are complete for {}, {}/{}".format(subject, count, len(subjects)))
+
+	#If any subjects were validated, the comparison metrics are written out.
+	if validation_rows:
+		with open(validation_file, 'w', newline='') as output_file:
+			writer = csv.DictWriter(output_file, fieldnames=['Subject', 'Correlation', 'Relative_RMS', 'Max_abs_diff'])
+			writer.writeheader()
+			for row in sorted(validation_rows, key=lambda row: row['Subject']):
+				writer.writerow(row)
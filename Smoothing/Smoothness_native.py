@@ -0,0 +1,153 @@
+#Imports relevant modules.
+import os
+import math
+import nibabel as nb
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+#Defines the identity of the pipeline being run. Will need to be updated accordingly.
+pipeline = '0'
+
+#Defines a variable based on the location of files that have generated in fMRIPrep for processing in FEAT.
+feat_folders = '/<directory root>/FEAT/Pipeline_{}/'.format(pipeline) #Full path removed for purpose of public sharing.
+
+#The number of subjects that will be estimated simultaneously, each in its own process.
+n_workers = 8
+
+#The number of volumes processed together when taking differences between neighbouring voxels. This bounds
+#the memory used by the estimate, at little cost in speed.
+volume_chunk = 32
+
+#The largest distance (in voxels) along each axis at which the spatial autocorrelation is measured for the ACF model.
+max_lag = 6
+
+#A function to remove polynomial trends from each voxel's timeseries, mirroring '3dFWHMx -detrend'. Timeseries
+#are given as a (voxels x volumes) array. As in AFNI, the default polynomial order is the number of volumes / 30.
+def detrend(timeseries, order=None):
+	n_volumes = timeseries.shape[1]
+	if order is None:
+		order = n_volumes // 30
+	basis = np.polynomial.legendre.legvander(np.linspace(-1, 1, n_volumes), order)
+	coefficients = np.linalg.lstsq(basis, timeseries.T, rcond=None)[0]
+	return (timeseries - (basis @ coefficients).T).astype(np.float32)
+
+#A function to find each pair of voxels inside the mask that are 'lag' voxels apart along a given axis. Returns
+#the positions of both voxels in the list of in-mask voxels (the order used by 'data[mask]').
+def neighbour_pairs(mask, axis, lag=1):
+	index = np.full(mask.shape, -1, dtype=np.int64)
+	index[mask] = np.arange(np.count_nonzero(mask))
+	first = np.moveaxis(index, axis, 0)[:-lag]
+	second = np.moveaxis(index, axis, 0)[lag:]
+	valid = (first >= 0) & (second >= 0)
+	return first[valid], second[valid]
+
+#A function to estimate the FWHM (mm) in x, y and z for every volume, using the variance of first differences
+#between neighbouring voxels relative to the overall variance (the 'classic' 3dFWHMx estimate). Volumes where an
+#estimate is not possible are given a value of -1, as in AFNI.
+def fwhm_per_volume(residuals, mask, zooms):
+	n_volumes = residuals.shape[1]
+	fwhm = np.full((n_volumes, 3), -1.0)
+	pairs = [neighbour_pairs(mask, axis) for axis in range(3)]
+
+	for start in range(0, n_volumes, volume_chunk):
+		chunk = residuals[:, start:start + volume_chunk]
+		variance = chunk.var(axis=0)
+
+		for axis, (first, second) in enumerate(pairs):
+			diff_variance = (chunk[first] - chunk[second]).var(axis=0)
+			with np.errstate(divide='ignore', invalid='ignore'):
+				autocorrelation = 1 - 0.5 * diff_variance / variance
+				estimate = zooms[axis] * np.sqrt(-2 * math.log(2) / np.log(autocorrelation))
+			valid = (autocorrelation > 0) & (autocorrelation < 1)
+			fwhm[start:start + volume_chunk, axis] = np.where(valid, estimate, -1.0)
+
+	return fwhm
+
+#A function to measure the spatial autocorrelation of the residuals at distances of 1 to 'max_lag' voxels along each
+#axis, averaged across volumes. Returns the distances in mm and the autocorrelation at each.
+def empirical_acf(residuals, mask, zooms):
+	centred = residuals - residuals.mean(axis=0)
+	variance = (centred ** 2).mean(axis=0)
+	radii = []
+	acf = []
+
+	for axis in range(3):
+		for lag in range(1, max_lag + 1):
+			first, second = neighbour_pairs(mask, axis, lag)
+			if len(first) == 0:
+				continue
+			products = np.zeros(centred.shape[1])
+			for start in range(0, centred.shape[1], volume_chunk):
+				chunk = centred[:, start:start + volume_chunk]
+				products[start:start + volume_chunk] = (chunk[first] * chunk[second]).mean(axis=0)
+			radii.append(lag * zooms[axis])
+			acf.append(np.mean(products / variance))
+
+	return np.array(radii), np.array(acf)
+
+#A function to fit the mixed ACF model used by '3dFWHMx -acf', a*exp(-r^2/(2*b^2)) + (1-a)*exp(-r/c), by evaluating
+#a grid of parameter values all at once. The FWHM of the model is twice the radius at which it falls to 0.5.
+#Returns a, b, c and the FWHM (mm).
+def fit_acf_model(radii, acf):
+	a = np.linspace(0, 1, 51)[:, None, None, None]
+	b = np.linspace(0.5, 20, 79)[None, :, None, None]
+	c = np.linspace(0.5, 40, 80)[None, None, :, None]
+	r = radii[None, None, None, :]
+	model = a * np.exp(-r ** 2 / (2 * b ** 2)) + (1 - a) * np.exp(-r / c)
+	error = ((model - acf) ** 2).sum(axis=-1)
+	best_a, best_b, best_c = np.unravel_index(np.argmin(error), error.shape)
+	a, b, c = a.ravel()[best_a], b.ravel()[best_b], c.ravel()[best_c]
+
+	fine_r = np.arange(0, 60, 0.01)
+	fine_model = a * np.exp(-fine_r ** 2 / (2 * b ** 2)) + (1 - a) * np.exp(-fine_r / c)
+	below = np.nonzero(fine_model <= 0.5)[0]
+	fwhm = 2 * fine_r[below[0]] if len(below) else -1.0
+	return a, b, c, fwhm
+
+#A function to produce both smoothness estimates for one set of masked timeseries (voxels x volumes).
+def estimate_smoothness(timeseries, mask, zooms):
+	residuals = detrend(timeseries)
+	fwhm = fwhm_per_volume(residuals, mask, zooms)
+	acf_params = fit_acf_model(*empirical_acf(residuals, mask, zooms))
+	return fwhm, acf_params
+
+#A function to write smoothness estimates, in the same format as the 3dFWHMx '-out' file (one row per volume, with
+#x, y and z columns). The ACF model parameters and FWHM are written to a second file with an '_ACF' suffix.
+def write_smoothness(output_file, fwhm, acf_params):
+	with open(output_file, 'w') as f:
+		for row in fwhm:
+			f.write('  {:.6f}  {:.6f}  {:.6f}\n'.format(*row))
+
+	with open(output_file + '_ACF', 'w') as f:
+		f.write('  {:.6f}  {:.6f}  {:.6f}  {:.6f}\n'.format(*acf_params))
+
+#A function to estimate smoothness for a subject both pre- and post-smoothing, from data already loaded into memory.
+#Outputs are written into the subject's Results/Smoothness folder.
+def smoothness_subject(subject_dir, bold_data, smoothed_data, mask, zooms):
+	smoothness_dir = os.path.join(subject_dir, 'Results', 'Smoothness')
+	if not os.path.exists(smoothness_dir):
+		os.makedirs(smoothness_dir)
+
+	for suffix, data in [('pre', bold_data), ('post', smoothed_data)]:
+		fwhm, acf_params = estimate_smoothness(data[mask], mask, zooms)
+		write_smoothness(os.path.join(smoothness_dir, 'smoothness_{}'.format(suffix)), fwhm, acf_params)
+
+#A function to estimate smoothness for a subject whose data has already been smoothed on disk (e.g. by Smoothing.sh).
+def process_subject(subject_dir):
+	func_dir = os.path.join(subject_dir, 'Functional')
+	bold_load = nb.load(os.path.join(func_dir, 'stopsignal_bold.nii.gz'))
+	mask = np.asanyarray(nb.load(os.path.join(func_dir, 'stopsignal_mask.nii.gz')).dataobj) > 0
+	smoothed_data = nb.load(os.path.join(func_dir, 'stopsignal_brain.nii.gz')).get_fdata(dtype=np.float32)
+	smoothness_subject(subject_dir, bold_load.get_fdata(dtype=np.float32), smoothed_data, mask, bold_load.header.get_zooms())
+
+if __name__ == '__main__':
+
+	#Finds each subject directory for this pipeline, and estimates smoothness for each across a process pool.
+	subjects = sorted(subject for subject in os.listdir(feat_folders) if 'sub' in subject)
+	count = 0
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		futures = {executor.submit(process_subject, os.path.join(feat_folders, subject)): subject for subject in subjects}
+		for future in as_completed(futures):
+			count += 1
+			future.result()
+			print("Smoothness estimates are complete for {}, {}/{}".format(futures[future], count, len(subjects)))
@@ -0,0 +1,270 @@
+#Imports relevant modules.
+import os
+import re
+import csv
+import shutil
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+#Reports how much storage is used by each pipeline, stage and file type across the fMRIPrep and FEAT directories, and
+#finds files that are byte-identical across pipelines (e.g. anatomical outputs, behavioural files and EVs). Duplicates
+#in stages that are only read once written (see 'link_stages') can optionally be replaced with hardlinks to a single
+#copy, which is made read-only, with a manifest written so this can be undone.
+
+#Defines the top-level directories to be inventoried, each containing a folder for each pipeline.
+roots = {'fMRIPrep': '/<directory root>/fMRIPrep', #Full path removed for purpose of public sharing.
+	'FEAT': '/<directory root>/FEAT'} #Full path removed for purpose of public sharing.
+
+#Defines the output directory for the reports and manifest. If this directory doesn't exist, it's created.
+output_dir = '/<directory root>/Sustainability_Output/Storage' #Full path removed for purpose of public sharing.
+
+#Files smaller than this (in bytes) aren't checked for duplicates, as linking them saves little. Stages listed in
+#'dedup_excluded' (e.g. working directories, which are deleted anyway) are counted but not checked for duplicates.
+min_dedup_size = 64 * 1024
+dedup_excluded = {'scratch'}
+
+#If True, duplicates are replaced by hardlinks to the first copy. If 'undo' is True, the links listed in the manifest
+#are instead replaced by separate copies again. A file rewritten in place through one link changes every linked copy,
+#so only stages whose files aren't rewritten once they've been written (e.g. the behavioural files and EVs copied by
+#fMRIPrep_to_FEAT.py, which are removed before being copied again) are linked. fMRIPrep derivatives, FEAT output and
+#smoothed data are rewritten by reruns, FEAT and Smoothing_native.py, so are only reported. Linked files are also made
+#read-only, so that anything trying to write to one in place fails instead of changing the other copies.
+link_duplicates = False
+link_stages = {'FEAT/Behav', 'FEAT/EVs'}
+undo = False
+manifest_file = os.path.join(output_dir, 'Hardlink_manifest.csv')
+
+#The number of threads used to scan directories and hash files, and the size of each block read when hashing. Files
+#are first compared on a hash of their first block, and only fully hashed if that matches another file.
+n_threads = 16
+block_size = 1 << 20
+
+#A pattern for the pipeline folder in a path.
+pipeline_pattern = re.compile(r'^Pipeline_(\w+)$')
+
+#A function to find the type of a file from its name, keeping compressed extensions together (e.g. '.nii.gz').
+def file_type(name):
+	parts = name.split('.')
+	if len(parts) == 1:
+		return 'none'
+	if parts[-1] == 'gz' and len(parts) > 2:
+		return '.' + '.'.join(parts[-2:])
+	return '.' + parts[-1]
+
+#A function to find the pipeline and stage of a file from its path relative to one of the roots. The stage is the
+#root name and the first folder within the pipeline's folder, skipping the subject folder (e.g. 'fMRIPrep/derivatives',
+#'fMRIPrep/scratch', or 'FEAT/Functional').
+def classify(area, relative_path):
+	parts = relative_path.split(os.sep)
+	match = pipeline_pattern.match(parts[0])
+	if not match:
+		return 'none', area
+	folders = [part for part in parts[1:-1] if not part.startswith('sub-')]
+	return match.group(1), '{}/{}'.format(area, folders[0] if folders else '.')
+
+#A function to scan one directory. Returns its subdirectories, and a tuple of (path, size, device, inode, link count,
+#stat) for each file in it. Symbolic links are not followed.
+def scan_directory(path):
+	subdirectories, files = [], []
+	try:
+		with os.scandir(path) as entries:
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					subdirectories.append(entry.path)
+				elif entry.is_file(follow_symlinks=False):
+					stat = entry.stat(follow_symlinks=False)
+					files.append((entry.path, stat.st_size, stat.st_dev, stat.st_ino, stat.st_nlink, stat))
+	except OSError as error:
+		print("Could not scan {}: {}".format(path, error))
+	return subdirectories, files
+
+#A function to scan every directory below each root across a pool of threads. Each directory is submitted as soon as
+#its parent has been scanned, so the pool stays busy however deep or wide the tree is. Totals are kept for each
+#pipeline, stage and type (counting each inode once, so files that are already hardlinked aren't counted twice), and
+#files that could be duplicates are grouped by size.
+def inventory(executor):
+	totals = defaultdict(lambda: [0, 0])
+	by_size = defaultdict(list)
+	seen_inodes = set()
+	for area, root in roots.items():
+		pending = {executor.submit(scan_directory, root)}
+		while pending:
+			done, pending = wait(pending, return_when=FIRST_COMPLETED)
+			for future in done:
+				subdirectories, files = future.result()
+				pending.update(executor.submit(scan_directory, subdirectory) for subdirectory in subdirectories)
+				for path, size, device, inode, links, stat in files:
+					if links > 1:
+						if (device, inode) in seen_inodes:
+							continue
+						seen_inodes.add((device, inode))
+					pipeline, stage = classify(area, os.path.relpath(path, root))
+					total = totals[(pipeline, stage, file_type(path))]
+					total[0] += 1
+					total[1] += size
+					if size >= min_dedup_size and stage.split('/')[1] not in dedup_excluded:
+						by_size[size].append((path, device, inode, file_state(stat)))
+	return totals, by_size
+
+#A function to record the state of a file when it's inventoried: its size and modification time (to check that it
+#hasn't changed before it's linked), and its permissions, owner and group (which a hardlink would replace).
+def file_state(stat):
+	return (stat.st_size, stat.st_mtime_ns, stat.st_mode & 0o7777, stat.st_uid, stat.st_gid)
+
+#A function to calculate the SHA-256 hash of a file, either of its first block only or of the whole file.
+def hash_file(path, first_block_only=False):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		if first_block_only:
+			digest.update(f.read(block_size))
+		else:
+			for block in iter(lambda: f.read(block_size), b''):
+				digest.update(block)
+	return digest.hexdigest()
+
+#A function to group files by the hash of their contents, across a pool of threads. Returns a list of groups of
+#identical files, each as (hash, size, paths).
+def hash_groups(executor, files, size, first_block_only):
+	hashes = executor.map(lambda file: hash_file(file[0], first_block_only), files)
+	groups = defaultdict(list)
+	for file, digest in zip(files, hashes):
+		groups[digest].append(file)
+	return [(digest, size, group) for digest, group in groups.items() if len(group) > 1]
+
+#A function to find groups of duplicate files. Only files with the same size (and on the same device, so they could be
+#linked) are compared. Files that are already links to the same inode are treated as one. Files larger than one block
+#are first compared on their first block, and only fully hashed if that matches. Returns a list of groups, each as
+#(hash, size, files), with each file as (path, state) in order of path.
+def find_duplicates(executor, by_size):
+	duplicates = []
+	for size, files in by_size.items():
+		by_device = defaultdict(dict)
+		for path, device, inode, state in files:
+			by_device[device].setdefault(inode, (path, state))
+		for inodes in by_device.values():
+			if len(inodes) < 2:
+				continue
+			candidates = sorted(inodes.values())
+			if size > block_size:
+				candidates = [file for _, _, group in hash_groups(executor, candidates, size, True) for file in group]
+			for digest, size, group in hash_groups(executor, candidates, size, False):
+				duplicates.append((digest, size, sorted(group)))
+	return duplicates
+
+#A function to find the stage of a file from its full path (see 'classify').
+def stage_of(path):
+	for area, root in roots.items():
+		if path.startswith(os.path.join(root, '')):
+			return classify(area, os.path.relpath(path, root))[1]
+	return None
+
+#A function to check whether a file's permissions (other than write permission, which linked files lose), owner and
+#group are the same as the canonical copy's, as the link would silently replace them with the canonical copy's.
+def same_access(state, canonical_state):
+	return (state[2] & ~0o222, state[3], state[4]) == (canonical_state[2] & ~0o222, canonical_state[3], canonical_state[4])
+
+#A function to replace the duplicates in a group with hardlinks to the first (canonical) copy. Only files in the stages
+#in 'link_stages' are linked. Every file is checked again just before linking, and a file is skipped if it or the
+#canonical copy has changed size or modification time since it was inventoried (and so hashed), or if its access
+#differs from the canonical copy's. Each link is created beside the file and then moved over it, so the file is never
+#missing, and the canonical copy is then made read-only. Returns a list of rows, for the manifest or for the list of
+#skipped files, with whether each file was linked.
+def link_group(digest, size, files):
+	files = [file for file in files if stage_of(file[0]) in link_stages]
+	if len(files) < 2:
+		return []
+	(canonical_path, canonical_state), results = files[0], []
+	for path, state in files[1:]:
+		row = {'Path': path, 'Canonical': canonical_path, 'Size': size, 'SHA256': digest}
+		try:
+			current = [file_state(os.stat(canonical_path)), file_state(os.stat(path))]
+		except FileNotFoundError:
+			results.append((dict(row, Reason='missing'), False))
+			continue
+		if current != [canonical_state, state]:
+			results.append((dict(row, Reason='changed since inventory'), False))
+			continue
+		if not same_access(state, canonical_state):
+			results.append((dict(row, Reason='mode {} uid {} gid {}, canonical mode {} uid {} gid {}'.format(oct(state[2]), state[3], state[4],
+				oct(canonical_state[2]), canonical_state[3], canonical_state[4])), False))
+			continue
+		temporary = path + '.dedup_tmp'
+		os.link(canonical_path, temporary)
+		os.replace(temporary, path)
+		results.append((dict(row, Mode=oct(state[2]), Canonical_mode=oct(canonical_state[2]), Mtime=state[1] / 1e9), True))
+	if any(linked for _, linked in results):
+		os.chmod(canonical_path, canonical_state[2] & ~0o222)
+	return results
+
+#A function to undo a link from the manifest, giving the file its own copy again (with its original permissions and
+#modification time). Files that are no longer linked to their canonical copy are left alone.
+def unlink_file(row):
+	path, canonical = row['Path'], row['Canonical']
+	if not (os.path.exists(path) and os.path.exists(canonical) and os.path.samefile(path, canonical)):
+		return False
+	temporary = path + '.dedup_tmp'
+	shutil.copyfile(canonical, temporary)
+	os.chmod(temporary, int(row['Mode'], 8))
+	os.utime(temporary, (float(row['Mtime']), float(row['Mtime'])))
+	os.replace(temporary, path)
+	return True
+
+#A function to give a canonical copy its original permissions back once none of its links are left.
+def restore_canonical(row):
+	canonical = row['Canonical']
+	if row.get('Canonical_mode') and os.path.exists(canonical) and os.stat(canonical).st_nlink == 1:
+		os.chmod(canonical, int(row['Canonical_mode'], 8))
+
+if __name__ == '__main__':
+
+	if not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+
+	with ThreadPoolExecutor(max_workers=n_threads) as executor:
+
+		#Undoes the links in the manifest, if requested, and stops.
+		if undo:
+			with open(manifest_file, newline='') as f:
+				rows = list(csv.DictReader(f))
+			restored = sum(executor.map(unlink_file, rows))
+			for row in rows:
+				restore_canonical(row)
+			print("Restored {} of {} linked file(s) to separate copies.".format(restored, len(rows)))
+			raise SystemExit
+
+		#Writes the storage used by each pipeline, stage and file type.
+		totals, by_size = inventory(executor)
+		with open(os.path.join(output_dir, 'Storage_inventory.csv'), 'w', newline = '') as output:
+			writer = csv.writer(output)
+			writer.writerow(['Pipeline', 'Stage', 'Type', 'Files', 'Bytes'])
+			for (pipeline, stage, kind), (files, size) in sorted(totals.items()):
+				writer.writerow([pipeline, stage, kind, files, size])
+		print("Inventoried {} file(s), {:.1f} GB.".format(sum(total[0] for total in totals.values()), sum(total[1] for total in totals.values()) / 1e9))
+
+		#Finds and writes out duplicates. The first copy (by path) of each group is kept as the canonical copy.
+		duplicates = find_duplicates(executor, by_size)
+		with open(os.path.join(output_dir, 'Duplicates.csv'), 'w', newline = '') as output:
+			writer = csv.writer(output)
+			writer.writerow(['SHA256', 'Size', 'Canonical', 'Path'])
+			for digest, size, files in duplicates:
+				writer.writerows([digest, size, files[0][0], path] for path, _ in files[1:])
+		print("Found {} group(s) of duplicates, {:.1f} GB could be saved.".format(len(duplicates), sum(size * (len(files) - 1) for _, size, files in duplicates) / 1e9))
+
+		#Replaces duplicates with hardlinks, if requested, adding each link to the manifest so that it can be undone.
+		#Files that were skipped are written out with the reason.
+		if link_duplicates:
+			results = [result for group in executor.map(lambda group: link_group(*group), duplicates) for result in group]
+			rows = [row for row, linked in results if linked]
+			skipped = [row for row, linked in results if not linked]
+			new_manifest = not os.path.exists(manifest_file)
+			with open(manifest_file, 'a', newline = '') as output:
+				writer = csv.DictWriter(output, fieldnames = ['Path', 'Canonical', 'Size', 'SHA256', 'Mode', 'Canonical_mode', 'Mtime'])
+				if new_manifest:
+					writer.writeheader()
+				writer.writerows(rows)
+			with open(os.path.join(output_dir, 'Link_skipped.csv'), 'w', newline = '') as output:
+				writer = csv.DictWriter(output, fieldnames = ['Path', 'Canonical', 'Size', 'SHA256', 'Reason'])
+				writer.writeheader()
+				writer.writerows(skipped)
+			print("Linked {} file(s), skipped {} (see Link_skipped.csv).".format(len(rows), len(skipped)))
@@ -0,0 +1,229 @@
+#Imports relevant modules.
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import pstats
+import inspect
+import atexit
+import cProfile
+import resource
+import threading
+import functools
+import contextlib
+import tracemalloc
+from collections import defaultdict
+
+#Shared instrumentation for the analysis scripts. Scripts wrap each subject, and each read or write of a file, in a
+#'span', and every span is written as one line of a JSON-lines file, with its wall time, CPU time, bytes read and
+#written, and the peak resident memory of the process. Tracing is switched off unless one of these environment
+#variables is set:
+#  SUSTAINABILITY_TRACE: the file spans are appended to (e.g. 'SUSTAINABILITY_TRACE=trace.jsonl python Script.py').
+#  SUSTAINABILITY_PROFILE: 'cprofile', 'tracemalloc', or both separated by a comma. cProfile profiles the whole run,
+#  saved beside the trace file when the script exits, and tracemalloc adds the peak Python/numpy allocations to each
+#  span, along with a list of the lines allocating the most memory. Both slow scripts down.
+#Scripts call 'span', 'traced' and 'each' unconditionally: with tracing switched off they only run the code they wrap,
+#and with it on, every wrapped subject, file, chunk or map is recorded (including those in worker processes).
+#Running this module directly summarises a trace file, ranking the stages and subjects with the highest wall time.
+trace_file = os.environ.get('SUSTAINABILITY_TRACE', '')
+profile = [option.strip() for option in os.environ.get('SUSTAINABILITY_PROFILE', '').split(',') if option.strip()]
+if profile and not trace_file:
+	trace_file = 'sustainability_trace.jsonl'
+enabled = bool(trace_file)
+
+#The number of stages and subjects listed by the summary.
+top_n = 15
+
+#The name of the running script, which is recorded with each span.
+script = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else 'interactive'
+
+#The spans currently open in each thread, innermost last, and the file descriptor spans are written to (opened again
+#in worker processes, which inherit the parent's descriptor).
+local = threading.local()
+output = {'fd': None, 'pid': None}
+
+#A function to read the bytes read and written by this process so far, from /proc/self/io (Linux only). These count
+#every read and write call, including those served from the page cache, and include all threads of the process.
+def io_counters():
+	try:
+		with open('/proc/self/io', 'rb') as f:
+			counters = dict(line.split(b': ') for line in f.read().splitlines())
+		return int(counters[b'rchar']), int(counters[b'wchar'])
+	except (OSError, KeyError, ValueError):
+		return None, None
+
+#A function to write one record to the trace file. Each record is a single write to a file opened in append mode,
+#so records from several processes aren't interleaved.
+def write_record(record):
+	if output['pid'] != os.getpid():
+		output['fd'] = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		output['pid'] = os.getpid()
+	os.write(output['fd'], (json.dumps(record, default=str) + '\n').encode())
+
+#A context manager recording one span. Extra keyword arguments (e.g. pipeline or contrast) are written with the span.
+#Spans opened within another span are recorded with their parent's stage, and take their parent's subject unless
+#given one. If the span ends with an exception, the type of exception is recorded.
+@contextlib.contextmanager
+def span(stage, subject=None, **fields):
+	if not enabled:
+		yield
+		return
+
+	stack = local.__dict__.setdefault('stack', [])
+	parent = stack[-1] if stack else None
+	if subject is None and parent is not None:
+		subject = parent['subject']
+	current = {'stage': stage, 'subject': subject, 'traced_peak': 0}
+
+	#tracemalloc only keeps one peak, so it's reset for each span. The parent's peak so far is kept first, and the
+	#parent takes this span's peak when it ends.
+	if tracemalloc.is_tracing():
+		if parent is not None:
+			parent['traced_peak'] = max(parent['traced_peak'], tracemalloc.get_traced_memory()[1])
+		tracemalloc.reset_peak()
+	stack.append(current)
+
+	error = None
+	start, wall_start, cpu_start = time.time(), time.perf_counter(), time.process_time()
+	read_start, written_start = io_counters()
+	try:
+		yield
+	except GeneratorExit:
+		raise
+	except BaseException as exception:
+		error = type(exception).__name__
+		raise
+	finally:
+		wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+		read_end, written_end = io_counters()
+		stack.pop()
+
+		#ru_maxrss is given in kilobytes on Linux.
+		record = {'script': script,
+			'pid': os.getpid(),
+			'stage': stage,
+			'subject': subject,
+			'parent': parent['stage'] if parent is not None else None,
+			'depth': len(stack),
+			'start': start,
+			'wall_s': wall,
+			'cpu_s': cpu,
+			'read_MB': (read_end - read_start) / 1e6 if read_start is not None else None,
+			'written_MB': (written_end - written_start) / 1e6 if written_start is not None else None,
+			'peak_rss_MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3}
+		if tracemalloc.is_tracing():
+			current['traced_peak'] = max(current['traced_peak'], tracemalloc.get_traced_memory()[1])
+			record['traced_peak_MB'] = current['traced_peak'] / 1e6
+			if parent is not None:
+				parent['traced_peak'] = max(parent['traced_peak'], current['traced_peak'])
+		if error is not None:
+			record['error'] = error
+		record.update(fields)
+		write_record(record)
+
+#A decorator recording each call of a function (e.g. one that reads or copies a file) as a span of the given stage. If
+#'subject_arg' names one of the function's arguments, its value is recorded as the subject.
+def traced(stage, subject_arg=None, **fields):
+	def decorator(function):
+		signature = inspect.signature(function)
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			subject = str(signature.bind(*args, **kwargs).arguments[subject_arg]) if enabled and subject_arg else None
+			with span(stage, subject=subject, **fields):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+#A generator recording each iteration of a loop as a span, with the item as the subject, e.g.
+#'for subject in each(subjects, 'subject'):'. Each span ends when the next item is requested or the loop ends.
+def each(items, stage, **fields):
+	for item in items:
+		with span(stage, subject=str(item), **fields):
+			yield item
+
+#A function to save the profiles when the script exits, beside the trace file, named after the script and process.
+def save_profiles(profiler):
+	prefix = '{}.{}.{}'.format(os.path.splitext(trace_file)[0], os.path.splitext(script)[0], os.getpid())
+	if profiler is not None:
+		profiler.disable()
+		profiler.dump_stats(prefix + '.prof')
+	if tracemalloc.is_tracing():
+		statistics = tracemalloc.take_snapshot().statistics('lineno')
+		with open(prefix + '.tracemalloc.txt', 'w') as f:
+			f.write('\n'.join(str(statistic) for statistic in statistics[:50]) + '\n')
+
+#Starts profiling as soon as a script imports this module, if requested. Worker processes started by a pool exit
+#without running exit handlers, so only the main process is profiled (spans are still recorded in workers).
+if enabled and profile:
+	profiler = None
+	if 'tracemalloc' in profile:
+		tracemalloc.start()
+	if 'cprofile' in profile:
+		profiler = cProfile.Profile()
+		profiler.enable()
+	atexit.register(save_profiles, profiler)
+
+#A function to load the spans from a trace file.
+def load_spans(path):
+	with open(path) as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+#A function to summarise spans by a key (e.g. script and stage). Returns rows of the number of spans, total and largest
+#wall time, total CPU time, total MB read and written, and largest peak RSS, sorted by total wall time.
+def summarise_spans(spans, key):
+	totals = defaultdict(lambda: {'Spans': 0, 'Wall_s': 0.0, 'Max_wall_s': 0.0, 'CPU_s': 0.0, 'Read_MB': 0.0, 'Written_MB': 0.0, 'Peak_RSS_MB': 0.0})
+	for record in spans:
+		total = totals[key(record)]
+		total['Spans'] += 1
+		total['Wall_s'] += record['wall_s']
+		total['Max_wall_s'] = max(total['Max_wall_s'], record['wall_s'])
+		total['CPU_s'] += record['cpu_s']
+		total['Read_MB'] += record['read_MB'] or 0
+		total['Written_MB'] += record['written_MB'] or 0
+		total['Peak_RSS_MB'] = max(total['Peak_RSS_MB'], record['peak_rss_MB'])
+	return sorted(totals.items(), key=lambda item: -item[1]['Wall_s'])
+
+if __name__ == '__main__':
+
+	#The trace file to summarise is given as an argument, or taken from SUSTAINABILITY_TRACE.
+	path = sys.argv[1] if len(sys.argv) > 1 else trace_file
+	spans = load_spans(path)
+
+	#Ranks stages by their total wall time. Spans within another span (e.g. reading a file for one subject) are also
+	#counted in their parent, so the totals of stages at different depths overlap.
+	stages = summarise_spans(spans, lambda record: (record['script'], record['stage'], record['depth']))
+	print("Hottest stages in {} ({} spans):".format(path, len(spans)))
+	print("{:<28}{:<22}{:>6}{:>8}{:>12}{:>12}{:>10}{:>10}{:>10}".format('Script', 'Stage', 'Depth', 'Spans', 'Wall_s', 'CPU_s', 'Read_MB', 'Write_MB', 'RSS_MB'))
+	for (name, stage, depth), total in stages[:top_n]:
+		print("{:<28}{:<22}{:>6}{:>8}{:>12.2f}{:>12.2f}{:>10.1f}{:>10.1f}{:>10.1f}".format(name[:27], stage[:21], depth, total['Spans'], total['Wall_s'],
+			total['CPU_s'], total['Read_MB'], total['Written_MB'], total['Peak_RSS_MB']))
+
+	#Ranks subjects by their wall time in each stage, compared with the median subject for that stage.
+	subject_spans = [record for record in spans if record['subject'] is not None]
+	subjects = summarise_spans(subject_spans, lambda record: (record['script'], record['stage'], record['subject']))
+	medians = {}
+	for (name, stage, subject), total in subjects:
+		medians.setdefault((name, stage), []).append(total['Wall_s'])
+	medians = {key: sorted(values)[len(values) // 2] for key, values in medians.items()}
+	print("\nHottest subjects:")
+	print("{:<28}{:<22}{:<16}{:>12}{:>12}{:>10}".format('Script', 'Stage', 'Subject', 'Wall_s', 'x_median', 'Read_MB'))
+	for (name, stage, subject), total in subjects[:top_n]:
+		median = medians[(name, stage)]
+		print("{:<28}{:<22}{:<16}{:>12.2f}{:>12.1f}{:>10.1f}".format(name[:27], stage[:21], subject[:15], total['Wall_s'],
+			total['Wall_s'] / median if median else 0, total['Read_MB']))
+
+	#Lists the functions with the highest cumulative time across any profiles saved beside the trace file.
+	profiles = glob.glob('{}.*.prof'.format(glob.escape(os.path.splitext(path)[0])))
+	if profiles:
+		print("\nHottest functions across {} profile(s):".format(len(profiles)))
+		pstats.Stats(*profiles).sort_stats('cumulative').print_stats(top_n)
+
+	#Writes both rankings in full beside the trace file.
+	prefix = os.path.splitext(path)[0]
+	for suffix, rows, labels in [('stages', stages, ['Script', 'Stage', 'Depth']), ('subjects', subjects, ['Script', 'Stage', 'Subject'])]:
+		with open('{}_{}.csv'.format(prefix, suffix), 'w', newline = '') as f:
+			writer = csv.writer(f)
+			writer.writerow(labels + list(rows[0][1].keys()) if rows else labels)
+			writer.writerows(list(key) + list(total.values()) for key, total in rows)
@@ -0,0 +1,122 @@
+#Imports relevant modules.
+import os
+import csv
+import shutil
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from Job_generator import ROOT_DIR, script_dir, pipelines, provenance_groups, list_subjects, is_complete, reuse_anatomy
+
+#Seeds each pipeline's FreeSurfer and anatomical derivatives from the pipeline in its group that has already run them.
+#Pipelines are grouped by Job_generator.py according to the flags that change anatomical processing. FreeSurfer folders
+#are always copied, as recon-all resumes in place in the target pipeline (writing logs, status and touch files, and
+#rewriting files in 'mri' and 'surf'), which would change the source pipeline's files through a shared hardlink.
+#Anatomical derivatives are only hardlinked if 'reuse_anatomy' is switched on in Job_generator.py, in which case the
+#target pipelines read them through '--anat-derivatives' and don't rewrite them. Otherwise they're copied too.
+
+#If True, no files are linked or copied, and files already present in both pipelines are only compared.
+verify_only = False
+
+#The number of threads used to calculate checksums, and the size of each block read when doing so.
+n_threads = 8
+block_size = 1 << 20
+
+#Defines the output manifest, which lists every seeded file with its checksum.
+manifest_file = os.path.join(script_dir, 'Anatomical_reuse_manifest.csv')
+
+#A function to find the derivatives directory of a pipeline.
+def derivatives_dir(pipeline):
+	return os.path.join(ROOT_DIR, 'Pipeline_{}'.format(pipeline), 'derivatives')
+
+#A function to find the folders to be reused for a subject, at each level: the FreeSurfer reconstruction, and the
+#anatomical derivatives. Paths are relative to the derivatives directory.
+def reused_folders(subject):
+	return {'freesurfer': os.path.join('sourcedata', 'freesurfer', subject),
+		'anat': os.path.join(subject, 'anat')}
+
+#A function to calculate the SHA-256 checksum of a file, reading it in blocks. Results are cached, so that each source
+#file is only read once however many pipelines it's seeded into.
+@lru_cache(maxsize=None)
+def checksum(path):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+#A function to list every file below a folder, as paths relative to the given root.
+def list_files(root, folder):
+	files = []
+	for directory, _, filenames in os.walk(os.path.join(root, folder)):
+		files.extend(os.path.relpath(os.path.join(directory, filename), root) for filename in filenames)
+	return files
+
+#A function to check whether the files of a level can be hardlinked rather than copied (see above).
+def can_link(level):
+	return level == 'anat' and reuse_anatomy
+
+#A function to copy one file, with its modification time and permissions, into place. It's copied to a temporary file
+#first, so that a file interrupted part way through is never left at the target path.
+def copy_file(source_path, target_path):
+	temporary = target_path + '.partial'
+	shutil.copy2(source_path, temporary)
+	os.replace(temporary, target_path)
+
+#A function to seed one file from the source pipeline into the target pipeline (unless it already exists there), by
+#hardlink or copy, then check that the two are identical. A target that is a hardlink to the source from an earlier run
+#is replaced with a copy if the level can't be linked. Files that are the same inode are identical by definition;
+#otherwise both checksums are compared. Returns a row for the manifest.
+def seed_file(source, target, level, relative_path):
+	source_path = os.path.join(derivatives_dir(source), relative_path)
+	target_path = os.path.join(derivatives_dir(target), relative_path)
+
+	if not verify_only:
+		if not os.path.exists(target_path):
+			os.makedirs(os.path.dirname(target_path), exist_ok=True)
+			if can_link(level):
+				os.link(source_path, target_path)
+			else:
+				copy_file(source_path, target_path)
+		elif not can_link(level) and os.path.samefile(source_path, target_path):
+			copy_file(source_path, target_path)
+
+	source_sum = checksum(source_path)
+	if not os.path.exists(target_path):
+		target_sum, linked = '', False
+	elif os.path.samefile(source_path, target_path):
+		target_sum, linked = source_sum, True
+	else:
+		target_sum, linked = checksum(target_path), False
+
+	return {'Source': source, 'Target': target, 'Path': relative_path, 'Size': os.path.getsize(source_path),
+		'SHA256': source_sum, 'Linked': linked, 'Identical': source_sum == target_sum}
+
+if __name__ == '__main__':
+
+	#Lists each file to be seeded, for every target pipeline at each level of reuse.
+	subjects = list_subjects()
+	tasks = []
+	for level in ['freesurfer', 'anat']:
+		for group in provenance_groups(pipelines, level):
+			source, targets = group[0], group[1:]
+			for subject in subjects:
+				if not is_complete(derivatives_dir(source), subject):
+					continue
+				files = list_files(derivatives_dir(source), reused_folders(subject)[level])
+				tasks.extend((source, target, level, relative_path) for target in targets for relative_path in files)
+
+	#Seeds and checks files across a pool of threads (hashing releases the GIL), and writes the manifest.
+	with ThreadPoolExecutor(max_workers=n_threads) as executor:
+		rows = list(executor.map(lambda task: seed_file(*task), tasks))
+
+	with open(manifest_file, 'w', newline = '') as output:
+		writer = csv.DictWriter(output, fieldnames = ['Source', 'Target', 'Path', 'Size', 'SHA256', 'Linked', 'Identical'])
+		writer.writeheader()
+		writer.writerows(rows)
+
+	#Summarises the outcome for each target pipeline.
+	for target in pipelines:
+		target_rows = [row for row in rows if row['Target'] == target]
+		if target_rows:
+			print("Pipeline {}: {} file(s) seeded, {} linked, {} not identical.".format(target, len(target_rows),
+				sum(row['Linked'] for row in target_rows), sum(not row['Identical'] for row in target_rows)))
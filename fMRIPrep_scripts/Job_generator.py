@@ -0,0 +1,222 @@
+#Imports relevant modules.
+import os
+
+#Generates the array job script for each fMRIPrep pipeline from a single description of the flags shared by every
+#pipeline and the change made for each one, along with a manifest listing the subject for each task. Each task looks
+#up its subject by line number in the manifest, rather than every task listing the BIDS directory.
+
+#Defines the pipelines to generate scripts for, and the scheduler the scripts are written for ('sge' or 'slurm').
+pipelines = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+scheduler = 'sge'
+
+#Defines paths for (a) the input data, in BIDS format, (b) the folder pipeline-specific scratch and output folders are
+#created in, (c) the location of fMRIPrep license file, (d) the fMRIPrep singularity image, and (e) the folder that
+#generated scripts, manifests and logs are written into.
+DATA_DIR = '/<directory root>/CNP_BIDS' #Full path removed for purpose of public sharing.
+ROOT_DIR = '/<directory root>' #Full path removed for purpose of public sharing.
+LICENSE = '/<directory root>/fs_license/license.txt' #Full path removed for purpose of public sharing.
+IMAGE = '/<directory root>/fmriprep_singularity/fmriprep_22.1.1.simg' #Full path removed for purpose of public sharing.
+script_dir = '/<directory root>/fMRIPrep/job_scripts' #Full path removed for purpose of public sharing.
+log_root = '/<directory root>/fMRIPrep' #Full path removed for purpose of public sharing.
+
+#Requested memory per slot, the maximum number of tasks that can run simultaneously, and a list of problematic nodes
+#to avoid when submitting tasks.
+memory = '8G'
+max_concurrent = 50
+avoid_nodes = ['nodeXXX', 'nodeYYY']
+
+#The resources and fMRIPrep flags shared by every pipeline. Flags without a value are given as None.
+base = {'slots': 5,
+	'flags': {'--fs-license-file': '/license',
+		'--skip-bids-validation': None,
+		'--work-dir': '/wd',
+		'--omp-nthreads': '1',
+		'--nthreads': '5',
+		'--mem_mb': '30000',
+		'--output-spaces': 'MNI152NLin6Asym:res-2',
+		'--track-carbon': None,
+		'--country-code': 'GBR',
+		'--ignore': 'slicetiming',
+		'--random-seed': '1234',
+		'--skull-strip-fixed-seed': None}}
+
+#The change made to the base for each pipeline. Flags given here are added, or replace the base value.
+deltas = {'0': {},
+	'1': {'flags': {'--fs-no-reconall': None}}, #P1: FreeSurfer surface reconstruction switched off.
+	'2': {'flags': {'--sloppy': None}}, #P2: Turns on sloppy testing mode.
+	'3': {'flags': {'--low-mem': None}}, #P3: Low memory mode switched on.
+	'4': {'flags': {'--output-spaces': 'MNI152NLin6Asym:res-2 fsaverage'}}, #P4: Surface output space added.
+	'5': {'flags': {'--use-aroma': None}}, #P5: ICA-AROMA implemented.
+	'6': {'flags': {'--output-spaces': 'MNI152NLin6Asym:res-1'}}, #P6: Volumetric output space resolution increased.
+	'7': {'flags': {'--use-syn-sdc': 'error'}}, #P7: Fieldmap-free distortion correction implemented, produced an error message if needed.
+	'8': {'slots': 16, 'flags': {'--nthreads': '16'}}, #P8: Threads increased from 5 to 16.
+	'9': {'slots': 1, 'flags': {'--nthreads': '1'}}} #P9: Threads reduced from 5 to 1.
+
+#Flags that only change functional processing (or how fMRIPrep is run), and so leave anatomical outputs unchanged given
+#the fixed random seeds. Output spaces change the anatomical derivatives but not the FreeSurfer reconstruction.
+functional_flags = {'--fs-license-file', '--skip-bids-validation', '--work-dir', '--nthreads', '--mem_mb', '--track-carbon',
+	'--country-code', '--ignore', '--low-mem', '--use-aroma', '--use-syn-sdc'}
+space_flags = {'--output-spaces'}
+
+#If True, pipelines whose anatomical processing is identical to an earlier pipeline reuse its anatomical derivatives
+#(seeded by Anatomical_reuse.py) instead of recomputing them.
+reuse_anatomy = False
+
+#The header lines and task ID variable for each scheduler. Slurm doesn't allow comments on the same line as options.
+headers = {'sge': ["#$ -N P{pipeline} #Job ID name sent to HPC cluster.",
+		"#$ -pe openmp {slots} #Number of requested parallel environments.",
+		"#$ -o '{log_dir}' #Folder where fMRIPrep logs files are saved out by the HPC cluster.",
+		"#$ -e logs #Resquests logs.",
+		"#$ -l m_mem_free={memory} #Requested memory for HPC cluster.",
+		"#$ -l 'h={avoid}' #A list of problematic nodes to avoid when submitting tasks.",
+		"#$ -t 1-{n_tasks} #This sets SGE_TASK_ID!, the number of subjects sent for preprocessing in this job (each is a seperate task).",
+		"#$ -tc {max_concurrent} #The maximum number of tasks that can run simultaneously."],
+	'slurm': ["#Job ID name sent to HPC cluster.",
+		"#SBATCH --job-name=P{pipeline}",
+		"#Number of requested CPUs.",
+		"#SBATCH --cpus-per-task={slots}",
+		"#fMRIPrep logs, named in the same way as SGE logs.",
+		"#SBATCH --output={log_dir}/%x.o%A.%a",
+		"#Requested memory for HPC cluster.",
+		"#SBATCH --mem-per-cpu={memory}",
+		"#A list of problematic nodes to avoid when submitting tasks.",
+		"#SBATCH --exclude={exclude}",
+		"#The number of subjects sent for preprocessing in this job, and the maximum that can run simultaneously.",
+		"#SBATCH --array=1-{n_tasks}%{max_concurrent}"]}
+task_variables = {'sge': 'SGE_TASK_ID', 'slurm': 'SLURM_ARRAY_TASK_ID'}
+
+#The body of each script. The subject for this task is read from the manifest by line number.
+body = """
+#Defines paths for (a) the input data, in BIDS format, (b) the folder in which working directory/scratch files should
+#be generated, (c) the designated output folder for preprocesed data, (d) the location of fMRIPrep license file,
+#and (e) the local FreeSurfer directory. With the excepton of input directory and license, each is pipeline-specific.
+DATA_DIR={data_dir}
+SCRATCH_DIR={scratch_dir}
+OUT_DIR={out_dir}
+LICENSE={license}
+LOCAL_FREESURFER_DIR={freesurfer_dir}
+
+#Prints out the index of the current task ID
+echo This is task ${task_variable}
+
+#Defines and prints the subject ID, read from line {{task ID}} of the manifest, so this will be present within the log file.
+SUBJECT=$(sed -n "${{{task_variable}}}p" {manifest})
+echo $SUBJECT
+
+#Removes IsRunning files from the local FreeSurfer directory, if present. These files can cause problems if there
+#are issues with overwriting.
+find ${{LOCAL_FREESURFER_DIR}}/$SUBJECT/ -name "IsRunning" -type f -delete
+
+#The fMRIPrep command line (see https://fmriprep.org/en/stable/usage.html for info on flags).
+singularity run --cleanenv \\
+    -B ${{DATA_DIR}}:/data \\
+    -B ${{OUT_DIR}}/:/out \\
+    -B ${{SCRATCH_DIR}}:/wd \\
+    -B ${{LICENSE}}:/license \\
+{extra_binds}    {image} \\
+    --participant-label ${{SUBJECT}} \\
+{flags}
+    /data /out/ participant
+
+echo Done
+"""
+
+#A function to combine the base with a pipeline's delta, giving its slots and full set of flags.
+def pipeline_options(pipeline):
+	delta = deltas[pipeline]
+	flags = dict(base['flags'])
+	flags.update(delta.get('flags', {}))
+	return delta.get('slots', base['slots']), flags
+
+#A function to group pipelines that share anatomical provenance, i.e. whose flags differ only in functional options.
+#At the 'freesurfer' level output spaces are also ignored. Groups are ordered by their first pipeline, which is the
+#one that runs the anatomical processing for the group.
+def provenance_groups(pipelines, level='anat'):
+	ignored = functional_flags | (space_flags if level == 'freesurfer' else set())
+	groups = {}
+	for pipeline in pipelines:
+		flags = pipeline_options(pipeline)[1]
+		key = tuple(sorted((flag, value) for flag, value in flags.items() if flag not in ignored))
+		groups.setdefault(key, []).append(pipeline)
+	return list(groups.values())
+
+#A function to find the pipeline whose anatomical derivatives a pipeline should reuse (itself if none).
+def anat_source(pipeline, level='anat'):
+	for group in provenance_groups(pipelines, level):
+		if pipeline in group:
+			return group[0]
+
+#A function to list the subjects in the BIDS directory. This is done once, when scripts are generated.
+def list_subjects():
+	return sorted(entry.name for entry in os.scandir(DATA_DIR) if entry.is_dir() and entry.name.startswith('sub-'))
+
+#A function to check whether a subject has already been completed for a pipeline. fMRIPrep writes the subject's
+#HTML report once it has finished.
+def is_complete(out_dir, subject):
+	return os.path.exists(os.path.join(out_dir, '{}.html'.format(subject)))
+
+#A function to write the manifest and job script for one pipeline. Returns the script path and number of tasks. If
+#every subject is complete, neither is written (and any left from an earlier run are removed), and the path is None.
+def generate(pipeline, subjects):
+	pipeline_root = os.path.join(ROOT_DIR, 'Pipeline_{}'.format(pipeline))
+	out_dir = os.path.join(pipeline_root, 'derivatives')
+	manifest = os.path.join(script_dir, 'Pipeline_{}_subjects.txt'.format(pipeline))
+	script = os.path.join(script_dir, 'Pipeline_{}.sh'.format(pipeline))
+
+	#Subjects who have already been completed are excluded, and the rest are written to the manifest, one per line.
+	remaining = [subject for subject in subjects if not is_complete(out_dir, subject)]
+	if not remaining:
+		for old_file in [manifest, script]:
+			if os.path.exists(old_file):
+				os.remove(old_file)
+		return None, 0
+	with open(manifest, 'w') as f:
+		f.write(''.join(subject + '\n' for subject in remaining))
+
+	#Fills in the header and body for this pipeline.
+	slots, flags = pipeline_options(pipeline)
+
+	#If anatomy is reused, the source pipeline's derivatives are mounted read-only and passed to fMRIPrep.
+	extra_binds = ''
+	source = anat_source(pipeline)
+	if reuse_anatomy and source != pipeline:
+		extra_binds = '    -B {}:/anat:ro \\\n'.format(os.path.join(ROOT_DIR, 'Pipeline_{}'.format(source), 'derivatives'))
+		flags['--anat-derivatives'] = '/anat'
+	values = {'pipeline': pipeline,
+		'slots': slots,
+		'log_dir': os.path.join(log_root, 'Pipeline_{}'.format(pipeline), 'logs'),
+		'memory': memory,
+		'avoid': '&'.join('!' + node for node in avoid_nodes),
+		'exclude': ','.join(avoid_nodes),
+		'n_tasks': len(remaining),
+		'max_concurrent': max_concurrent}
+	lines = ['#!/bin/bash'] + [line.format(**values) for line in headers[scheduler]]
+	flag_lines = '\n'.join('    {} \\'.format(flag if value is None else '{} {}'.format(flag, value)) for flag, value in flags.items())
+	lines.append(body.format(data_dir=DATA_DIR,
+		scratch_dir=os.path.join(pipeline_root, 'scratch'),
+		out_dir=out_dir,
+		license=LICENSE,
+		freesurfer_dir=os.path.join(out_dir, 'sourcedata', 'freesurfer'),
+		task_variable=task_variables[scheduler],
+		manifest=manifest,
+		extra_binds=extra_binds,
+		image=IMAGE,
+		flags=flag_lines))
+
+	with open(script, 'w') as f:
+		f.write('\n'.join(lines))
+	return script, len(remaining)
+
+if __name__ == '__main__':
+
+	if not os.path.isdir(script_dir):
+		os.makedirs(script_dir)
+
+	#Lists the subjects once, then generates a script and manifest for each pipeline.
+	subjects = list_subjects()
+	for pipeline in pipelines:
+		script, n_tasks = generate(pipeline, subjects)
+		if n_tasks == 0:
+			print("All subjects are complete for Pipeline {}, no script is needed.".format(pipeline))
+		else:
+			print("Generated {} with {} task(s).".format(script, n_tasks))